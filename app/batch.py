@@ -0,0 +1,237 @@
+"""
+Bulk generation over JSONL.
+
+Each input line is a GraphGenerateRequest object with an optional "id" field
+(defaults to the 1-based line number). Results are emitted as JSONL in
+completion order:
+
+    {"id": "...", "key": "<input hash>", "response": {...GraphGenerateResponse}}
+    {"id": "...", "key": "<input hash>", "error": "..."}
+
+Records are read as they arrive and handed to `concurrency` workers through a
+bounded queue, so memory does not grow with the input. Identical inputs share
+one run while it is in flight, and the last BATCH_SHARED_RESULTS results are
+reused. Batch runs do not open sessions. The CLI appends to its output file
+and, with --resume, skips ids that already succeeded there:
+
+    python -m app.batch features.jsonl -o results.jsonl --concurrency 8 --resume
+"""
+import argparse
+import asyncio
+import codecs
+import json
+import os
+import sys
+from collections import OrderedDict
+from typing import Any, AsyncIterable, AsyncIterator, Dict, Iterable, Optional, Set, Tuple, Union
+
+from fastapi import HTTPException
+from pydantic import ValidationError
+
+from app.cache import canonical_hash
+from app.runner import prepare_features_run, run_graph
+from app.schemas import GraphGenerateRequest
+
+DEFAULT_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "64"))
+# Finished results kept for identical inputs later in the batch
+SHARED_RESULTS = int(os.getenv("BATCH_SHARED_RESULTS", "1000"))
+# Request body chunks buffered ahead of the record parser
+BODY_CHUNKS = int(os.getenv("BATCH_BODY_CHUNKS", "16"))
+
+ParsedRecord = Tuple[str, Optional[GraphGenerateRequest], Optional[str]]
+
+
+def _parse_line(lineno: int, raw: str) -> Optional[ParsedRecord]:
+    raw = raw.strip()
+    if not raw:
+        return None
+    record_id = str(lineno)
+    try:
+        data = json.loads(raw)
+        if not isinstance(data, dict):
+            raise ValueError("each line must be a JSON object")
+        record_id = str(data.pop("id", lineno))
+        return record_id, GraphGenerateRequest(**data), None
+    except (ValueError, ValidationError) as e:
+        return record_id, None, f"invalid_record: {e}"
+
+
+def parse_records(lines: Iterable[str]) -> Iterable[ParsedRecord]:
+    """Yield (id, request, error) for each non-blank JSONL line."""
+    for lineno, raw in enumerate(lines, start=1):
+        record = _parse_line(lineno, raw)
+        if record is not None:
+            yield record
+
+
+async def aparse_records(lines: AsyncIterable[str]) -> AsyncIterator[ParsedRecord]:
+    """parse_records for lines that arrive asynchronously (a request body)."""
+    lineno = 0
+    async for raw in lines:
+        lineno += 1
+        record = _parse_line(lineno, raw)
+        if record is not None:
+            yield record
+
+
+async def body_lines(chunks: AsyncIterable[bytes]) -> AsyncIterator[str]:
+    """Split a streamed UTF-8 body into lines without holding more than one line."""
+    # Undecodable bytes become U+FFFD, so that line is reported as an invalid record
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    buffer = ""
+    async for chunk in chunks:
+        buffer += decoder.decode(chunk)
+        *complete, buffer = buffer.split("\n")
+        for line in complete:
+            yield line
+    buffer += decoder.decode(b"", final=True)
+    if buffer:
+        yield buffer
+
+
+async def _aiter(items: Iterable[ParsedRecord]) -> AsyncIterator[ParsedRecord]:
+    for item in items:
+        yield item
+
+
+def request_key(request: GraphGenerateRequest) -> str:
+    return canonical_hash(request.model_dump())
+
+
+async def _generate(request: GraphGenerateRequest) -> Dict[str, Any]:
+    try:
+        # Batch graphs queue behind interactive requests for LLM capacity
+        run = await prepare_features_run(request, route="/v1/generate-graph/batch", priority="batch")
+        response = await run_graph(run)
+    except HTTPException as e:
+        return {"error": e.detail}
+    except Exception as e:
+        return {"error": f"graph_error: {e}"}
+    return {"response": response.model_dump()}
+
+
+async def run_batch(
+    records: Union[Iterable[ParsedRecord], AsyncIterable[ParsedRecord]],
+    concurrency: int = DEFAULT_CONCURRENCY,
+    skip_ids: Optional[Set[str]] = None,
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Run records on `concurrency` workers, yielding results as they finish.
+    Closing the iterator (e.g. the client disconnected) cancels every run.
+    """
+    workers = max(1, min(concurrency, MAX_CONCURRENCY))
+    skip_ids = skip_ids or set()
+    if not hasattr(records, "__aiter__"):
+        records = _aiter(records)
+    # Bounded, so a large input waits for the workers instead of piling up in memory
+    inbox: "asyncio.Queue[Optional[Tuple[str, GraphGenerateRequest, str]]]" = asyncio.Queue(maxsize=workers * 2)
+    outbox: "asyncio.Queue[Optional[Dict[str, Any]]]" = asyncio.Queue()
+    running: Dict[str, "asyncio.Future"] = {}
+    finished: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+    def remember(key: str, run: "asyncio.Future") -> None:
+        running.pop(key, None)
+        if not run.cancelled() and SHARED_RESULTS > 0:
+            finished[key] = run.result()
+            while len(finished) > SHARED_RESULTS:
+                finished.popitem(last=False)
+
+    async def feed() -> None:
+        try:
+            async for record_id, request, error in records:
+                if record_id in skip_ids:
+                    continue
+                if error is not None:
+                    await outbox.put({"id": record_id, "error": error})
+                    continue
+                await inbox.put((record_id, request, request_key(request)))
+        finally:
+            for _ in range(workers):
+                await inbox.put(None)
+
+    async def work() -> None:
+        try:
+            while True:
+                item = await inbox.get()
+                if item is None:
+                    return
+                record_id, request, key = item
+                result = finished.get(key)
+                if result is None:
+                    # Identical inputs share one graph run
+                    run = running.get(key)
+                    if run is None:
+                        run = running[key] = asyncio.ensure_future(_generate(request))
+                        run.add_done_callback(lambda f, key=key: remember(key, f))
+                    result = await asyncio.shield(run)
+                await outbox.put({"id": record_id, "key": key, **result})
+        finally:
+            outbox.put_nowait(None)
+
+    feeder = asyncio.ensure_future(feed())
+    tasks = [asyncio.ensure_future(work()) for _ in range(workers)]
+    try:
+        done = 0
+        while done < workers:
+            result = await outbox.get()
+            if result is None:
+                done += 1
+            else:
+                yield result
+        # Surfaces an error reading the input
+        await feeder
+    finally:
+        for task in [feeder, *tasks, *running.values()]:
+            task.cancel()
+
+
+def completed_ids(path: str) -> Set[str]:
+    """Ids with a successful result in an existing output file (for --resume)."""
+    done: Set[str] = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, "r", encoding="utf-8") as f:
+        for raw in f:
+            try:
+                data = json.loads(raw)
+            except ValueError:
+                # Truncated last line from an interrupted run
+                continue
+            if isinstance(data, dict) and "response" in data and "id" in data:
+                done.add(str(data["id"]))
+    return done
+
+
+async def _main(args) -> int:
+    skip = completed_ids(args.output) if args.resume else set()
+    if skip:
+        print(f"resuming: {len(skip)} records already done", file=sys.stderr)
+
+    ok = failed = 0
+    with open(args.input, "r", encoding="utf-8") as src, open(args.output, "a" if args.resume else "w", encoding="utf-8") as out:
+        async for result in run_batch(parse_records(src), concurrency=args.concurrency, skip_ids=skip):
+            out.write(json.dumps(result) + "\n")
+            out.flush()
+            if "error" in result:
+                failed += 1
+            else:
+                ok += 1
+    print(f"done: {ok} ok, {failed} failed", file=sys.stderr)
+    return 1 if failed else 0
+
+
+def main() -> None:
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="JSONL of GraphGenerateRequest records")
+    parser.add_argument("-o", "--output", required=True, help="JSONL file to write results to")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--resume", action="store_true", help="Append to output and skip ids that already succeeded")
+    sys.exit(asyncio.run(_main(parser.parse_args())))
+
+
+if __name__ == "__main__":
+    main()
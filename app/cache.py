@@ -0,0 +1,398 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+
+def canonical_hash(payload: Dict[str, Any]) -> str:
+    """Stable sha256 of a JSON-serialisable payload (sorted keys, no whitespace)."""
+    blob = json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+def bytes_digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+# A full sqlite backend evicts down to this fraction of max_entries, so it recounts rarely
+EVICT_LOW_WATER = 0.9
+
+
+async def call_backend(backend, method: str, *args: Any) -> Any:
+    """Call a backend method from the event loop; in a worker thread when it does disk I/O (sqlite)."""
+    fn = getattr(backend, method)
+    if backend.offload:
+        return await asyncio.to_thread(fn, *args)
+    return fn(*args)
+
+
+class MemoryBackend:
+    """In-process LRU with per-entry TTL."""
+
+    name = "memory"
+    # A dict lookup is cheaper inline than a thread hop
+    offload = False
+
+    def __init__(self, max_entries: int = 1000):
+        self.max_entries = max(1, max_entries)
+        self._data: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at and expires_at < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any, ttl: Optional[float]) -> None:
+        expires_at = time.time() + ttl if ttl else 0.0
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def update(self, key: str, fn: Callable[[Any], Any], ttl: Optional[float], default: Any = None) -> Optional[Any]:
+        """
+        Atomically replace a live entry with fn(value) and restart its TTL. A
+        missing entry becomes fn(default), or is left missing (None) without a default.
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or (item[0] and item[0] < time.time()):
+                self._data.pop(key, None)
+                if default is None:
+                    return None
+                item = (0.0, default)
+            value = fn(item[1])
+            self._data[key] = (time.time() + ttl if ttl else 0.0, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+            return value
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
+
+
+class SQLiteBackend:
+    """
+    On-disk cache that survives restarts. Values are stored as JSON. Writes
+    keep an approximate row count (other processes may write too); once it
+    passes max_entries the table is recounted, expired rows are dropped and the
+    least recently accessed go until EVICT_LOW_WATER of max_entries is left.
+    """
+
+    name = "sqlite"
+    offload = True
+
+    def __init__(self, path: str, max_entries: int = 10000, table: str = "cache"):
+        self.path = path
+        self.max_entries = max(1, max_entries)
+        self.table = table
+        self.evictions = 0
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_accessed ON {table}(accessed_at)")
+        (self._approx_count,) = self._conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()
+
+    def get(self, key: str) -> Optional[Any]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(f"SELECT value, expires_at FROM {self.table} WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            value, expires_at = row
+            if expires_at and expires_at < now:
+                self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                return None
+            self._conn.execute(f"UPDATE {self.table} SET accessed_at = ? WHERE key = ?", (now, key))
+        return json.loads(value)
+
+    def set(self, key: str, value: Any, ttl: Optional[float]) -> None:
+        now = time.time()
+        expires_at = now + ttl if ttl else 0.0
+        with self._lock:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), expires_at, now),
+            )
+            # Replacing a key also counts, so this overestimates until the next recount
+            self._approx_count += 1
+            if self._approx_count > self.max_entries:
+                self._evict(now)
+
+    def _evict(self, now: float) -> None:
+        # Caller holds the lock
+        self._conn.execute(f"DELETE FROM {self.table} WHERE expires_at > 0 AND expires_at < ?", (now,))
+        (count,) = self._conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()
+        overflow = count - int(self.max_entries * EVICT_LOW_WATER) if count > self.max_entries else 0
+        if overflow > 0:
+            self._conn.execute(
+                f"DELETE FROM {self.table} WHERE key IN "
+                f"(SELECT key FROM {self.table} ORDER BY accessed_at ASC LIMIT ?)",
+                (overflow,),
+            )
+            self.evictions += overflow
+        self._approx_count = count - max(overflow, 0)
+
+    def update(self, key: str, fn: Callable[[Any], Any], ttl: Optional[float], default: Any = None) -> Optional[Any]:
+        """
+        Atomically replace a live entry with fn(value) and restart its TTL. A
+        missing entry becomes fn(default), or is left missing (None) without a
+        default. The read and the write share one BEGIN IMMEDIATE transaction,
+        so concurrent updates from other processes are not lost.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(f"SELECT value, expires_at FROM {self.table} WHERE key = ?", (key,)).fetchone()
+                live = row is not None and not (row[1] and row[1] < now)
+                if live or default is not None:
+                    value = fn(json.loads(row[0]) if live else default)
+                    self._conn.execute(
+                        f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                        (key, json.dumps(value), now + ttl if ttl else 0.0, now),
+                    )
+                else:
+                    value = None
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            if row is None and value is not None:
+                self._approx_count += 1
+                if self._approx_count > self.max_entries:
+                    self._evict(now)
+        return value
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute(f"DELETE FROM {self.table}")
+            self._approx_count = 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            (count,) = self._conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()
+        return count
+
+
+def build_backend(name: str, path: str, max_entries: int, table: str = "cache"):
+    """Backend factory: 'memory', 'sqlite' or 'off' (returns None)."""
+    name = (name or "memory").strip().lower()
+    if name in ("off", "none", "disabled"):
+        return None
+    if name == "memory":
+        return MemoryBackend(max_entries=max_entries)
+    if name == "sqlite":
+        return SQLiteBackend(path, max_entries=max_entries, table=table)
+    raise ValueError(f"unknown cache backend {name!r}; expected memory, sqlite or off")
+
+
+class ResponseCache:
+    """
+    Content-addressed cache of graph responses.
+
+    Keys hash the full generation input (features or image digest, model,
+    temperature, style set, mode). Only deterministic requests (temperature 0)
+    are cached by default, since users retry sampled requests to get new lines;
+    set RESPONSE_CACHE_NONDETERMINISTIC=1 to cache those too.
+    """
+
+    def __init__(self, backend, ttl: Optional[float] = None, cache_nondeterministic: bool = False):
+        self.backend = backend
+        self.ttl = ttl
+        self.cache_nondeterministic = cache_nondeterministic
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.bypasses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.backend is not None
+
+    def cacheable(self, temperature: Optional[float]) -> bool:
+        return self.enabled and (self.cache_nondeterministic or temperature == 0)
+
+    @staticmethod
+    def make_key(source: Dict[str, Any], **params: Any) -> str:
+        return canonical_hash({"source": source, **params})
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        value = await call_backend(self.backend, "get", key) if self.enabled else None
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, key: str, value: Dict[str, Any]) -> None:
+        if not self.enabled:
+            return
+        await call_backend(self.backend, "set", key, value, self.ttl)
+        self.writes += 1
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "backend": getattr(self.backend, "name", "off"),
+            "entries": len(self.backend) if self.enabled else 0,
+            "ttl_seconds": self.ttl,
+            "cache_nondeterministic": self.cache_nondeterministic,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            "writes": self.writes,
+            "bypasses": self.bypasses,
+            "evictions": getattr(self.backend, "evictions", 0),
+        }
+
+
+class VisionCache:
+    """
+    Long-lived cache of image digest -> extracted features for the describe node.
+
+    Concurrent misses for the same key are coalesced onto one vision call. The
+    call runs in a task owned by the cache, not by the request that started it,
+    so one caller's cancellation or deadline never fails the others: each caller
+    waits up to its own `timeout`, and the call finishes (and is cached) even if
+    every caller has given up. It stays in flight until its result is stored, so
+    a lookup in between joins it instead of calling again.
+    """
+
+    def __init__(self, backend, ttl: Optional[float] = None):
+        self.backend = backend
+        self.ttl = ttl
+        self._inflight: Dict[str, "asyncio.Task"] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.errors = 0
+
+    @staticmethod
+    def make_key(vision_model: str, image_digest: str) -> str:
+        return f"{vision_model}:{image_digest}"
+
+    async def get_or_compute(
+        self,
+        key: str,
+        compute: Callable[[], Awaitable[Dict[str, Any]]],
+        timeout: Optional[float] = None,
+    ) -> Dict[str, Any]:
+        """Cached value for `key`, or compute()'s; raises asyncio.TimeoutError after `timeout` seconds."""
+        if self.backend is not None:
+            cached = await call_backend(self.backend, "get", key)
+            if cached is not None:
+                self.hits += 1
+                return cached
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = asyncio.get_running_loop().create_task(compute())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._finished(key, t))
+        return await asyncio.wait_for(asyncio.shield(task), timeout)
+
+    def _finished(self, key: str, task: "asyncio.Task") -> None:
+        if task.cancelled():
+            return self._done(key, task)
+        # Also marks the error as retrieved when no caller is left to await it
+        if task.exception() is not None:
+            self.errors += 1
+            return self._done(key, task)
+        if self.backend is None:
+            return self._done(key, task)
+        store = asyncio.get_running_loop().create_task(call_backend(self.backend, "set", key, task.result(), self.ttl))
+        store.add_done_callback(lambda done: self._stored(key, task, done))
+
+    def _stored(self, key: str, task: "asyncio.Task", store: "asyncio.Task") -> None:
+        # A failed write only costs a later miss; retrieve its error so it is not logged as unhandled
+        if not store.cancelled():
+            store.exception()
+        self._done(key, task)
+
+    def _done(self, key: str, task: "asyncio.Task") -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "backend": getattr(self.backend, "name", "off"),
+            "entries": len(self.backend) if self.backend is not None else 0,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "errors": self.errors,
+            "in_flight": len(self._inflight),
+            # Coalesced lookups also avoided a vision call
+            "hit_rate": ((self.hits + self.coalesced) / lookups) if lookups else 0.0,
+            "evictions": getattr(self.backend, "evictions", 0),
+        }
+
+
+def _env_flag(name: str, default: str = "0") -> bool:
+    return os.getenv(name, default).strip().lower() in ("1", "true", "yes", "on")
+
+
+response_cache = ResponseCache(
+    build_backend(
+        os.getenv("RESPONSE_CACHE_BACKEND", "memory"),
+        os.getenv("RESPONSE_CACHE_PATH", ".cache/responses.sqlite3"),
+        int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1000")),
+        table="responses",
+    ),
+    ttl=float(os.getenv("RESPONSE_CACHE_TTL", "86400")) or None,
+    cache_nondeterministic=_env_flag("RESPONSE_CACHE_NONDETERMINISTIC"),
+)
+
+vision_cache = VisionCache(
+    build_backend(
+        os.getenv("VISION_CACHE_BACKEND", "memory"),
+        os.getenv("VISION_CACHE_PATH", ".cache/vision.sqlite3"),
+        int(os.getenv("VISION_CACHE_MAX_ENTRIES", "5000")),
+        table="vision",
+    ),
+    ttl=float(os.getenv("VISION_CACHE_TTL", str(7 * 86400))) or None,
+)
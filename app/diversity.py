@@ -0,0 +1,171 @@
+"""
+Near-duplicate suppression and diversity ranking for generated lines.
+
+Lines are compared by Jaccard similarity of their character-trigram sets (the
+shingles app.scoring uses for its corpus signal), packed into a SHINGLE_BITS
+bitset per line so a comparison is two big-int operations and a popcount.
+A line is a near duplicate when it is at least DEDUPE_THRESHOLD similar to:
+
+- an earlier style's line in the same request (registry order, so the first
+  style keeps its line), or
+- one of the last DEDUPE_HISTORY lines served to the same user (requests that
+  send a user_id). The history lives in an app.cache backend
+  (DEDUPE_HISTORY_BACKEND: memory, per process; sqlite, shared by the workers
+  on a host and the app.serve default), least recently seen users evicted past
+  DEDUPE_MAX_USERS.
+
+The graph regenerates only the duplicate styles (they use their retry attempts
+and are not rated first), telling the generator which lines to avoid, and
+best_line gets a bonus of DIVERSITY_WEIGHT * (1 - similarity to the user's
+history). A request compares a few lines against a short history, which takes
+microseconds (see bench/dedupe.py), so it runs inline in the graph nodes.
+"""
+import os
+import zlib
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from app.cache import MemoryBackend, build_backend, call_backend
+from app.metrics import metrics
+from app.scoring import trigrams
+
+# 0 turns duplicate detection off
+DEDUPE_THRESHOLD = float(os.getenv("DEDUPE_THRESHOLD", "0.5"))
+DEDUPE_HISTORY = int(os.getenv("DEDUPE_HISTORY", "20"))
+DEDUPE_MAX_USERS = int(os.getenv("DEDUPE_MAX_USERS", "10000"))
+DEDUPE_HISTORY_BACKEND = os.getenv("DEDUPE_HISTORY_BACKEND", "memory")
+DEDUPE_HISTORY_PATH = os.getenv("DEDUPE_HISTORY_PATH", ".cache/recent_lines.sqlite3")
+DIVERSITY_WEIGHT = float(os.getenv("DIVERSITY_WEIGHT", "1.0"))
+# Trigrams are hashed into this many bits. A short line has ~50 trigrams, and
+# collisions raise a pair's similarity by ~0.03 on average over exact Jaccard
+SHINGLE_BITS = 1024
+
+duplicate_lines = metrics.counter(
+    "pickup_duplicate_lines_total", "Near-duplicate lines found, by what they repeated (outputs, history, cache)", ("source",)
+)
+
+# A line with its trigram bitset
+Shingled = Tuple[str, int]
+
+
+@lru_cache(maxsize=4096)
+def shingle(line: str) -> Shingled:
+    # The graph checks the same lines several times per request; the cache makes repeats free
+    bits = 0
+    for gram in trigrams(line):
+        # crc32, not hash(): str hashes are salted per process, and the
+        # bitsets must agree across workers and restarts
+        bits |= 1 << (zlib.crc32(gram.encode("utf-8")) % SHINGLE_BITS)
+    return line, bits
+
+
+def similarity(a: int, b: int) -> float:
+    union = (a | b).bit_count()
+    return (a & b).bit_count() / union if union else 0.0
+
+
+def _first_match(bits: int, lines: Sequence[Shingled], threshold: float) -> Optional[str]:
+    for line, other in lines:
+        if similarity(bits, other) >= threshold:
+            return line
+    return None
+
+
+def find_duplicates(
+    outputs: Dict[str, str],
+    history: Sequence[Shingled] = (),
+    threshold: float = DEDUPE_THRESHOLD,
+) -> Dict[str, Tuple[str, str]]:
+    """
+    label -> (source, repeated line) for near-duplicate lines in `outputs`;
+    source is "outputs" (an earlier label's line) or "history".
+    """
+    if threshold <= 0:
+        return {}
+    duplicates: Dict[str, Tuple[str, str]] = {}
+    kept: List[Shingled] = []
+    for label, line in outputs.items():
+        if not line:
+            continue
+        shingled = shingle(line)
+        match = _first_match(shingled[1], kept, threshold)
+        if match is not None:
+            duplicates[label] = ("outputs", match)
+            continue
+        match = _first_match(shingled[1], history, threshold)
+        if match is not None:
+            duplicates[label] = ("history", match)
+        kept.append(shingled)
+    return duplicates
+
+
+def novelty(line: str, history: Sequence[Shingled]) -> float:
+    """1 - the line's highest similarity to the history (1.0 with no history)."""
+    if not history or not line:
+        return 1.0
+    bits = shingle(line)[1]
+    return 1.0 - max([similarity(bits, other) for _, other in history])
+
+
+class RecentLines:
+    """
+    Per-user window of recently served lines in an app.cache backend (LRU over
+    users). Entries are stored as [line, bitset] pairs: the bitsets are stable
+    across processes, so a worker uses another's as they are.
+    """
+
+    def __init__(self, window: int = DEDUPE_HISTORY, max_users: int = DEDUPE_MAX_USERS, backend=None):
+        self.window = window
+        self.max_users = max_users
+        self.backend = backend if backend is not None else MemoryBackend(max_entries=max_users)
+
+    @staticmethod
+    def _decode(value: Optional[List[Any]]) -> Tuple[Shingled, ...]:
+        return tuple((line, bits) for line, bits in value or ())
+
+    def _append(self, lines: Iterable[str]) -> Callable[[List[Any]], List[Any]]:
+        new = [shingle(line) for line in lines if line]
+
+        def append(recent: List[Any]) -> List[Any]:
+            served = {line for line, _ in recent}
+            recent = list(recent)
+            for line, bits in new:
+                if line not in served:
+                    served.add(line)
+                    recent.append([line, bits])
+            return recent[-self.window:]
+
+        return append
+
+    def get(self, user_id: Optional[str]) -> Tuple[Shingled, ...]:
+        if not user_id or self.window <= 0:
+            return ()
+        return self._decode(self.backend.get(user_id))
+
+    def add(self, user_id: Optional[str], lines: Iterable[str]) -> None:
+        if not user_id or self.window <= 0:
+            return
+        self.backend.update(user_id, self._append(lines), None, default=[])
+
+    # Event-loop entry points; the sqlite backend runs in a worker thread
+    async def aget(self, user_id: Optional[str]) -> Tuple[Shingled, ...]:
+        if not user_id or self.window <= 0:
+            return ()
+        return self._decode(await call_backend(self.backend, "get", user_id))
+
+    async def aadd(self, user_id: Optional[str], lines: Iterable[str]) -> None:
+        if not user_id or self.window <= 0:
+            return
+        await call_backend(self.backend, "update", user_id, self._append(lines), None, [])
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": self.backend.name, "users": len(self.backend), "window": self.window, "max_users": self.max_users}
+
+
+def _build_recent_lines() -> RecentLines:
+    backend = build_backend(DEDUPE_HISTORY_BACKEND, DEDUPE_HISTORY_PATH, DEDUPE_MAX_USERS, table="recent_lines")
+    # "off" keeps no history, like DEDUPE_HISTORY=0
+    return RecentLines(window=DEDUPE_HISTORY if backend is not None else 0, backend=backend)
+
+
+recent_lines = _build_recent_lines()
@@ -1,13 +1,45 @@
-from typing import Dict, Optional, TypedDict
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Optional, Sequence, Tuple, TypedDict
 from typing_extensions import Annotated
-from operator import or_
+from operator import add, or_
+import asyncio
 import os
-import base64
-
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import StrOutputParser
-from langchain_openai import ChatOpenAI
-from langgraph.graph import StateGraph, START, END
+import time
+import inspect
+
+from app import transport
+from app.cache import vision_cache
+from app.diversity import DIVERSITY_WEIGHT, Shingled, duplicate_lines, find_duplicates, novelty
+from app.images import ImagePayload
+from app.latency import (
+    DEADLINE_MS,
+    DeadlineExceeded,
+    call_llm,
+    deadline_drops,
+    hedge_enabled,
+    llm_priority,
+    rater_reserve,
+    time_left,
+)
+from app.metrics import current_usage, metrics, node_seconds, record_llm_usage
+from app.parsing import parse_model
+from app.prompts import (
+    avoid_text,
+    baseline_layout,
+    batch_prompt,
+    features_input,
+    generator_prompt,
+    lines_input,
+    rater_prompt,
+)
+from app.scheduler import LLMRateLimited
+from app.schemas import GeneratedLinesResult, ImageDescription, RatingsResult
+from app.scoring import is_close_call, local_scorer, resolve_rater_mode
+from app.styles import style_registry
+
+# LangChain/LangGraph take about two seconds to import, so they are imported
+# when the first graph is built (lifespan warm-up or first request), not with the app
+if TYPE_CHECKING:
+    from langchain_openai import ChatOpenAI
 
 
 class GraphState(TypedDict, total=False):
@@ -19,12 +51,94 @@ class GraphState(TypedDict, total=False):
     best_line: str
     # Track how many times each generator has produced a line
     attempts: Annotated[Dict[str, int], or_]
-    # Optional inputs for vision description
-    image_bytes: bytes
-    mime_type: str
+    # Line text each rating was given for, so the rater only re-scores changed lines
+    rated: Annotated[Dict[str, str], or_]
+    # Number of LLM calls made for this request
+    llm_calls: Annotated[int, add]
+    # One entry per node execution: node, seconds, tokens, estimated cost
+    timings: Annotated[List[Dict[str, Any]], add]
+    # Labels whose generator missed the request deadline or stayed rate limited
+    # ("rate" if the rater did) -> "deadline" / "rate_limited"
+    dropped: Annotated[Dict[str, str], or_]
+    # Labels (or "describe"/"rate") whose LLM call was hedged with a duplicate
+    hedged: Annotated[List[str], add]
+    # Optional input for vision description: a handle to the preprocessed image, not the bytes
+    image: ImagePayload
+
+
+# Style label -> generator instruction for every enabled style (STYLES_PATH, see app.styles)
+STYLES: Dict[str, str] = style_registry.instructions()
+
+# Graph execution modes:
+# - fanout: one generator node per style, then a separate rater call
+# - batched: one JSON call writes every style's line, then a separate rater call
+# - batched_rated: one JSON call writes and rates every line (no rater node)
+GRAPH_MODES = ("fanout", "batched", "batched_rated")
+DEFAULT_GRAPH_MODE = "fanout"
+
+# Lines rated below the threshold are regenerated until they hit the attempt cap.
+# Per-request overrides go through graph_run_config().
+RETRY_THRESHOLD = int(os.getenv("GRAPH_RETRY_THRESHOLD", "8"))
+MAX_ATTEMPTS_PER_LABEL = int(os.getenv("GRAPH_MAX_ATTEMPTS", "2"))  # initial + 1 retry
+# No new retry round starts once a request has run this long (0 = no limit)
+RETRY_BUDGET_S = float(os.getenv("GRAPH_RETRY_BUDGET_S", "0"))
+
+# JSON mode for describe/rate/batched calls; turn off for providers that reject response_format
+JSON_MODE = os.getenv("LLM_JSON_MODE", "1").strip().lower() not in ("0", "false", "no")
+
+rater_decisions = metrics.counter("pickup_rater_decisions_total", "Rate node results by scoring source", ("source",))
+
+
+def resolve_mode(mode: Optional[str] = None) -> str:
+    chosen = (mode or os.getenv("GRAPH_MODE") or DEFAULT_GRAPH_MODE).strip().lower()
+    if chosen not in GRAPH_MODES:
+        raise ValueError(f"unknown graph mode {chosen!r}; expected one of {', '.join(GRAPH_MODES)}")
+    return chosen
+
+
+def graph_run_config(
+    tags: Optional[List[str]] = None,
+    metadata: Optional[Dict[str, Any]] = None,
+    retry_threshold: Optional[int] = None,
+    max_attempts: Optional[int] = None,
+    retry_budget_s: Optional[float] = None,
+    deadline_s: Optional[float] = None,
+    hedge: Optional[bool] = None,
+    rater_mode: Optional[str] = None,
+    priority: str = "interactive",
+    history: Sequence[Shingled] = (),
+    avoid: Optional[Dict[str, List[str]]] = None,
+) -> Dict[str, Any]:
+    """
+    RunnableConfig for one graph run, carrying the per-request retry, deadline,
+    hedging, rater and scheduling policy, the lines recently served to the user
+    (app.diversity) that new lines should not repeat, and per-style lines the
+    generators are told to avoid from the first attempt (session "more" calls).
+    """
+    started_at = time.monotonic()
+    if deadline_s is None:
+        deadline_s = DEADLINE_MS / 1000.0
+    configurable = {
+        "retry_threshold": retry_threshold if retry_threshold is not None else RETRY_THRESHOLD,
+        "max_attempts": max_attempts if max_attempts is not None else MAX_ATTEMPTS_PER_LABEL,
+        "retry_budget_s": retry_budget_s if retry_budget_s is not None else RETRY_BUDGET_S,
+        "started_at": started_at,
+        "deadline_at": started_at + deadline_s if deadline_s else None,
+        "deadline_s": deadline_s or None,
+        "rater_mode": resolve_rater_mode(rater_mode),
+        # LLM scheduler queue: "interactive" calls go ahead of "batch" ones
+        "priority": priority,
+        "history": tuple(history),
+        "avoid": avoid or {},
+    }
+    if hedge is not None:
+        configurable["hedge"] = hedge
+    return {"tags": tags or [], "metadata": metadata or {}, "configurable": configurable}
+
 
+def _build_llm(model: Optional[str], temperature: Optional[float], default_temperature: float = 1) -> "ChatOpenAI":
+    from langchain_openai import ChatOpenAI
 
-def _build_llm(model: Optional[str], temperature: Optional[float]) -> ChatOpenAI:
     # Prefer explicit model arg; otherwise read from env, then fallback to a safe default
     chosen_model = model or os.getenv("OPENAI_TEXT_MODEL") or "gpt-4o-mini"
     api_key = os.getenv("OPENAI_API_KEY")
@@ -33,7 +147,15 @@ def _build_llm(model: Optional[str], temperature: Optional[float]) -> ChatOpenAI
 
     kwargs = {
         "model": chosen_model,
-        "temperature": temperature if temperature is not None else 1,
+        "temperature": temperature if temperature is not None else default_temperature,
+        # Report token usage on streamed responses too
+        "stream_usage": True,
+        # Share the app-wide connection pools instead of one pool per node
+        "http_async_client": transport.get_async_client(),
+        "http_client": transport.get_sync_client(),
+        "timeout": transport.request_timeout(),
+        # app.scheduler retries 429/5xx itself so it can adapt concurrency to them
+        "max_retries": 0,
     }
     if api_key:
         kwargs["api_key"] = api_key
@@ -45,27 +167,54 @@ def _build_llm(model: Optional[str], temperature: Optional[float]) -> ChatOpenAI
     return ChatOpenAI(**kwargs)
 
 
-def _to_data_url(image_bytes: bytes, mime_type: Optional[str] = None) -> str:
-    if not mime_type:
-        mime_type = "image/jpeg"
-    b64 = base64.b64encode(image_bytes).decode("utf-8")
-    return f"data:{mime_type};base64,{b64}"
+def _json_llm(llm: "ChatOpenAI"):
+    return llm.bind(response_format={"type": "json_object"}) if JSON_MODE else llm
+
+
+def _prompt(messages: List[Tuple[str, Any]]):
+    from langchain_core.prompts import ChatPromptTemplate
+
+    return ChatPromptTemplate.from_messages(messages)
+
+
+def prime_response_models() -> None:
+    """
+    Compile the OpenAI SDK's response models, which it otherwise builds lazily
+    inside the first completion call (a few hundred ms on the first request).
+    """
+    from openai.types.chat import ChatCompletion, ChatCompletionChunk, ParsedChatCompletion
+
+    completion = {
+        "id": "warmup", "object": "chat.completion", "created": 0, "model": "warmup",
+        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "{}"}}],
+        "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+    }
+    # construct() is what the SDK runs on every response; the first call compiles each nested model
+    ChatCompletion.construct(**completion)
+    # JSON-mode calls go through the SDK's parse path
+    ParsedChatCompletion[None].construct(**completion)
+    ChatCompletionChunk.construct(**{
+        "id": "warmup", "object": "chat.completion.chunk", "created": 0, "model": "warmup",
+        "choices": [{"index": 0, "delta": {"content": "{}"}}],
+    })
 
 
-def _describe_node(model: Optional[str], temperature: Optional[float]):
+class _UnparsedDescription(ValueError):
+    """The vision model's reply was not the expected JSON."""
+
+    def __init__(self, content: Any):
+        super().__init__("unparsed image description")
+        self.content = content
+
+
+def _describe_node(model: Optional[str], temperature: Optional[float], vision_model: Optional[str] = None):
     """
-    Vision description node. If state has non-empty features, it returns state unchanged.
-    Else, if image_bytes is present, it calls a vision-capable model to extract features
+    Vision description node. If state has non-empty features, it changes nothing.
+    Else, if an image is present, it calls a vision-capable model to extract features
     with keys: description (str), attributes (List[str]).
     """
-    vision_model = os.getenv("OPENAI_VISION_MODEL") or model or "gpt-4o-mini"
-    llm = ChatOpenAI(
-        model=vision_model,
-        temperature=temperature if temperature is not None else 0.5,
-        api_key=os.getenv("OPENAI_API_KEY"),
-        base_url=os.getenv("OPENAI_BASE_URL"),
-        organization=os.getenv("OPENAI_ORG") or os.getenv("OPENAI_ORGANIZATION"),
-    )
+    vision_model = vision_model or os.getenv("OPENAI_VISION_MODEL") or model or "gpt-4o-mini"
+    llm = _json_llm(_build_llm(vision_model, temperature, default_temperature=0.5))
 
     system = (
         "You analyze dating profile photos and extract concise, respectful details suitable for crafting pickup lines. "
@@ -77,172 +226,508 @@ def _describe_node(model: Optional[str], temperature: Optional[float]):
         "attributes are short keywords like 'smiling','beach','guitar','dog','sunset','glasses'. "
     )
 
-    def node(state: GraphState) -> GraphState:
+    # Built once per graph; the photo goes in as the image_url variable
+    chain = _prompt([
+        ("system", system),
+        ("user", [
+            {"type": "text", "text": user_text},
+            {"type": "image_url", "image_url": {"url": "{image_url}"}},
+        ]),
+    ]) | llm
+
+    async def node(state: GraphState, config: Dict[str, Any]) -> GraphState:
         # If features already provided or no image, pass-through.
-        features = state.get("features") or {}
-        if features:
-            return {"features": features}
-
-        image_bytes = state.get("image_bytes")
-        if not image_bytes:
-            # Nothing to do; leave features empty
-            return {"features": {}}
-
-        data_url = _to_data_url(image_bytes, state.get("mime_type"))
-        # Prepare multimodal message
-        messages = [
-            ("system", system),
-            ("user", [
-                {"type": "text", "text": user_text},
-                {"type": "image_url", "image_url": {"url": data_url}},
-            ]),
-        ]
-        prompt = ChatPromptTemplate.from_messages(messages)
-        resp = (prompt | llm).invoke({})
-        content = getattr(resp, "content", resp)
-
-        # Try parse JSON; fallback to safe structure
-        import json
+        image: Optional[ImagePayload] = state.get("image")
+        if state.get("features") or image is None:
+            return {}
+
+        calls, hedged = 0, False
+
+        async def describe(data_url: str) -> Dict:
+            nonlocal calls, hedged
+            # Without features nothing can be generated, so a miss here fails the request.
+            # No timeout here: the call is shared by every request for this photo, and
+            # each of them applies its own deadline while waiting for it below
+            resp, calls, hedged = await call_llm(
+                "describe", vision_model, lambda: chain.ainvoke({"image_url": data_url}),
+                hedge=hedge_enabled(config), priority=llm_priority(config),
+            )
+            record_llm_usage(resp, vision_model)
+            content = getattr(resp, "content", resp)
+
+            parsed = parse_model(content, ImageDescription, "describe")
+            if parsed is None:
+                # Raised rather than returned so the vision cache does not keep it
+                raise _UnparsedDescription(content)
+            return parsed.model_dump()
+
+        # Same photo uploaded again (or concurrently) reuses one vision call
+        key = vision_cache.make_key(vision_model, image.digest)
         try:
-            data = json.loads(content)
-        except Exception:
-            data = {"description": str(content or ""), "attributes": []}
-        data.setdefault("description", "")
-        data.setdefault("attributes", [])
-        return {"features": data}
+            # data_url() runs now, not in the shared call: that may outlive this request,
+            # which releases the image below
+            data = await vision_cache.get_or_compute(
+                key, lambda: describe(image.data_url()), timeout=time_left(config, rater_reserve(config))
+            )
+        except asyncio.TimeoutError:
+            deadline_drops.inc(node="describe")
+            raise DeadlineExceeded(calls=calls, hedged=hedged)
+        except _UnparsedDescription as e:
+            # Keep the prose as the description rather than failing the request
+            data = {"description": str(e.content or ""), "attributes": []}
+        finally:
+            # Nothing after describe needs the image; free it for the rest of the run
+            image.release()
+        update: GraphState = {"features": dict(data), "llm_calls": calls}
+        if hedged:
+            update["hedged"] = ["describe"]
+        return update
 
     return node
 
 
 def _make_gen_node(label: str, style_instruction: str, model: Optional[str], temperature: Optional[float]):
     llm = _build_llm(model, temperature)
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", f"You write a single, short pickup line in the following style: {style_instruction}.\n"
-                    "It should make her feel admired, special, or cherished.\n"
-                    "You can add humor in pickup line.\n"
-                    "Keep it less logical and more creative.\n"
-                    "Avoid clichés unless used playfully. Use warmth, charm, or subtle romance.\n"
-                    "Only output the pickup line text, no quotes, no JSON."),
-        ("user", "Features: {features}")
-    ])
-    chain = prompt | llm | StrOutputParser()
-
-    def node(state: GraphState) -> GraphState:
-        features = state.get("features", {})
-        line = chain.invoke({"features": features})
-        outputs = dict(state.get("outputs", {}))
-        outputs[label] = (line or "").strip()
-        attempts = dict(state.get("attempts", {}))
-        attempts[label] = attempts.get(label, 0) + 1
-        return {"outputs": outputs, "attempts": attempts}
+    # Base models get a system prompt shared by every style, so providers can cache it
+    # as a prefix; fine-tuned ones keep the layout they were trained on
+    baseline = baseline_layout(llm.model_name)
+    chain = _prompt(generator_prompt(baseline)) | llm
+
+    async def node(state: GraphState, config: Dict[str, Any]) -> GraphState:
+        inputs = {
+            "style": style_instruction,
+            "features": features_input(state.get("features", {}), baseline),
+            "avoid": avoid_text(_lines_to_avoid(state, [label], config)),
+        }
+        # Return only this label's entries: parallel retries would otherwise
+        # overwrite each other's attempt counts with stale copies when merged
+        attempts = (state.get("attempts", {}) or {}).get(label, 0) + 1
+        try:
+            resp, calls, hedged = await call_llm(
+                "generate", llm.model_name, lambda: chain.ainvoke(inputs),
+                hedge=hedge_enabled(config), priority=llm_priority(config),
+                timeout=time_left(config, rater_reserve(config)),
+            )
+        except DeadlineExceeded as e:
+            # Keep an earlier attempt's line if there is one; otherwise drop the label
+            update: GraphState = {"attempts": {label: attempts}, "llm_calls": e.calls}
+            if not (state.get("outputs", {}) or {}).get(label):
+                deadline_drops.inc(node=label)
+                update["dropped"] = {label: "deadline"}
+            if e.hedged:
+                update["hedged"] = [label]
+            return update
+        except LLMRateLimited:
+            # The scheduler already retried; degrade like a deadline miss rather than failing the request
+            update = {"attempts": {label: attempts}, "llm_calls": 1}
+            if not (state.get("outputs", {}) or {}).get(label):
+                update["dropped"] = {label: "rate_limited"}
+            return update
+        record_llm_usage(resp, llm.model_name)
+        line = getattr(resp, "content", resp)
+        update = {"outputs": {label: (line or "").strip()}, "attempts": {label: attempts}, "llm_calls": calls}
+        if hedged:
+            update["hedged"] = [label]
+        return update
 
     return node
 
 
-def _rater_node(model: Optional[str], temperature: Optional[float]):
-    llm = _build_llm(model, temperature)
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", "You are a woman reading dating app openers.\n"
-                    "Rate each line from 1-10 on attractiveness, charm, and respect.\n"
-                    "Return strict JSON with keys: \n"
-                    "- ratings: object mapping label->integer 1-10\n"
-                    "- best_label: string (the best line's label)\n"
-                    "- best_line: string"),
-        ("user", "Lines to rate (JSON): {outputs}")
-    ])
-    chain = prompt | llm
-
-    def node(state: GraphState) -> GraphState:
-        outputs = state.get("outputs", {})
-        resp = chain.invoke({"outputs": outputs})
-        # Try to parse model JSON response; fallback to simple heuristic
-        import json
-        ratings, best_label, best_line = {}, "", ""
+async def _complete_ratings(ratings: Dict[str, int], outputs: Dict[str, str], features: Optional[Dict] = None) -> Dict[str, int]:
+    """Model ratings for `outputs`, with lines the model skipped (e.g. a truncated reply) scored locally."""
+    ratings = {label: score for label, score in ratings.items() if label in outputs}
+    missing = {label: line for label, line in outputs.items() if label not in ratings}
+    if missing:
+        rater_decisions.inc(source="local_fill")
+        ratings.update(await local_scorer.ascore_lines(missing, features))
+    return ratings
+
+
+async def _parse_ratings(content, outputs: Dict[str, str], features: Optional[Dict] = None) -> Tuple[Dict[str, int], str]:
+    """
+    Parse a rater reply into (ratings, preferred label). Unusable replies are
+    scored by the local scorer instead, so they do not trigger needless retries.
+    """
+    parsed = parse_model(content, RatingsResult, "rate") if content else None
+    if parsed is None:
+        rater_decisions.inc(source="fallback")
+        return await local_scorer.ascore_lines(outputs, features), ""
+    rater_decisions.inc(source="llm")
+    # Only model-given scores teach the local scorer
+    await local_scorer.alearn(outputs, parsed.ratings)
+    return await _complete_ratings(parsed.ratings, outputs, features), parsed.best_label
+
+
+def _history(config: Optional[Dict[str, Any]]) -> Sequence[Shingled]:
+    return ((config or {}).get("configurable", {}) or {}).get("history", ())
+
+
+def _retries_open(config: Optional[Dict[str, Any]]) -> bool:
+    """False once the request's retry latency budget or deadline is spent."""
+    settings = (config or {}).get("configurable", {}) or {}
+    budget = settings.get("retry_budget_s", RETRY_BUDGET_S)
+    started_at = settings.get("started_at")
+    if budget and started_at is not None and time.monotonic() - started_at >= budget:
+        return False
+    left = time_left(config, rater_reserve(config))
+    return left is None or left > 0
+
+
+def _duplicates_to_regenerate(state: GraphState, config: Optional[Dict[str, Any]] = None) -> Dict[str, Tuple[str, str]]:
+    """Near-duplicate lines (app.diversity) whose style still has attempts left and time to retry."""
+    if not _retries_open(config):
+        return {}
+    max_attempts = ((config or {}).get("configurable", {}) or {}).get("max_attempts", MAX_ATTEMPTS_PER_LABEL)
+    attempts = state.get("attempts", {}) or {}
+    duplicates = find_duplicates(state.get("outputs", {}) or {}, _history(config))
+    return {label: dup for label, dup in duplicates.items() if attempts.get(label, 0) < max_attempts}
+
+
+def _retry_candidates(
+    state: GraphState,
+    labels: Iterable[str],
+    config: Optional[Dict[str, Any]] = None,
+) -> List[Tuple[int, str]]:
+    """
+    (score, label) pairs for labels rated below the threshold, or whose line
+    is a near duplicate, that still have attempts left. Empty once the
+    request's retry latency budget is spent.
+    """
+    if not _retries_open(config):
+        return []
+    settings = (config or {}).get("configurable", {}) or {}
+    threshold = settings.get("retry_threshold", RETRY_THRESHOLD)
+    max_attempts = settings.get("max_attempts", MAX_ATTEMPTS_PER_LABEL)
+
+    ratings = state.get("ratings", {}) or {}
+    attempts = state.get("attempts", {}) or {}
+    duplicates = _duplicates_to_regenerate(state, config)
+    candidates = []
+    for label in labels:
+        score = 0
         try:
-            data = json.loads(getattr(resp, "content", resp))
-            ratings = {k: int(v) for k, v in data.get("ratings", {}).items()}
-            best_label = data.get("best_label") or ""
-            best_line = data.get("best_line") or (outputs.get(best_label) if best_label in outputs else "")
+            score = int(ratings.get(label, 0))
         except Exception:
-            # Fallback: choose longest non-empty line
-            non_empty = [(k, v) for k, v in outputs.items() if v]
-            if non_empty:
-                best_label, best_line = max(non_empty, key=lambda kv: len(kv[1]))
-            ratings = {k: 7 for k in outputs.keys()}  # neutral default
+            score = 0
+        if (score < threshold or label in duplicates) and attempts.get(label, 0) < max_attempts:
+            candidates.append((score, label))
+    return candidates
+
 
-        return {
+def _lines_to_avoid(state: GraphState, labels: Iterable[str], config: Optional[Dict[str, Any]] = None) -> List[str]:
+    """
+    Lines the generator should not write again: the labels' lines from the run
+    config (earlier session calls) and, on a retry, their previous lines and
+    the lines they duplicated.
+    """
+    outputs = state.get("outputs", {}) or {}
+    earlier = ((config or {}).get("configurable", {}) or {}).get("avoid") or {}
+    duplicates = find_duplicates(outputs, _history(config)) if outputs else {}
+    avoid: List[str] = []
+    for label in labels:
+        for line in (*earlier.get(label, ()), outputs.get(label), duplicates.get(label, ("", ""))[1]):
+            if line and line not in avoid:
+                avoid.append(line)
+    return avoid
+
+
+def _count_duplicates(outputs: Dict[str, str], fresh: Iterable[str], config: Optional[Dict[str, Any]]) -> None:
+    """Count near duplicates among the lines just generated (`fresh` labels)."""
+    duplicates = find_duplicates(outputs, _history(config))
+    for label in fresh:
+        if label in duplicates:
+            duplicate_lines.inc(source=duplicates[label][0])
+
+
+def _batch_gen_node(model: Optional[str], temperature: Optional[float], rate_inline: bool, styles: Dict[str, str]):
+    """
+    Single-call generator: one JSON-mode request writes a line for every style that
+    needs one (all styles on the first pass, only weak ones on retries), and with
+    rate_inline also scores them so the separate rater call can be skipped. The
+    request's rater mode applies to those scores as it does in the rater node.
+    """
+    base_llm = _build_llm(model, temperature)
+    llm = _json_llm(base_llm)
+    # For base models the requested styles go in the user message so the system prompt stays a static prefix
+    baseline = baseline_layout(base_llm.model_name)
+    chain = _prompt(batch_prompt(baseline, rate_inline)) | llm
+
+    async def node(state: GraphState, config: Dict[str, Any]) -> GraphState:
+        if state.get("outputs"):
+            labels = [label for _, label in _retry_candidates(state, styles, config)]
+        else:
+            labels = list(styles)
+        if not labels:
+            return {"llm_calls": 0}
+
+        requested = "\n".join(f"- {label}: {styles[label]}" for label in labels)
+        inputs = {
+            "styles": requested,
+            "features": features_input(state.get("features", {}), baseline),
+            "avoid": avoid_text(_lines_to_avoid(state, labels, config)),
+        }
+        prior_attempts = state.get("attempts", {}) or {}
+        attempts = {label: prior_attempts.get(label, 0) + 1 for label in labels}
+        try:
+            resp, calls, hedged = await call_llm(
+                "generate_batch", base_llm.model_name,
+                lambda: chain.ainvoke(inputs),
+                hedge=hedge_enabled(config), priority=llm_priority(config),
+                timeout=time_left(config, 0.0 if rate_inline else rater_reserve(config)),
+            )
+        except DeadlineExceeded as e:
+            prior_outputs = state.get("outputs", {}) or {}
+            missing = {label: "deadline" for label in labels if not prior_outputs.get(label)}
+            for label in missing:
+                deadline_drops.inc(node=label)
+            update: GraphState = {"attempts": attempts, "llm_calls": e.calls}
+            if missing:
+                update["dropped"] = missing
+            if e.hedged:
+                update["hedged"] = ["generate"]
+            return update
+        except LLMRateLimited:
+            prior_outputs = state.get("outputs", {}) or {}
+            update = {"attempts": attempts, "llm_calls": 1}
+            missing = {label: "rate_limited" for label in labels if not prior_outputs.get(label)}
+            if missing:
+                update["dropped"] = missing
+            return update
+        record_llm_usage(resp, base_llm.model_name)
+        parsed = parse_model(getattr(resp, "content", resp), GeneratedLinesResult, "generate")
+        lines = parsed.lines if parsed is not None else {}
+        outputs = {label: str(lines.get(label) or "").strip() for label in labels}
+        update: GraphState = {"outputs": outputs, "attempts": attempts, "llm_calls": calls}
+        if hedged:
+            update["hedged"] = ["generate"]
+
+        if rate_inline:
+            ratings = await _complete_ratings(parsed.ratings if parsed is not None else {}, outputs, state.get("features"))
+            merged_outputs = {**(state.get("outputs", {}) or {}), **outputs}
+            merged_ratings = {**(state.get("ratings", {}) or {}), **ratings}
+            # The rater mode applies to the inline scores as in the rater node: local replaces
+            # them, local_then_llm keeps them only for close calls (they cost no extra call)
+            mode = ((config or {}).get("configurable", {}) or {}).get("rater_mode", "llm")
+            if mode != "llm":
+                scores = await local_scorer.ascore_values(outputs, state.get("features"))
+                merged_scores = {**(state.get("ratings", {}) or {}), **scores}
+                if mode == "local" or not is_close_call({line: merged_scores.get(k, 0) for k, line in merged_outputs.items() if line}):
+                    rater_decisions.inc(source="local")
+                    ratings = {k: int(round(v)) for k, v in scores.items()}
+                    merged_ratings = merged_scores
+            _count_duplicates(merged_outputs, outputs, config)
+            best_label, best_line = _pick_best(merged_outputs, merged_ratings, history=_history(config))
+            update.update({
+                "ratings": ratings,
+                "rated": outputs,
+                "best_label": best_label,
+                "best_line": best_line,
+            })
+        return update
+
+    return node
+
+
+def _pick_best(
+    outputs: Dict[str, str],
+    ratings: Dict[str, int],
+    preferred: str = "",
+    history: Sequence[Shingled] = (),
+) -> Tuple[str, str]:
+    """
+    Highest-rated non-empty line plus a diversity bonus for being unlike the
+    user's recent lines; ties go to `preferred` (e.g. the rater's pick), then the longer line.
+    """
+    history = history if DIVERSITY_WEIGHT else ()
+    scored = [
+        (ratings.get(label, 0) + DIVERSITY_WEIGHT * novelty(line, history), label == preferred, len(line), label)
+        for label, line in outputs.items() if line
+    ]
+    if not scored:
+        return "", ""
+    label = max(scored)[-1]
+    return label, outputs[label]
+
+
+def _rater_node(model: Optional[str], temperature: Optional[float]):
+    base_llm = _build_llm(model, temperature)
+    llm = _json_llm(base_llm)
+    baseline = baseline_layout(base_llm.model_name)
+    chain = _prompt(rater_prompt()) | llm
+
+    async def node(state: GraphState, config: Dict[str, Any]) -> GraphState:
+        outputs = state.get("outputs", {}) or {}
+        rated = state.get("rated", {}) or {}
+        # Only lines that are new or changed since the last rating need a score
+        pending = {k: v for k, v in outputs.items() if k not in rated or rated[k] != v}
+        _count_duplicates(outputs, pending, config)
+        # Near duplicates about to be regenerated are scored after their retry
+        regenerate = _duplicates_to_regenerate(state, config)
+        pending = {k: v for k, v in pending.items() if k not in regenerate}
+        if not pending:
+            return {"llm_calls": 0}
+        history = _history(config)
+
+        update: GraphState = {}
+        prior_ratings = state.get("ratings", {}) or {}
+        mode = ((config or {}).get("configurable", {}) or {}).get("rater_mode", "llm")
+        if mode != "llm":
+            scores = await local_scorer.ascore_values(pending, state.get("features"))
+            # Compare against every line's current score, not just the changed ones
+            merged_scores = {**prior_ratings, **scores}
+            # Keyed by line text: two styles that wrote the same line are not a close call
+            if mode == "local" or not is_close_call({line: merged_scores.get(k, 0) for k, line in outputs.items() if line}):
+                rater_decisions.inc(source="local")
+                best_label, best_line = _pick_best(outputs, merged_scores, history=history)
+                return {
+                    "ratings": {k: int(round(v)) for k, v in scores.items()},
+                    "rated": pending,
+                    "best_label": best_label,
+                    "best_line": best_line,
+                    "llm_calls": 0,
+                }
+
+        try:
+            resp, calls, hedged = await call_llm(
+                "rate", base_llm.model_name, lambda: chain.ainvoke({"outputs": lines_input(pending, baseline)}),
+                hedge=hedge_enabled(config), priority=llm_priority(config),
+                timeout=time_left(config),
+            )
+            record_llm_usage(resp, base_llm.model_name)
+            content = getattr(resp, "content", resp)
+        except DeadlineExceeded as e:
+            # Out of time: score with the local fallback instead of failing the request
+            deadline_drops.inc(node="rate")
+            calls, hedged, content = e.calls, e.hedged, ""
+            update["dropped"] = {"rate": "deadline"}
+        except LLMRateLimited:
+            calls, hedged, content = 1, False, ""
+            update["dropped"] = {"rate": "rate_limited"}
+        ratings, best_label = await _parse_ratings(content, pending, state.get("features"))
+        merged_ratings = {**prior_ratings, **ratings}
+        best_label, best_line = _pick_best(outputs, merged_ratings, preferred=best_label, history=history)
+        update.update({
             "ratings": ratings,
+            "rated": pending,
             "best_label": best_label,
             "best_line": best_line,
-        }
+            "llm_calls": calls,
+        })
+        if hedged:
+            update["hedged"] = ["rate"]
+        return update
 
     return node
 
 
-def build_pickup_graph(model: Optional[str] = None, temperature: Optional[float] = None):
+def _instrument(name: str, fn):
+    """
+    Wrap a node to time it and collect the token usage/cost of its LLM calls.
+    Adds a `timings` entry to the node's update and feeds the node histogram.
+    """
+    accepts_config = "config" in inspect.signature(fn).parameters
+
+    async def node(state: GraphState, config: Dict[str, Any]) -> GraphState:
+        usage = {"input_tokens": 0, "output_tokens": 0, "cost_usd": 0.0}
+        token = current_usage.set(usage)
+        started = time.perf_counter()
+        try:
+            update = await (fn(state, config) if accepts_config else fn(state))
+        finally:
+            current_usage.reset(token)
+        elapsed = time.perf_counter() - started
+        node_seconds.observe(elapsed, node=name)
+        # Nodes return fresh delta dicts, so the timing entry is added in place
+        update = update if update is not None else {}
+        update["timings"] = [{"node": name, "seconds": round(elapsed, 6), **usage}]
+        return update
+
+    return node
+
+
+def build_pickup_graph(
+    model: Optional[str] = None,
+    temperature: Optional[float] = None,
+    vision_model: Optional[str] = None,
+    mode: Optional[str] = None,
+    styles: Optional[Iterable[str]] = None,
+):
+    """
+    Build and compile a new graph for `styles` (every enabled style when None).
+    Prefer app.registry.get_pickup_graph in request handlers, which reuses
+    compiled graphs across requests.
+
+    All nodes are async, so run the compiled graph with ``ainvoke``/``astream``.
+    """
+    mode = resolve_mode(mode)
+    labels = style_registry.resolve(styles)
+    if mode != "fanout":
+        return _build_batched_graph(
+            model, temperature, vision_model, rate_inline=(mode == "batched_rated"),
+            styles=style_registry.instructions(labels),
+        )
+
+    from langgraph.graph import StateGraph, START, END
+
     g = StateGraph(GraphState)
     # Nodes
-    g.add_node("describe", _describe_node(model, temperature))
-    g.add_node("playful", _make_gen_node("playful", "playful, cheeky, light banter", model, temperature))
-    g.add_node("witty", _make_gen_node("witty", "clever, wordplay, subtle humor", model, temperature))
-    g.add_node("spicy", _make_gen_node("spicy", "bold, flirty, a tiny bit spicy but respectful", model, temperature))
-    g.add_node("sweet", _make_gen_node("sweet", "wholesome, kind, cute", model, temperature))
-    g.add_node("roast", _make_gen_node("roast", "playful roast, cheeky tease, light sarcasm without insults; keep respectful and fun", model, temperature))
-    g.add_node("rizz", _make_gen_node("rizz", "confident, charismatic charm with smooth delivery; respectful and magnetic, no arrogance", model, temperature))
-    g.add_node("rate", _rater_node(model, temperature))
-
-    # Start with describe, then fan out to the four generators
+    g.add_node("describe", _instrument("describe", _describe_node(model, temperature, vision_model)))
+    for label in labels:
+        style = style_registry.get(label)
+        # A style's own model/temperature wins over the graph's
+        style_temperature = style.temperature if style.temperature is not None else temperature
+        node = _make_gen_node(label, style.instruction, style.model or model, style_temperature)
+        g.add_node(label, _instrument(label, node))
+    g.add_node("rate", _instrument("rate", _rater_node(model, temperature)))
+
+    # Start with describe, fan out to every generator and join at the rater
     g.add_edge(START, "describe")
-    g.add_edge("describe", "playful")
-    g.add_edge("describe", "spicy")
-    g.add_edge("describe", "sweet")
-    g.add_edge("describe", "roast")
-    g.add_edge("describe", "rizz")
-
-    # Join at rater
-    g.add_edge("playful", "rate")
-    g.add_edge("witty", "rate")
-    g.add_edge("spicy", "rate")
-    g.add_edge("sweet", "rate")
-    g.add_edge("roast", "rate")
-    g.add_edge("rizz", "rate")
-
-    # Conditional loop: if a targeted label is below threshold and hasn't exceeded attempts, retry it
-    THRESHOLD = 8
-    MAX_ATTEMPTS_PER_LABEL = 2  # initial + 1 retry
-
-    def retry_condition(state: GraphState) -> str:
-        ratings = state.get("ratings", {}) or {}
-        attempts = state.get("attempts", {}) or {}
-        candidates = []
-        for label in ("playful", "witty", "spicy", "roast", "rizz"):
-            score = 0
-            try:
-                score = int(ratings.get(label, 0))
-            except Exception:
-                score = 0
-            if score < THRESHOLD and attempts.get(label, 0) < MAX_ATTEMPTS_PER_LABEL:
-                candidates.append((score, label))
+    for label in labels:
+        g.add_edge("describe", label)
+        g.add_edge(label, "rate")
+
+    # Conditional loop: every label below threshold with attempts left is regenerated
+    # in parallel in the next superstep, then only the changed lines are re-rated
+    def retry_condition(state: GraphState, config: Dict[str, Any]):
+        candidates = _retry_candidates(state, labels, config)
         if not candidates:
             return "done"
-        # Pick the lowest scoring candidate to retry next
-        candidates.sort(key=lambda x: x[0])
-        _, label = candidates[0]
-        return f"retry_{label}"
+        return [f"retry_{label}" for _, label in candidates]
 
     g.add_conditional_edges(
         "rate",
         retry_condition,
-        {
-            "retry_playful": "playful",
-            "retry_witty": "witty",
-            "retry_spicy": "spicy",
-            "retry_roast": "roast",
-            "retry_rizz": "rizz",
-            "done": END,
-        },
+        {**{f"retry_{label}": label for label in labels}, "done": END},
     )
 
-    # Note: final transition to END handled by conditional above when "done"
+    return g.compile()
+
+
+
+def _build_batched_graph(
+    model: Optional[str],
+    temperature: Optional[float],
+    vision_model: Optional[str],
+    rate_inline: bool,
+    styles: Dict[str, str],
+):
+    from langgraph.graph import StateGraph, START, END
+
+    g = StateGraph(GraphState)
+    g.add_node("describe", _instrument("describe", _describe_node(model, temperature, vision_model)))
+    g.add_node("generate", _instrument("generate", _batch_gen_node(model, temperature, rate_inline, styles)))
+    g.add_edge(START, "describe")
+    g.add_edge("describe", "generate")
+
+    # Weak lines are regenerated together in one more batched call
+    def retry_condition(state: GraphState, config: Dict[str, Any]) -> str:
+        return "retry" if _retry_candidates(state, styles, config) else "done"
+
+    if rate_inline:
+        g.add_conditional_edges("generate", retry_condition, {"retry": "generate", "done": END})
+    else:
+        g.add_node("rate", _instrument("rate", _rater_node(model, temperature)))
+        g.add_edge("generate", "rate")
+        g.add_conditional_edges("rate", retry_condition, {"retry": "generate", "done": END})
 
     return g.compile()
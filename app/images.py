@@ -0,0 +1,219 @@
+import asyncio
+import base64
+import hashlib
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import BinaryIO, Optional, Tuple, Union
+
+from fastapi import HTTPException, UploadFile
+from fastapi.responses import JSONResponse
+
+from app.cache import bytes_digest
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional; without it uploads are forwarded as-is
+    Image = None
+    ImageOps = None
+
+
+# Set IMAGE_PREPROCESS=0 to forward uploads to the vision model untouched
+PREPROCESS = os.getenv("IMAGE_PREPROCESS", "1").strip().lower() not in ("0", "false", "no")
+# Upload size cap (bytes). UploadSizeLimit stops larger multipart bodies while
+# they stream in; scan_upload checks the file itself
+MAX_UPLOAD_BYTES = int(os.getenv("IMAGE_MAX_UPLOAD_BYTES", str(15 * 1024 * 1024)))
+# Longest side sent to the vision model; larger images only cost tokens
+MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "1024"))
+OUTPUT_FORMAT = os.getenv("IMAGE_OUTPUT_FORMAT", "jpeg").strip().lower()
+OUTPUT_QUALITY = int(os.getenv("IMAGE_OUTPUT_QUALITY", "85"))
+# Refuse to decode anything above this many pixels (decompression bombs)
+MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", str(64 * 1024 * 1024)))
+
+# Room for the other form fields and multipart boundaries on top of the file
+FORM_OVERHEAD_BYTES = 64 * 1024
+
+_CHUNK_SIZE = 1024 * 1024
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+class ImageTooLarge(ValueError):
+    pass
+
+
+class ImagePayload:
+    """
+    A preprocessed image as it travels through the graph. Graph state holds
+    this handle instead of the bytes, so supersteps, stream updates and traces
+    pass a reference (its repr is one line). The base64 data URL is encoded
+    once and shared by every vision call for the request, hedges included.
+    The describe node calls release() once the image is described, so the
+    buffers are not held for the rest of the run.
+    """
+
+    __slots__ = ("mime_type", "size", "digest", "_data", "_data_url")
+
+    def __init__(self, data: bytes, mime_type: Optional[str] = None):
+        self._data: Optional[bytes] = data
+        self._data_url: Optional[str] = None
+        self.mime_type = mime_type or "image/jpeg"
+        self.size = len(data)
+        self.digest = bytes_digest(data)
+
+    @property
+    def data(self) -> memoryview:
+        if self._data is None:
+            raise ValueError("image payload was already released")
+        return memoryview(self._data)
+
+    def data_url(self) -> str:
+        if self._data_url is None:
+            encoded = base64.b64encode(self.data).decode("ascii")
+            self._data_url = f"data:{self.mime_type};base64,{encoded}"
+        return self._data_url
+
+    def release(self) -> None:
+        self._data = None
+        self._data_url = None
+
+    def __repr__(self) -> str:
+        return f"ImagePayload({self.mime_type}, {self.size} bytes, sha256={self.digest[:12]})"
+
+
+@dataclass(frozen=True)
+class UploadedImage:
+    """
+    An upload left where the multipart parser put it (a spooled temp file:
+    memory up to 1 MB, then disk) instead of read into one bytes object, with
+    the sha256 and size computed while streaming through it. A request queued
+    for the image workers then holds about 1 MB rather than the whole upload.
+    """
+
+    file: BinaryIO
+    size: int
+    digest: str
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "UploadedImage":
+        return cls(io.BytesIO(data), len(data), bytes_digest(data))
+
+
+def _too_large(max_bytes: int) -> str:
+    return f"Image exceeds the {max_bytes // (1024 * 1024)} MB upload limit."
+
+
+class UploadSizeLimit:
+    """
+    ASGI middleware that stops multipart bodies larger than MAX_UPLOAD_BYTES plus
+    FORM_OVERHEAD_BYTES before the form parser has spooled them: at once from
+    Content-Length, else as soon as the streamed byte count passes the limit.
+    """
+
+    def __init__(self, app, max_bytes: int = MAX_UPLOAD_BYTES):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.max_body = max_bytes + FORM_OVERHEAD_BYTES
+
+    async def __call__(self, scope, receive, send):
+        headers = dict(scope.get("headers") or ()) if scope["type"] == "http" else {}
+        if not headers.get(b"content-type", b"").startswith(b"multipart/"):
+            return await self.app(scope, receive, send)
+        length = headers.get(b"content-length", b"")
+        if length.isdigit() and int(length) > self.max_body:
+            response = JSONResponse({"detail": _too_large(self.max_bytes)}, status_code=413)
+            return await response(scope, receive, send)
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_body:
+                    # Raised inside the form parser; FastAPI turns it into the response
+                    raise HTTPException(status_code=413, detail=_too_large(self.max_bytes))
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+async def scan_upload(file: UploadFile, max_bytes: int = MAX_UPLOAD_BYTES) -> UploadedImage:
+    """Hash and size an upload in chunks, failing fast once it exceeds max_bytes, then rewind it."""
+    digest = hashlib.sha256()
+    size = 0
+    while True:
+        chunk = await file.read(_CHUNK_SIZE)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > max_bytes:
+            raise ImageTooLarge(_too_large(max_bytes))
+        digest.update(chunk)
+    await file.seek(0)
+    return UploadedImage(file.file, size, digest.hexdigest())
+
+
+def preprocess_image(data: Union[bytes, BinaryIO], mime_type: Optional[str] = None) -> Tuple[bytes, str]:
+    """
+    Decode, fix orientation, downsample to MAX_SIDE, drop EXIF/metadata and
+    re-encode compactly. `data` is bytes or a binary file, which Pillow reads
+    directly. Returns (bytes, mime_type). Raises ValueError if the input is
+    not a decodable image. Without Pillow the input is returned as-is.
+    """
+    if Image is None or not PREPROCESS:
+        return (data.read() if hasattr(data, "read") else data), mime_type or "image/jpeg"
+
+    try:
+        img = Image.open(data if hasattr(data, "read") else io.BytesIO(data))
+        width, height = img.size
+        if width * height > MAX_PIXELS:
+            raise ImageTooLarge(f"Image has too many pixels ({width}x{height}).")
+        # JPEG can decode at 1/2, 1/4, 1/8 scale directly, which is far cheaper than a full decode + resize
+        img.draft("RGB", (MAX_SIDE, MAX_SIDE))
+        img = ImageOps.exif_transpose(img)
+        img.load()
+    except ImageTooLarge:
+        raise
+    except Exception:
+        raise ValueError("Could not decode image; upload a JPEG, PNG or WebP file.")
+
+    if img.mode not in ("RGB", "L"):
+        if "A" in img.getbands() or img.mode == "P":
+            rgba = img.convert("RGBA")
+            background = Image.new("RGB", rgba.size, (255, 255, 255))
+            background.paste(rgba, mask=rgba.getchannel("A"))
+            img = background
+        else:
+            img = img.convert("RGB")
+    img.thumbnail((MAX_SIDE, MAX_SIDE), Image.LANCZOS)
+
+    out = io.BytesIO()
+    if OUTPUT_FORMAT == "webp":
+        img.save(out, format="WEBP", quality=OUTPUT_QUALITY, method=4)
+        return out.getvalue(), "image/webp"
+    # No exif/icc arguments, so metadata is stripped
+    img.save(out, format="JPEG", quality=OUTPUT_QUALITY, optimize=True, progressive=True)
+    return out.getvalue(), "image/jpeg"
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        workers = int(os.getenv("IMAGE_WORKERS", str(min(4, os.cpu_count() or 1))))
+        _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image-prep")
+    return _executor
+
+
+async def preprocess_image_async(data: Union[bytes, BinaryIO], mime_type: Optional[str] = None) -> Tuple[bytes, str]:
+    """Run preprocess_image in the image worker pool, off the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), preprocess_image, data, mime_type)
+
+
+def shutdown_executor() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
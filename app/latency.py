@@ -0,0 +1,202 @@
+"""
+Tail-latency controls for graph LLM calls.
+
+- Request deadline: graph_run_config(deadline_s=...) stores an absolute
+  monotonic deadline in the run config. Generator calls get the time left minus
+  a reserve so the rater can still score whatever arrived: RATER_RESERVE_S, at
+  most RATER_RESERVE_FRACTION of the deadline, and none for the local rater. A
+  call that misses its budget raises DeadlineExceeded and the node drops its label.
+- Hedging: when enabled, a duplicate call is fired if the first has not returned
+  after the observed p95 latency for that node kind/model, and whichever returns
+  first wins. No hedge is sent until HEDGE_MIN_SAMPLES latencies are known.
+  The losing attempt's tokens are counted too (the winner's usage stands in
+  for one cancelled after it was sent), so token and cost metrics include
+  hedging; a hedge cancelled while still queued was never sent and costs nothing.
+- Every attempt (hedges included) goes through app.scheduler (concurrency slot,
+  OpenAI budgets, 429 retries); that wait counts against the deadline but not
+  the latency window.
+"""
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Set, Tuple
+
+from app.metrics import metrics, record_llm_usage
+from app.scheduler import llm_scheduler
+
+DEADLINE_MS = int(os.getenv("GRAPH_DEADLINE_MS", "0"))  # 0 = no deadline
+RATER_RESERVE_S = float(os.getenv("GRAPH_RATER_RESERVE_S", "1.0"))
+RATER_RESERVE_FRACTION = float(os.getenv("GRAPH_RATER_RESERVE_FRACTION", "0.3"))
+HEDGE = os.getenv("GRAPH_HEDGE", "0").strip().lower() in ("1", "true", "yes")
+HEDGE_PERCENTILE = float(os.getenv("GRAPH_HEDGE_PERCENTILE", "95"))
+HEDGE_MIN_SAMPLES = int(os.getenv("GRAPH_HEDGE_MIN_SAMPLES", "20"))
+HEDGE_MIN_DELAY_S = float(os.getenv("GRAPH_HEDGE_MIN_DELAY_S", "0.05"))
+HEDGE_WINDOW = int(os.getenv("GRAPH_HEDGE_WINDOW", "200"))
+
+hedges = metrics.counter("pickup_llm_hedges_total", "Hedged LLM calls fired and won by the duplicate", ("kind", "outcome"))
+deadline_drops = metrics.counter("pickup_graph_deadline_drops_total", "Graph nodes that missed the request deadline", ("node",))
+
+
+class DeadlineExceeded(TimeoutError):
+    """An LLM call did not finish inside the request deadline."""
+
+    def __init__(self, calls: int = 1, hedged: bool = False):
+        super().__init__("deadline exceeded")
+        self.calls = calls
+        self.hedged = hedged
+
+
+class LatencyTracker:
+    """Sliding window of successful call latencies per key (node kind + model)."""
+
+    def __init__(self, window: int = HEDGE_WINDOW, min_samples: int = HEDGE_MIN_SAMPLES):
+        self.window = window
+        self.min_samples = min_samples
+        self._samples: Dict[str, Deque[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, key: str, seconds: float) -> None:
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples is None:
+                samples = self._samples[key] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def quantile(self, key: str, pct: float) -> Optional[float]:
+        """pct-th percentile latency, or None until min_samples calls have been seen."""
+        with self._lock:
+            samples = sorted(self._samples.get(key) or ())
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(round(pct / 100.0 * (len(samples) - 1))))]
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            keys = list(self._samples)
+        return {
+            key: {
+                "samples": len(self._samples.get(key) or ()),
+                "p50_s": self.quantile(key, 50),
+                f"p{HEDGE_PERCENTILE:g}_s": self.quantile(key, HEDGE_PERCENTILE),
+            }
+            for key in keys
+        }
+
+
+latency_tracker = LatencyTracker()
+
+
+def time_left(config: Optional[Dict[str, Any]], reserve: float = 0.0) -> Optional[float]:
+    """Seconds left before the request deadline minus `reserve`, or None without a deadline."""
+    deadline_at = ((config or {}).get("configurable", {}) or {}).get("deadline_at")
+    if deadline_at is None:
+        return None
+    return deadline_at - reserve - time.monotonic()
+
+
+def rater_reserve(config: Optional[Dict[str, Any]]) -> float:
+    """Seconds of the deadline kept back for the rater; short deadlines keep back proportionally less."""
+    settings = (config or {}).get("configurable", {}) or {}
+    if settings.get("rater_mode") == "local":
+        return 0.0
+    deadline_s = settings.get("deadline_s")
+    if not deadline_s:
+        return RATER_RESERVE_S
+    return min(RATER_RESERVE_S, RATER_RESERVE_FRACTION * deadline_s)
+
+
+def hedge_enabled(config: Optional[Dict[str, Any]]) -> bool:
+    return bool(((config or {}).get("configurable", {}) or {}).get("hedge", HEDGE))
+
+
+def llm_priority(config: Optional[Dict[str, Any]]) -> str:
+    return ((config or {}).get("configurable", {}) or {}).get("priority", "interactive")
+
+
+def hedge_delay(key: str) -> Optional[float]:
+    p = latency_tracker.quantile(key, HEDGE_PERCENTILE)
+    return None if p is None else max(p, HEDGE_MIN_DELAY_S)
+
+
+def _record_losing_usage(tasks, winner: "asyncio.Future", model: str, sent: Set[int]) -> None:
+    """
+    Token usage of the attempts that lost a hedge race (the caller records the
+    winner's). One that also finished reports its own usage. One about to be
+    cancelled after it was sent (its index is in `sent`) is billed, but its usage
+    is never seen, so the winner's is counted for it: it sent the same prompt.
+    One still waiting in the scheduler was never sent and costs nothing.
+    """
+    for i, task in enumerate(tasks):
+        if task is winner:
+            continue
+        if task.done() and not task.cancelled() and task.exception() is None:
+            record_llm_usage(task.result(), model)
+        elif not task.done() and i in sent:
+            record_llm_usage(winner.result(), model)
+
+
+async def call_llm(
+    kind: str,
+    model: str,
+    make_call: Callable[[], Awaitable[Any]],
+    hedge: bool = False,
+    timeout: Optional[float] = None,
+    priority: str = "interactive",
+) -> Tuple[Any, int, bool]:
+    """
+    Await make_call() under an optional timeout, hedging it when enabled.
+    Returns (result, calls made, hedged). Raises DeadlineExceeded on timeout;
+    other errors are raised once every in-flight attempt has failed.
+    """
+    key = f"{kind}:{model}"
+    if timeout is not None and timeout <= 0:
+        raise DeadlineExceeded(calls=0)
+
+    def observe(seconds: float) -> None:
+        latency_tracker.observe(key, seconds)
+
+    # Attempts whose request has gone out (the scheduler granted a slot and called make_call)
+    sent: Set[int] = set()
+
+    async def timed(attempt: int):
+        def send():
+            sent.add(attempt)
+            return make_call()
+
+        return await llm_scheduler.call(model, send, priority=priority, observe=observe, kind=kind)
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout if timeout is not None else None
+    tasks = [asyncio.ensure_future(timed(0))]
+    try:
+        delay = hedge_delay(key) if hedge else None
+        if delay is not None and (deadline is None or loop.time() + delay < deadline):
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                tasks.append(asyncio.ensure_future(timed(1)))
+                hedges.inc(kind=kind, outcome="fired")
+
+        error: Optional[BaseException] = None
+        pending = set(tasks)
+        while pending:
+            remaining = None if deadline is None else max(0.0, deadline - loop.time())
+            done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                raise DeadlineExceeded(calls=len(tasks), hedged=len(tasks) > 1)
+            for task in done:
+                if task.exception() is None:
+                    if task is not tasks[0]:
+                        hedges.inc(kind=kind, outcome="won")
+                    _record_losing_usage(tasks, task, model, sent)
+                    return task.result(), len(tasks), len(tasks) > 1
+                error = error or task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                # Mark a losing attempt's failure as retrieved
+                task.exception()
@@ -1,13 +1,16 @@
+import asyncio
 import io
 import os
 import json
-from typing import List, Optional
+import time
+import logging
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Literal, Optional
 from dotenv import load_dotenv
-import razorpay
 
-from fastapi import FastAPI, File, UploadFile, HTTPException, Body, Form
+from fastapi import FastAPI, File, UploadFile, HTTPException, Body, Form, Depends, Header, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 
 # from app.openai_client import OpenAIClient
 from app.schemas import (
@@ -15,15 +18,218 @@ from app.schemas import (
     GraphGenerateResponse,
     RazorpayCreateOrderRequest,
     RazorpayOrderResponse,
+    RazorpayVerifyRequest,
+    RazorpayVerifyResponse,
+    SessionMoreRequest,
+)
+from app.graph import prime_response_models
+from app.registry import get_pickup_graph, graph_registry
+from app.cache import response_cache, vision_cache
+from app.pool import line_pool
+from app.sessions import session_store
+from app.ratelimit import RATE_LIMIT_BACKEND, all_stats
+from app.scheduler import llm_scheduler
+from app.styles import style_registry
+from app.images import ImageTooLarge, UploadedImage, UploadSizeLimit, scan_upload, shutdown_executor
+from app import payments, transport
+from app.metrics import http_requests, http_seconds, metrics
+from app.batch import BODY_CHUNKS as BATCH_BODY_CHUNKS, DEFAULT_CONCURRENCY, aparse_records, body_lines, run_batch
+from app.runner import (
+    GRAPH_MODEL,
+    DEFAULT_TEMPERATURE,
+    GraphRun,
+    default_image_model,
+    prepare_features_run,
+    prepare_image_run,
+    prepare_session_run,
+    run_graph,
+    stream_graph,
 )
-from app.graph import build_pickup_graph
 
 load_dotenv()
-# Enable LangSmith tracing if env not already set
-os.environ.setdefault("LANGCHAIN_TRACING_V2", "true")
+# Enable LangSmith tracing by default only when a LangSmith key is configured;
+# built-in /metrics and debug timings work without it.
+if os.getenv("LANGCHAIN_API_KEY") or os.getenv("LANGSMITH_API_KEY"):
+    os.environ.setdefault("LANGCHAIN_TRACING_V2", "true")
 os.environ.setdefault("LANGCHAIN_PROJECT", "pickup-line")
 
-app = FastAPI(title="Pickup Line Generator API", version="0.1.0")
+logger = logging.getLogger(__name__)
+
+# GRAPH_WARMUP: 1 = compile the default graphs before serving (default), background = serve
+# /health right away and compile in a thread (/ready answers 503 until done), 0 = no warm-up
+WARMUP_MODE = os.getenv("GRAPH_WARMUP", "1").strip().lower()
+if WARMUP_MODE in ("0", "false", "no", "off"):
+    WARMUP_MODE = "off"
+elif WARMUP_MODE != "background":
+    WARMUP_MODE = "blocking"
+
+# Readiness for /ready: flips once the warm-up has finished (or right away without one)
+startup: Dict[str, Any] = {"ready": False, "warmup": WARMUP_MODE, "warmup_s": None, "graphs": 0, "errors": []}
+
+
+def _warm_up_graphs() -> None:
+    """Run the startup warm-up (unless GRAPH_WARMUP=0), then mark the app ready."""
+    started = time.perf_counter()
+    if WARMUP_MODE != "off":
+        _build_warm_graphs()
+    startup["warmup_s"] = round(time.perf_counter() - started, 3)
+    startup["graphs"] = graph_registry.stats()["size"]
+    startup["ready"] = True
+
+
+def _build_warm_graphs() -> None:
+    """Compile the graphs used by the default request paths so the first requests hit the registry."""
+    keys = [{"model": model, "temperature": DEFAULT_TEMPERATURE} for model in (GRAPH_MODEL, default_image_model())]
+    if graph_registry.warm_keys is not None:
+        # Graphs other workers have built recently (GRAPH_WARMUP_KEYS_PATH)
+        keys += graph_registry.warm_keys.recent()
+    for key in keys:
+        try:
+            get_pickup_graph(**key)
+        except Exception as e:
+            # Missing credentials etc. should not prevent the app from starting
+            logger.warning("graph warm-up failed for %s: %s", key.get("model"), e)
+            startup["errors"].append(f"{key.get('model')}: {e}")
+    prime_response_models()
+
+
+def _encode_event(event: Dict[str, Any], fmt: str) -> str:
+    if fmt == "ndjson":
+        return json.dumps(event) + "\n"
+    return f"event: {event['event']}\ndata: {json.dumps(event)}\n\n"
+
+
+def _streaming_response(run: GraphRun, fmt: str, tokens: bool) -> StreamingResponse:
+    async def body():
+        async for event in stream_graph(run, tokens=tokens):
+            yield _encode_event(event, fmt)
+
+    media_type = "application/x-ndjson" if fmt == "ndjson" else "text/event-stream"
+    # Disable proxy buffering so each event reaches the client immediately
+    return StreamingResponse(body(), media_type=media_type, headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+class _BatchStreamingResponse(StreamingResponse):
+    """
+    A StreamingResponse whose content is parsed from the request body while it
+    is still arriving. The disconnect listener is the only receive() reader: it
+    hands body chunks to the content through a small queue and ends the response,
+    cancelling the runs, on http.disconnect. While that queue is full it waits,
+    so a disconnect is seen once the parser has caught up with the body.
+    """
+
+    def __init__(self, content_for, **kwargs):
+        self.chunks: asyncio.Queue = asyncio.Queue(maxsize=BATCH_BODY_CHUNKS)
+        super().__init__(content_for(self.request_chunks()), **kwargs)
+
+    async def request_chunks(self):
+        while (chunk := await self.chunks.get()) is not None:
+            yield chunk
+
+    async def listen_for_disconnect(self, receive) -> None:
+        more_body = True
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            if more_body:
+                await self.chunks.put(message.get("body", b""))
+                more_body = message.get("more_body", False)
+                if not more_body:
+                    await self.chunks.put(None)
+
+
+async def _image_upload(file: UploadFile) -> UploadedImage:
+    # Validate content type
+    if not (file.content_type and file.content_type.startswith("image/")):
+        raise HTTPException(status_code=400, detail="Please upload an image file.")
+
+    try:
+        upload = await scan_upload(file)
+    except ImageTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    if upload.size == 0:
+        raise HTTPException(status_code=400, detail="Empty file uploaded.")
+    return upload
+
+
+class ImageGraphForm:
+    """Form fields shared by the image graph endpoints."""
+
+    def __init__(
+        self,
+        file: UploadFile = File(...),
+        model_text: Optional[str] = Form(default=None),
+        temperature: Optional[float] = Form(default=None, description="Sampling temperature for generation"),
+        mode: Optional[str] = Form(default=None, description="Graph mode: fanout, batched or batched_rated"),
+        retry_threshold: Optional[int] = Form(default=None, ge=1, le=10, description="Regenerate lines rated below this score"),
+        max_attempts: Optional[int] = Form(default=None, ge=1, le=5, description="Max generations per style, including the first"),
+        latency_budget_ms: Optional[int] = Form(default=None, ge=0, description="No retry round starts after this much time"),
+        deadline_ms: Optional[int] = Form(default=None, ge=0, description="Hard request deadline; late styles are dropped"),
+        hedge: Optional[bool] = Form(default=None, description="Hedge LLM calls that run past the observed p95 latency"),
+        rater: Optional[str] = Form(default=None, description="Rater: llm, local or local_then_llm"),
+        styles: Optional[str] = Form(default=None, description="Comma-separated style labels to generate (default: all)"),
+        cache_control: str = Form(default="default", description="Response cache: default, bypass or refresh"),
+        user_id: Optional[str] = Form(default=None, max_length=128, description="Regenerate lines that repeat this user's recent ones"),
+        debug: bool = Form(default=False, description="Include per-node timings, tokens and cost in the response"),
+    ):
+        self.file = file
+        self.model_text = model_text
+        self.temperature = temperature
+        self.mode = mode
+        self.retry_threshold = retry_threshold
+        self.max_attempts = max_attempts
+        self.latency_budget_ms = latency_budget_ms
+        self.deadline_ms = deadline_ms
+        self.hedge = hedge
+        self.rater = rater
+        self.styles = [label for label in styles.split(",") if label.strip()] if styles else None
+        self.cache_control = cache_control
+        self.user_id = user_id
+        self.debug = debug
+
+    async def prepare(self, route: str) -> GraphRun:
+        upload = await _image_upload(self.file)
+        return await prepare_image_run(
+            upload,
+            self.file.content_type,
+            model_text=self.model_text,
+            temperature=self.temperature,
+            mode=self.mode,
+            retry_threshold=self.retry_threshold,
+            max_attempts=self.max_attempts,
+            latency_budget_ms=self.latency_budget_ms,
+            deadline_ms=self.deadline_ms,
+            hedge=self.hedge,
+            rater=self.rater,
+            styles=self.styles,
+            cache_control=self.cache_control,
+            route=route,
+            debug=self.debug,
+            user_id=self.user_id,
+        )
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    transport.start()
+    warmup = None
+    if WARMUP_MODE == "background":
+        # Heavy imports and graph compilation run off the event loop, so /health answers meanwhile
+        warmup = asyncio.create_task(asyncio.to_thread(_warm_up_graphs))
+    else:
+        _warm_up_graphs()
+    yield
+    if warmup is not None:
+        # Let a warm-up that is still running finish before the pools it uses close
+        await asyncio.gather(warmup, return_exceptions=True)
+    shutdown_executor()
+    # Compiled graphs hold references to the pooled clients that are about to close
+    graph_registry.clear()
+    await transport.aclose()
+
+
+app = FastAPI(title="Pickup Line Generator API", version="0.1.0", lifespan=lifespan)
 
 # CORS (adjust origins for your frontend)
 app.add_middleware(
@@ -37,138 +243,263 @@ app.add_middleware(
 )
 
 
+# Refuses oversized uploads before the form parser spools them
+app.add_middleware(UploadSizeLimit)
+
+
+class RecordHTTPMetrics:
+    """
+    Counts requests and observes latency per route. Plain ASGI rather than
+    @app.middleware("http"): that wrapper hides the client's disconnect from
+    streaming responses, so a dropped batch stream would keep running.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        status = 500
+
+        async def send_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            # Label by route template, not raw path, to keep cardinality bounded
+            route = getattr(scope.get("route"), "path", "unmatched")
+            method = scope["method"]
+            http_requests.inc(method=method, route=route, status=status)
+            http_seconds.observe(time.perf_counter() - started, method=method, route=route)
+
+
+app.add_middleware(RecordHTTPMetrics)
+
+
+def _cache_gauges() -> Dict[tuple, float]:
+    samples = {}
+    for name, stats in (
+        ("graph_registry", graph_registry.stats()),
+        ("response_cache", response_cache.stats()),
+        ("vision_cache", vision_cache.stats()),
+        ("sessions", session_store.stats()),
+    ):
+        for field in ("hits", "misses", "coalesced", "evictions", "builds", "size", "entries"):
+            if field in stats:
+                samples[(name, field)] = stats[field]
+    return samples
+
+
+metrics.gauge("pickup_cache_stat", "Graph registry and cache counters", _cache_gauges, ("cache", "stat"))
+metrics.gauge("pickup_http_pool_connections", "Shared HTTP pool connections by state", transport.pool_stats, ("pool", "state"))
+
+
+@app.get("/health")
+async def health():
+    """Liveness: the process is up and serving."""
+    return {"status": "ok"}
+
+
+@app.get("/ready")
+async def ready():
+    """Readiness: 200 once the startup warm-up has compiled the default graphs, 503 until then."""
+    return JSONResponse(startup, status_code=200 if startup["ready"] else 503)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics() -> PlainTextResponse:
+    """Prometheus text exposition of request, node, token, cost and cache metrics."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.post("/v1/generate-graph", response_model=GraphGenerateResponse)
 async def generate_graph(payload: GraphGenerateRequest) -> GraphGenerateResponse:
-    # Choose model/temperature: prefer explicit override; otherwise use a safe base model for LangGraph
-    chosen_model ="ft:gpt-3.5-turbo-1106:manav::C8AMBoyU"
-    chosen_temp = payload.temperature if payload.temperature is not None else 0.5
-    print(chosen_model, chosen_temp)
-    app_graph = build_pickup_graph(model=chosen_model, temperature=chosen_temp)
-    state_in = {"features": payload.features.model_dump()}
+    return await run_graph(await prepare_features_run(payload))
 
-    try:
-        result = app_graph.invoke(
-            state_in,
-            config={
-                "tags": ["graph", "from-features"],
-                "metadata": {
-                    "route": "/v1/generate-graph",
-                    "model": chosen_model,
-                    "temperature": chosen_temp,
-                },
-            },
-        )
-    except Exception as e:
-        # Surface error to client for debugging
-        raise HTTPException(status_code=500, detail=f"graph_error: {e}")
-
-    outputs = result.get("outputs", {})
-    ratings = result.get("ratings", {})
-    best_label = result.get("best_label", "")
-    best_line = result.get("best_line", outputs.get(best_label, ""))
-
-    return GraphGenerateResponse(
-        outputs=outputs,
-        ratings=ratings,
-        best_label=best_label,
-        best_line=best_line,
-    )
 
+@app.post("/v1/generate-graph/stream")
+async def generate_graph_stream(
+    payload: GraphGenerateRequest,
+    format: Literal["sse", "ndjson"] = Query(default="sse", description="sse or ndjson"),
+    tokens: bool = Query(default=False, description="Also stream generator tokens (fanout mode)"),
+) -> StreamingResponse:
+    """Streams each style's line as its node finishes, then ratings and the final result."""
+    run = await prepare_features_run(payload, route="/v1/generate-graph/stream")
+    return _streaming_response(run, format, tokens)
 
-# Razorpay: Create Order
-@app.post("/v1/payments/razorpay/create-order", response_model=RazorpayOrderResponse)
-async def create_razorpay_order(payload: RazorpayCreateOrderRequest) -> RazorpayOrderResponse:
+
+@app.post("/v1/sessions/{session_id}/more", response_model=GraphGenerateResponse)
+async def session_more(session_id: str, payload: SessionMoreRequest = Body(default_factory=SessionMoreRequest)) -> GraphGenerateResponse:
+    """New lines for the photo of an earlier response: generators and rater only, avoiding the session's lines."""
+    return await run_graph(await prepare_session_run(session_id, payload))
+
+
+@app.post("/v1/generate-graph/batch")
+async def generate_graph_batch(
+    request: Request,
+    concurrency: int = Query(default=DEFAULT_CONCURRENCY, ge=1, description="Max graphs in flight"),
+) -> StreamingResponse:
+    """
+    Body: JSONL of GraphGenerateRequest records (optional "id" per line).
+    Streams back JSONL results as they complete; identical inputs run once.
+    The body is parsed as it arrives, and a client disconnect cancels the runs.
+    """
+    async def lines(chunks):
+        async for result in run_batch(aparse_records(body_lines(chunks)), concurrency=concurrency):
+            yield json.dumps(result) + "\n"
+
+    return _BatchStreamingResponse(lines, media_type="application/x-ndjson")
+
+
+@app.get("/v1/styles")
+async def list_styles():
+    """Enabled styles clients can select with `styles`, in generation order."""
+    return {
+        "styles": [
+            {"label": label, "instruction": style.instruction, "model": style.model, "temperature": style.temperature}
+            for label, style in ((label, style_registry.get(label)) for label in style_registry.labels())
+        ]
+    }
+
+
+@app.get("/v1/graph-registry")
+async def graph_registry_stats():
+    """Hit/miss/build-time counters for the compiled-graph registry."""
+    return graph_registry.stats()
+
+
+@app.get("/v1/response-cache")
+async def response_cache_stats():
+    """Hit/miss counters and size of the response cache."""
+    return response_cache.stats()
+
+
+@app.get("/v1/line-pool")
+async def line_pool_stats():
+    """Size and hit/miss counters of the precomputed line pool."""
+    if line_pool is None:
+        return {"mode": "off"}
+    return line_pool.stats()
+
+
+@app.get("/v1/rate-limit")
+async def rate_limit_stats():
+    """OpenAI budget levels per limit group (shared across workers with sqlite) and this worker's LLM scheduler state."""
+    # sqlite bucket levels are read in transactions; keep them off the event loop
+    budgets = await asyncio.to_thread(all_stats)
+    return {"backend": RATE_LIMIT_BACKEND, "pid": os.getpid(), "budgets": budgets, "scheduler": llm_scheduler.stats()}
+
+
+@app.get("/v1/sessions")
+async def session_stats():
+    """Size, hit/miss and eviction counters of the session store."""
+    return session_store.stats()
+
+
+@app.get("/v1/vision-cache")
+async def vision_cache_stats():
+    """Hit/miss/coalescing counters for the image description cache."""
+    return vision_cache.stats()
+
+
+def _razorpay_credentials() -> tuple:
     key_id = os.getenv("RAZORPAY_KEY_ID")
     key_secret = os.getenv("RAZORPAY_KEY_SECRET")
     if not key_id or not key_secret:
         raise HTTPException(status_code=500, detail="Razorpay credentials are not configured. Set RAZORPAY_KEY_ID and RAZORPAY_KEY_SECRET")
+    return key_id, key_secret
 
+
+def _order_response(order: Dict[str, Any], key_id: str, replayed: bool = False) -> RazorpayOrderResponse:
+    # Build typed response including public key for frontend checkout
+    return RazorpayOrderResponse(
+        id=order.get("id"),
+        amount=order.get("amount"),
+        currency=order.get("currency"),
+        status=order.get("status"),
+        receipt=order.get("receipt"),
+        created_at=order.get("created_at"),
+        amount_paid=order.get("amount_paid"),
+        amount_due=order.get("amount_due"),
+        # Razorpay returns [] for empty notes
+        notes=order.get("notes") or {},
+        key_id=key_id,
+        payment_id=order.get("payment_id"),
+        idempotent_replay=replayed,
+    )
+
+
+# Razorpay: Create Order
+@app.post("/v1/payments/razorpay/create-order", response_model=RazorpayOrderResponse)
+async def create_razorpay_order(
+    payload: RazorpayCreateOrderRequest,
+    idempotency_key: Optional[str] = Header(default=None, alias="Idempotency-Key", max_length=255),
+) -> RazorpayOrderResponse:
+    """Create an order; retries with the same Idempotency-Key (header or body) return the original order."""
+    key_id, key_secret = _razorpay_credentials()
     if payload.amount <= 0:
         raise HTTPException(status_code=400, detail="Amount must be greater than 0 (in the smallest currency unit)")
 
-    try:
-        client = razorpay.Client(auth=(key_id, key_secret))
-        data = {
-            "amount": payload.amount,  # amount in paise for INR
-            "currency": payload.currency or "INR",
-        }
-        if payload.receipt:
-            data["receipt"] = payload.receipt
-        if payload.notes:
-            data["notes"] = payload.notes
-
-        order = client.order.create(data=data)
-        # Build typed response including public key for frontend checkout
-        return RazorpayOrderResponse(
-            id=order.get("id"),
-            amount=order.get("amount"),
-            currency=order.get("currency"),
-            status=order.get("status"),
-            receipt=order.get("receipt"),
-            created_at=order.get("created_at"),
-            amount_paid=order.get("amount_paid"),
-            amount_due=order.get("amount_due"),
-            notes=order.get("notes") or {},
-            key_id=key_id,
-        )
-    except razorpay.errors.BadRequestError as e:
-        raise HTTPException(status_code=400, detail=f"Razorpay BadRequest: {e}")
-    except razorpay.errors.ServerError as e:
-        raise HTTPException(status_code=502, detail=f"Razorpay ServerError: {e}")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Razorpay error: {e}")
+    data = {
+        "amount": payload.amount,  # amount in paise for INR
+        "currency": payload.currency or "INR",
+    }
+    if payload.receipt:
+        data["receipt"] = payload.receipt
+    if payload.notes:
+        data["notes"] = payload.notes
+    order, replayed = await payments.create_order((key_id, key_secret), data, idempotency_key or payload.idempotency_key)
+    return _order_response(order, key_id, replayed)
 
 
-@app.post("/v1/generate-graph-from-image", response_model=GraphGenerateResponse)
-async def generate_graph_from_image(
-    file: UploadFile = File(...),
-    model_text: Optional[str] = Form(default=None),
-    temperature: Optional[float] = Form(default=None, description="Sampling temperature for generation"),
-) -> GraphGenerateResponse:
-    # Validate content type
-    if not (file.content_type and file.content_type.startswith("image/")):
-        raise HTTPException(status_code=400, detail="Please upload an image file.")
+@app.get("/v1/payments/razorpay/orders/{order_id}", response_model=RazorpayOrderResponse)
+async def get_razorpay_order(order_id: str, refresh: bool = Query(default=False)) -> RazorpayOrderResponse:
+    """Order status from the local ledger; refresh=true re-fetches it from Razorpay."""
+    key_id, key_secret = _razorpay_credentials()
+    order = await payments.get_order((key_id, key_secret), order_id, refresh=refresh)
+    return _order_response(order, key_id)
 
-    data = await file.read()
-    if len(data) == 0:
-        raise HTTPException(status_code=400, detail="Empty file uploaded.")
 
-    chosen_model = model_text or os.getenv("OPENAI_TEXT_MODEL") or "gpt-4o-mini"
-    chosen_temp = temperature if temperature is not None else 0.5
+@app.post("/v1/payments/razorpay/verify", response_model=RazorpayVerifyResponse)
+async def verify_razorpay_payment(payload: RazorpayVerifyRequest) -> RazorpayVerifyResponse:
+    """Verify Checkout's payment signature against the ledger and mark the order paid (no Razorpay call)."""
+    key_id, key_secret = _razorpay_credentials()
+    # The ledger can wait on SQLite locks; keep that off the event loop
+    order = await asyncio.to_thread(
+        payments.verify_payment,
+        payload.razorpay_order_id, payload.razorpay_payment_id, payload.razorpay_signature, key_secret,
+    )
+    return RazorpayVerifyResponse(verified=True, order=_order_response(order, key_id))
 
-    app_graph = build_pickup_graph(model=chosen_model, temperature=chosen_temp)
-    state_in = {
-        "image_bytes": data,
-        "mime_type": file.content_type,
-        # Allow features passthrough if you later extend with extra form fields
-        "features": {},
-    }
 
-    try:
-        result = app_graph.invoke(
-            state_in,
-            config={
-                "tags": ["graph", "from-image"],
-                "metadata": {
-                    "route": "/v1/generate-graph-from-image",
-                    "model": chosen_model,
-                    "temperature": chosen_temp,
-                    "mime_type": file.content_type,
-                },
-            },
-        )
-    except Exception as e:
-        # Surface error to client for debugging
-        raise HTTPException(status_code=500, detail=f"graph_error: {e}")
-
-    outputs = result.get("outputs", {})
-    ratings = result.get("ratings", {})
-    best_label = result.get("best_label", "")
-    best_line = result.get("best_line", outputs.get(best_label, ""))
-
-    return GraphGenerateResponse(
-        outputs=outputs,
-        ratings=ratings,
-        best_label=best_label,
-        best_line=best_line,
-    )
+@app.post("/v1/payments/razorpay/webhook")
+async def razorpay_webhook(request: Request, x_razorpay_signature: str = Header(default="")):
+    """Razorpay webhook (order.paid, payment.captured/authorized/failed) signed with RAZORPAY_WEBHOOK_SECRET."""
+    secret = os.getenv("RAZORPAY_WEBHOOK_SECRET")
+    if not secret:
+        raise HTTPException(status_code=500, detail="Razorpay webhook secret is not configured. Set RAZORPAY_WEBHOOK_SECRET")
+    body = await request.body()
+    return await asyncio.to_thread(payments.handle_webhook, body, x_razorpay_signature, secret)
+
+
+@app.post("/v1/generate-graph-from-image", response_model=GraphGenerateResponse)
+async def generate_graph_from_image(form: ImageGraphForm = Depends()) -> GraphGenerateResponse:
+    run = await form.prepare(route="/v1/generate-graph-from-image")
+    return await run_graph(run)
+
+
+@app.post("/v1/generate-graph-from-image/stream")
+async def generate_graph_from_image_stream(
+    form: ImageGraphForm = Depends(),
+    format: Literal["sse", "ndjson"] = Query(default="sse", description="sse or ndjson"),
+    tokens: bool = Query(default=False, description="Also stream generator tokens (fanout mode)"),
+) -> StreamingResponse:
+    """Streams the extracted features, each style's line as it finishes, then ratings and the final result."""
+    run = await form.prepare(route="/v1/generate-graph-from-image/stream")
+    return _streaming_response(run, format, tokens)
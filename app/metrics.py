@@ -0,0 +1,187 @@
+"""
+Minimal in-process metrics with Prometheus text exposition (served at /metrics).
+
+Kept dependency-free on purpose: counters and histograms are plain dicts keyed
+by label values, updated on the event loop thread, so there is no network or
+tracing overhead on the hot path.
+"""
+import json
+import os
+import threading
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+LabelValues = Tuple[str, ...]
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values: Dict[LabelValues, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        key = tuple(str(labels.get(n, "")) for n in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: Any) -> float:
+        key = tuple(str(labels.get(n, "")) for n in self.labels)
+        return self._values.get(key, 0.0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, key)} {value:g}")
+        return lines
+
+
+class Gauge:
+    """Gauge whose samples are read from a callback at scrape time."""
+
+    def __init__(self, name: str, help_text: str, collect: Callable[[], Dict[LabelValues, float]], labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._collect = collect
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        try:
+            samples = self._collect()
+        except Exception:
+            samples = {}
+        for key, value in sorted(samples.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {float(value):g}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labels: Iterable[str] = (), buckets: Iterable[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> (bucket counts, sum, count)
+        self._values: Dict[LabelValues, Tuple[List[int], float, int]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = tuple(str(labels.get(n, "")) for n in self.labels)
+        with self._lock:
+            counts, total, count = self._values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    le = 'le="%g"' % bound
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {bucket_count}")
+                le = 'le="+Inf"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total:g}")
+                lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: List[Any] = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help_text: str, labels: Iterable[str] = ()) -> Counter:
+        return self.register(Counter(name, help_text, labels))
+
+    def histogram(self, name: str, help_text: str, labels: Iterable[str] = (), buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help_text, labels, buckets))
+
+    def gauge(self, name: str, help_text: str, collect: Callable[[], Dict[LabelValues, float]], labels: Iterable[str] = ()) -> Gauge:
+        return self.register(Gauge(name, help_text, collect, labels))
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+http_requests = metrics.counter("pickup_http_requests_total", "HTTP requests by route and status", ("method", "route", "status"))
+http_seconds = metrics.histogram("pickup_http_request_seconds", "HTTP request latency by route", ("method", "route"))
+graph_runs = metrics.counter("pickup_graph_runs_total", "Graph executions by route and outcome", ("route", "outcome"))
+graph_seconds = metrics.histogram("pickup_graph_run_seconds", "End-to-end graph execution time", ("route",))
+graph_llm_calls = metrics.counter("pickup_graph_llm_calls_total", "LLM calls made by graph executions", ("route",))
+node_seconds = metrics.histogram("pickup_node_seconds", "Graph node execution time", ("node",))
+llm_tokens = metrics.counter("pickup_llm_tokens_total", "LLM tokens by model and direction", ("model", "kind"))
+llm_cost = metrics.counter("pickup_llm_cost_usd_total", "Estimated LLM spend in USD", ("model",))
+
+
+# USD per 1M (input, output) tokens; longest matching prefix wins.
+# Override or extend with MODEL_PRICES_JSON='{"model-prefix": [in, out]}'.
+MODEL_PRICES: Dict[str, Tuple[float, float]] = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4.1-mini": (0.40, 1.60),
+    "gpt-4.1": (2.00, 8.00),
+    "gpt-3.5-turbo": (0.50, 1.50),
+    "ft:gpt-3.5-turbo": (3.00, 6.00),
+    "ft:gpt-4o-mini": (0.30, 1.20),
+}
+try:
+    MODEL_PRICES.update({k: tuple(v) for k, v in json.loads(os.getenv("MODEL_PRICES_JSON", "{}")).items()})
+except ValueError:
+    pass
+
+
+def estimate_cost(model: str, input_tokens: int, output_tokens: int) -> float:
+    matches = [prefix for prefix in MODEL_PRICES if (model or "").startswith(prefix)]
+    if not matches:
+        return 0.0
+    price_in, price_out = MODEL_PRICES[max(matches, key=len)]
+    return (input_tokens * price_in + output_tokens * price_out) / 1_000_000
+
+
+# Token usage of the graph node currently executing (set by the node instrumentation)
+current_usage: ContextVar[Optional[Dict[str, Any]]] = ContextVar("current_usage", default=None)
+
+
+def record_llm_usage(resp: Any, model: str) -> None:
+    """Record token usage from an AIMessage into the metrics and the current node's usage."""
+    usage = getattr(resp, "usage_metadata", None) or {}
+    input_tokens = int(usage.get("input_tokens", 0) or 0)
+    output_tokens = int(usage.get("output_tokens", 0) or 0)
+    cost = estimate_cost(model, input_tokens, output_tokens)
+    llm_tokens.inc(input_tokens, model=model, kind="input")
+    llm_tokens.inc(output_tokens, model=model, kind="output")
+    llm_cost.inc(cost, model=model)
+
+    node_usage = current_usage.get()
+    if node_usage is not None:
+        node_usage["input_tokens"] += input_tokens
+        node_usage["output_tokens"] += output_tokens
+        node_usage["cost_usd"] += cost
@@ -0,0 +1,133 @@
+"""
+Tolerant JSON parsing for model replies.
+
+Models in JSON mode still occasionally wrap the object in ``` fences, add a
+sentence around it, or get cut off by max_tokens. parse_json_object() handles
+all three: it strips fences, decodes the first {...} object in the text and,
+if that object is truncated, drops the unfinished trailing member and closes
+the brackets left open. parse_model() then validates the result against a
+Pydantic model and counts outcomes per node.
+"""
+import json
+import re
+from typing import Any, Dict, Optional, Tuple, Type, TypeVar
+
+from pydantic import BaseModel, ValidationError
+
+from app.metrics import metrics
+
+parse_results = metrics.counter(
+    "pickup_llm_parse_total",
+    "Structured LLM replies by node and outcome (ok, repaired, invalid, failed)",
+    ("node", "outcome"),
+)
+
+Model = TypeVar("Model", bound=BaseModel)
+
+_FENCE = re.compile(r"```(?:json|JSON)?\s*(.*?)(?:```|$)", re.S)
+
+
+def _strip_fences(text: str) -> str:
+    match = _FENCE.search(text)
+    return match.group(1) if match else text
+
+
+def _close_truncated(text: str) -> Optional[str]:
+    """
+    Best-effort completion of a JSON object cut off mid-stream: remember the
+    last point where a member ended cleanly, cut there, and close whatever
+    brackets are still open.
+    """
+    stack = []
+    in_string = escaped = False
+    last_clean = None  # (index, stack snapshot) after the last complete value
+    for i, ch in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+                last_clean = (i + 1, list(stack))
+            continue
+        if ch == '"':
+            in_string = True
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+        elif ch in "}]":
+            if not stack:
+                break
+            stack.pop()
+            last_clean = (i + 1, list(stack))
+            if not stack:
+                return text[: i + 1]
+        elif ch == ",":
+            last_clean = (i, list(stack))
+        elif ch.isdigit() or ch in "el":  # end of a number, true/false/null
+            last_clean = (i + 1, list(stack))
+    if last_clean is None:
+        return None
+    cut, open_brackets = last_clean
+    candidate = text[:cut].rstrip().rstrip(",")
+    # A dangling key ("key" or "key":) cannot be completed; drop it
+    if _dangling_key(candidate):
+        candidate = re.sub(r',?\s*"[^"\\]*"\s*:?\s*$', "", candidate)
+    return candidate + "".join(reversed(open_brackets))
+
+
+def _dangling_key(candidate: str) -> bool:
+    # True when the text ends in an object key ("key" or "key":) rather than a value
+    if not candidate.endswith(('"', ":")):
+        return False
+    stripped = candidate.rstrip(":").rstrip()
+    before = stripped[: stripped.rfind('"', 0, len(stripped) - 1)].rstrip()
+    return before.endswith(("{", ","))
+
+
+def parse_json_object(text: Any) -> Tuple[Optional[Dict[str, Any]], bool]:
+    """(object, repaired) from a model reply; (None, False) when nothing usable is found."""
+    if isinstance(text, dict):
+        return text, False
+    if not isinstance(text, str) or not text.strip():
+        return None, False
+    try:
+        data = json.loads(text)
+        return (data, False) if isinstance(data, dict) else (None, False)
+    except ValueError:
+        pass
+
+    body = _strip_fences(text)
+    start = body.find("{")
+    if start < 0:
+        return None, False
+    body = body[start:]
+    try:
+        data, _ = json.JSONDecoder().raw_decode(body)
+        return (data, True) if isinstance(data, dict) else (None, False)
+    except ValueError:
+        pass
+    closed = _close_truncated(body)
+    if closed:
+        try:
+            data = json.loads(closed)
+            if isinstance(data, dict):
+                return data, True
+        except ValueError:
+            pass
+    return None, False
+
+
+def parse_model(text: Any, model: Type[Model], node: str) -> Optional[Model]:
+    """Parse and validate a reply as `model`, counting the outcome under `node`."""
+    data, repaired = parse_json_object(text)
+    if data is None:
+        parse_results.inc(node=node, outcome="failed")
+        return None
+    try:
+        result = model.model_validate(data)
+    except ValidationError:
+        parse_results.inc(node=node, outcome="invalid")
+        return None
+    parse_results.inc(node=node, outcome="repaired" if repaired else "ok")
+    return result
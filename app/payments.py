@@ -0,0 +1,348 @@
+"""
+Razorpay orders with idempotency keys and a local order ledger.
+
+Orders are created through the shared async HTTP client (app.transport), so
+a slow Razorpay call never blocks the event loop. Every order is recorded in a
+SQLite ledger (RAZORPAY_LEDGER_PATH, shared by all workers on the host):
+
+- A create-order request with an Idempotency-Key claims the key in the ledger
+  before calling Razorpay. A retry with the same key and body returns the
+  stored order without another Razorpay call. The same key with a different
+  body is rejected (422). A retry that arrives while the first call is still
+  running waits for its result. If the first call failed, the key is freed so
+  the client can retry. If Razorpay created the order but the ledger write
+  failed, the key stays claimed with the order id, and a retry fetches that
+  order instead of creating another.
+- Orders created without a key are stored under "order:<id>"; client keys may
+  not use that prefix, so no client can replay someone else's order.
+- Status lookups, payment signature verification and webhooks read and update
+  the ledger instead of calling Razorpay again.
+
+Ledger calls can wait on SQLite locks (BEGIN IMMEDIATE, a 5 s busy timeout),
+so async code runs them in worker threads. The ledger file is opened on first
+use, not at import.
+"""
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import httpx
+from fastapi import HTTPException
+
+from app import transport
+from app.cache import canonical_hash
+from app.metrics import metrics
+
+LEDGER_PATH = os.getenv("RAZORPAY_LEDGER_PATH", ".cache/razorpay_ledger.sqlite3")
+# A claimed key whose create has not finished after this long (crashed worker) can be taken over
+PENDING_TIMEOUT_S = float(os.getenv("RAZORPAY_PENDING_TIMEOUT_S", "30"))
+PENDING_POLL_S = 0.05
+# Ledger keys of orders created without an Idempotency-Key; reserved, clients may not send them
+LEDGER_KEY_PREFIX = "order:"
+
+# Webhook event -> ledger status
+WEBHOOK_STATUSES = {
+    "order.paid": "paid",
+    "payment.captured": "paid",
+    "payment.authorized": "authorized",
+    "payment.failed": "failed",
+}
+
+order_requests = metrics.counter(
+    "pickup_razorpay_orders_total", "Razorpay create-order requests by outcome (created, replayed, error)", ("outcome",)
+)
+razorpay_seconds = metrics.histogram("pickup_razorpay_request_seconds", "Razorpay API call latency", ("call",))
+
+logger = logging.getLogger(__name__)
+
+
+class IdempotencyConflict(ValueError):
+    """The idempotency key was already used for a different order request."""
+
+
+class OrderInProgress(Exception):
+    """Another request holding the same idempotency key is still creating the order."""
+
+
+class OrderLedger:
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=5.0, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS orders ("
+            "idempotency_key TEXT PRIMARY KEY, request_hash TEXT NOT NULL, order_id TEXT UNIQUE, "
+            "status TEXT NOT NULL, order_json TEXT, payment_id TEXT, "
+            "created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+
+    def claim(self, key: str, request_hash: str) -> Optional[Dict[str, Any]]:
+        """
+        The stored order for `key`, or None when the caller now owns the key and
+        must create the order. Raises IdempotencyConflict or OrderInProgress.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT request_hash, order_id, updated_at FROM orders WHERE idempotency_key = ?", (key,)
+                ).fetchone()
+                if row is None:
+                    self._conn.execute(
+                        "INSERT INTO orders (idempotency_key, request_hash, status, created_at, updated_at) "
+                        "VALUES (?, ?, 'pending', ?, ?)",
+                        (key, request_hash, now, now),
+                    )
+                elif row[0] != request_hash:
+                    raise IdempotencyConflict(f"Idempotency-Key {key!r} was already used for a different order")
+                elif row[1] is None and now - row[2] >= PENDING_TIMEOUT_S:
+                    # The worker that claimed it is gone; take the key over
+                    self._conn.execute("UPDATE orders SET updated_at = ? WHERE idempotency_key = ?", (now, key))
+                elif row[1] is None:
+                    raise OrderInProgress(key)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return None if row is None or row[1] is None else self.get(row[1])
+
+    def complete(self, key: str, request_hash: str, order: Dict[str, Any]) -> None:
+        """Store a created order under `key` (claimed, or _ledger_key(id) for keyless requests)."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO orders (idempotency_key, request_hash, order_id, status, order_json, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(idempotency_key) DO UPDATE SET "
+                "order_id = excluded.order_id, status = excluded.status, order_json = excluded.order_json, "
+                "updated_at = excluded.updated_at",
+                (key, request_hash, order["id"], order.get("status") or "created", json.dumps(order), now, now),
+            )
+
+    def record_order_id(self, key: str, order_id: str) -> None:
+        """
+        Tie a claimed key to an order Razorpay created when storing the order
+        failed. The key stays "pending"; a retry finishes the record from Razorpay.
+        """
+        with self._lock:
+            self._conn.execute(
+                "UPDATE orders SET order_id = ?, updated_at = ? WHERE idempotency_key = ? AND order_id IS NULL",
+                (order_id, time.time(), key),
+            )
+
+    def release(self, key: str) -> None:
+        """Free a claimed key whose create failed, so a retry can try again."""
+        with self._lock:
+            self._conn.execute("DELETE FROM orders WHERE idempotency_key = ? AND order_id IS NULL", (key,))
+
+    def get(self, order_id: str) -> Optional[Dict[str, Any]]:
+        """Stored order with the ledger's status and payment id, or None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT order_json, status, payment_id FROM orders WHERE order_id = ?", (order_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        # Only the id is known for an order whose create was never fully recorded
+        order = json.loads(row[0]) if row[0] else {"id": order_id}
+        order["status"] = row[1]
+        order["payment_id"] = row[2]
+        return order
+
+    def update(self, order_id: str, status: str, payment_id: Optional[str] = None, order: Optional[Dict] = None) -> bool:
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE orders SET status = ?, payment_id = COALESCE(?, payment_id), "
+                "order_json = COALESCE(?, order_json), updated_at = ? WHERE order_id = ?",
+                (status, payment_id, json.dumps(order) if order is not None else None, time.time(), order_id),
+            )
+        return cursor.rowcount > 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM orders GROUP BY status").fetchall()
+        return {"path": self.path, "orders": dict(rows)}
+
+
+_ledger: Optional[OrderLedger] = None
+_ledger_lock = threading.Lock()
+
+
+def get_ledger() -> OrderLedger:
+    global _ledger
+    with _ledger_lock:
+        if _ledger is None:
+            _ledger = OrderLedger(LEDGER_PATH)
+        return _ledger
+
+
+def _ledger_key(order_id: str) -> str:
+    return f"{LEDGER_KEY_PREFIX}{order_id}"
+
+
+def _error_detail(resp: httpx.Response) -> str:
+    try:
+        body = resp.json()
+    except ValueError:
+        return resp.text
+    error = body.get("error") if isinstance(body, dict) else None
+    description = error.get("description") if isinstance(error, dict) else None
+    return description if isinstance(description, str) and description else resp.text
+
+
+async def _razorpay(method: str, path: str, auth: Tuple[str, str], call: str, **kwargs) -> Dict[str, Any]:
+    started = time.perf_counter()
+    try:
+        resp = await transport.get_razorpay_client().request(method, path, auth=auth, **kwargs)
+    except httpx.HTTPError as e:
+        raise HTTPException(status_code=502, detail=f"Razorpay error: {e}")
+    finally:
+        razorpay_seconds.observe(time.perf_counter() - started, call=call)
+    if resp.status_code >= 500:
+        raise HTTPException(status_code=502, detail=f"Razorpay ServerError: {_error_detail(resp)}")
+    if resp.status_code >= 400:
+        raise HTTPException(status_code=400, detail=f"Razorpay BadRequest: {_error_detail(resp)}")
+    return resp.json()
+
+
+async def create_order(
+    auth: Tuple[str, str],
+    data: Dict[str, Any],
+    idempotency_key: Optional[str] = None,
+) -> Tuple[Dict[str, Any], bool]:
+    """(order, replayed): create an order, or return the one already created for `idempotency_key`."""
+    request_hash = canonical_hash(data)
+    if idempotency_key and idempotency_key.startswith(LEDGER_KEY_PREFIX):
+        order_requests.inc(outcome="error")
+        raise HTTPException(
+            status_code=400, detail=f"Idempotency-Key must not start with {LEDGER_KEY_PREFIX!r}; that prefix is reserved"
+        )
+    if idempotency_key:
+        deadline = time.monotonic() + PENDING_TIMEOUT_S
+        while True:
+            try:
+                existing = await asyncio.to_thread(lambda: get_ledger().claim(idempotency_key, request_hash))
+                break
+            except IdempotencyConflict as e:
+                order_requests.inc(outcome="conflict")
+                raise HTTPException(status_code=422, detail=str(e))
+            except OrderInProgress:
+                if time.monotonic() >= deadline:
+                    order_requests.inc(outcome="conflict")
+                    raise HTTPException(status_code=409, detail="An order with this Idempotency-Key is still being created")
+                await asyncio.sleep(PENDING_POLL_S)
+        if existing is not None:
+            if existing["status"] == "pending":
+                # Created at Razorpay but never stored: fetch it rather than create a second one
+                existing = await get_order(auth, existing["id"], refresh=True)
+            order_requests.inc(outcome="replayed")
+            return existing, True
+
+    try:
+        order = await _razorpay("POST", "/v1/orders", auth, "create_order", json=data)
+    except BaseException:
+        order_requests.inc(outcome="error")
+        if idempotency_key:
+            await asyncio.to_thread(lambda: get_ledger().release(idempotency_key))
+        raise
+    try:
+        await asyncio.to_thread(lambda: get_ledger().complete(idempotency_key or _ledger_key(order["id"]), request_hash, order))
+    except BaseException:
+        order_requests.inc(outcome="error")
+        # The order exists at Razorpay, so the key must not be freed: a retry would create another
+        if idempotency_key:
+            try:
+                await asyncio.to_thread(lambda: get_ledger().record_order_id(idempotency_key, order["id"]))
+            except Exception as e:
+                logger.warning("could not record Razorpay order %s for its idempotency key: %s", order["id"], e)
+        raise
+    order_requests.inc(outcome="created")
+    return await asyncio.to_thread(lambda: get_ledger().get(order["id"])) or order, False
+
+
+async def get_order(auth: Tuple[str, str], order_id: str, refresh: bool = False) -> Dict[str, Any]:
+    """Order from the ledger; refresh=True (or an order created elsewhere) fetches it from Razorpay."""
+    order = await asyncio.to_thread(lambda: get_ledger().get(order_id))
+    if order is not None and not refresh:
+        return order
+    fresh = await _razorpay("GET", f"/v1/orders/{order_id}", auth, "fetch_order")
+    return await asyncio.to_thread(_store_fetched, order_id, order, fresh)
+
+
+def _store_fetched(order_id: str, order: Optional[Dict[str, Any]], fresh: Dict[str, Any]) -> Dict[str, Any]:
+    ledger = get_ledger()
+    if order is None:
+        ledger.complete(_ledger_key(order_id), canonical_hash({"order_id": order_id}), fresh)
+    else:
+        ledger.update(order_id, fresh.get("status") or order["status"], order=fresh)
+    return ledger.get(order_id) or fresh
+
+
+def _signature_matches(message: bytes, signature: str, secret: str) -> bool:
+    expected = hmac.new(secret.encode("utf-8"), message, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, (signature or "").strip())
+
+
+def verify_payment(order_id: str, payment_id: str, signature: str, key_secret: str) -> Dict[str, Any]:
+    """
+    Check Checkout's razorpay_signature against the ledger's order and mark it
+    paid. Blocks on the ledger; call it from a worker thread in async code.
+    """
+    ledger = get_ledger()
+    order = ledger.get(order_id)
+    if order is None:
+        raise HTTPException(status_code=404, detail=f"Unknown order {order_id}")
+    if not _signature_matches(f"{order_id}|{payment_id}".encode("utf-8"), signature, key_secret):
+        raise HTTPException(status_code=400, detail="Invalid payment signature")
+    ledger.update(order_id, "paid", payment_id=payment_id)
+    return ledger.get(order_id) or order
+
+
+def _webhook_object(value: Any, where: str) -> Dict[str, Any]:
+    """`value` when it is a JSON object, {} when absent; anything else is a malformed event."""
+    if value is None:
+        return {}
+    if not isinstance(value, dict):
+        raise HTTPException(status_code=400, detail=f"Malformed webhook event: {where} is not an object")
+    return value
+
+
+def _webhook_string(value: Any) -> Optional[str]:
+    return value if isinstance(value, str) and value else None
+
+
+def handle_webhook(body: bytes, signature: str, webhook_secret: str) -> Dict[str, Any]:
+    """Apply a signed Razorpay webhook event to the ledger (blocking, like verify_payment)."""
+    if not _signature_matches(body, signature, webhook_secret):
+        raise HTTPException(status_code=400, detail="Invalid webhook signature")
+    try:
+        event = json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Webhook body is not JSON")
+    if not isinstance(event, dict):
+        raise HTTPException(status_code=400, detail="Malformed webhook event: body is not an object")
+    status = WEBHOOK_STATUSES.get(_webhook_string(event.get("event")) or "")
+    payload = _webhook_object(event.get("payload"), "payload")
+    payment = _webhook_object(_webhook_object(payload.get("payment"), "payload.payment").get("entity"), "payload.payment.entity")
+    order = _webhook_object(_webhook_object(payload.get("order"), "payload.order").get("entity"), "payload.order.entity")
+    order_id = _webhook_string(payment.get("order_id")) or _webhook_string(order.get("id"))
+    if status is None or not order_id:
+        return {"ok": True, "updated": False}
+    ledger = get_ledger()
+    current = ledger.get(order_id)
+    if current is not None and current["status"] == "paid" and status != "paid":
+        # Events can arrive out of order; never move a paid order back
+        return {"ok": True, "updated": False, "order_id": order_id, "status": "paid"}
+    # Orders created outside this service are not in the ledger; acknowledge them anyway
+    updated = ledger.update(order_id, status, payment_id=_webhook_string(payment.get("id")))
+    return {"ok": True, "updated": updated, "order_id": order_id, "status": status}
@@ -0,0 +1,275 @@
+"""
+Persistent pool of generated, well-rated lines indexed by photo attributes.
+
+Every graph result (live traffic and batch runs) adds its lines rated >=
+LINE_POOL_MIN_RATING, keyed by the normalized attribute/vibe set of the
+features that produced them (inverted index in SQLite). With
+LINE_POOL_MODE=serve, /v1/generate-graph first looks for a close enough line
+for every style and answers from the pool without any LLM call; otherwise the
+graph runs as usual and refills the pool.
+
+Freshness/dedup: identical lines are stored once, lines expire after
+LINE_POOL_MAX_AGE_S, retire after LINE_POOL_MAX_SERVES serves, and a served
+line is not served again for LINE_POOL_COOLDOWN_S.
+
+Upkeep stays off the hot path: a line's attribute rows go with it (ON DELETE
+CASCADE), retired lines are deleted when served, expired ones by an indexed
+sweep at most every SWEEP_INTERVAL_S, and the oldest ids once an approximate
+line count passes LINE_POOL_MAX_LINES (down to EVICT_LOW_WATER of it). The
+pool is synchronous SQLite: callers on the event loop use alookup/aadd.
+"""
+import asyncio
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from app.metrics import metrics
+
+POOL_MODES = ("off", "fill", "serve")
+POOL_MODE = os.getenv("LINE_POOL_MODE", "off").strip().lower()
+POOL_PATH = os.getenv("LINE_POOL_PATH", ".cache/line_pool.sqlite3")
+MIN_RATING = int(os.getenv("LINE_POOL_MIN_RATING", "8"))
+# Weighted attribute/description similarity a pooled line needs to be served
+MIN_SIMILARITY = float(os.getenv("LINE_POOL_MIN_SIMILARITY", "0.5"))
+# Fraction of styles that must be covered to answer from the pool
+MIN_COVERAGE = float(os.getenv("LINE_POOL_MIN_COVERAGE", "1.0"))
+MAX_AGE_S = float(os.getenv("LINE_POOL_MAX_AGE_S", str(30 * 86400)))
+MAX_SERVES = int(os.getenv("LINE_POOL_MAX_SERVES", "50"))
+COOLDOWN_S = float(os.getenv("LINE_POOL_COOLDOWN_S", "600"))
+MAX_LINES = int(os.getenv("LINE_POOL_MAX_LINES", "100000"))
+ATTR_WEIGHT = 0.7
+SWEEP_INTERVAL_S = 60.0
+EVICT_LOW_WATER = 0.9
+
+pool_lookups = metrics.counter("pickup_line_pool_lookups_total", "Line pool lookups by outcome", ("outcome",))
+
+_WORD = re.compile(r"[a-z]+")
+_STOPWORDS = {"a", "an", "and", "at", "in", "of", "on", "the", "with", "person", "photo", "their", "her", "his"}
+
+
+def _singular(word: str) -> str:
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+
+def normalize_attributes(features: Optional[Dict[str, Any]]) -> Set[str]:
+    """Lowercased, singularized attribute and vibe keys ("Dogs" and "dog" match)."""
+    features = features or {}
+    keys = set()
+    for value in list(features.get("attributes") or []) + list(features.get("vibes") or []):
+        words = _WORD.findall(str(value).lower())
+        if words:
+            keys.add(" ".join(_singular(w) for w in words))
+    return keys
+
+
+def _description_words(features: Optional[Dict[str, Any]]) -> Set[str]:
+    text = str((features or {}).get("description") or "").lower()
+    return {_singular(w) for w in _WORD.findall(text) if w not in _STOPWORDS and len(w) > 2}
+
+
+def _normalize_line(line: str) -> str:
+    return " ".join(_WORD.findall((line or "").lower()))
+
+
+def _jaccard(a: Set[str], b: Set[str]) -> float:
+    if not a and not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+_ATTRS_COLUMNS = "attr TEXT NOT NULL, line_id INTEGER NOT NULL REFERENCES pool_lines(id) ON DELETE CASCADE"
+
+
+class LinePool:
+    def __init__(self, path: str, max_lines: int = MAX_LINES):
+        self.path = path
+        self.max_lines = max(1, max_lines)
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS pool_lines ("
+            "id INTEGER PRIMARY KEY, label TEXT NOT NULL, line TEXT NOT NULL, norm TEXT NOT NULL UNIQUE, "
+            "rating INTEGER NOT NULL, attrs TEXT NOT NULL, description TEXT NOT NULL, created_at REAL NOT NULL, "
+            "served_count INTEGER NOT NULL DEFAULT 0, last_served REAL NOT NULL DEFAULT 0)"
+        )
+        self._migrate_attrs()
+        self._conn.execute(f"CREATE TABLE IF NOT EXISTS pool_attrs ({_ATTRS_COLUMNS})")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS pool_attrs_attr ON pool_attrs(attr)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS pool_attrs_line ON pool_attrs(line_id)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS pool_lines_created ON pool_lines(created_at)")
+        (self._approx_lines,) = self._conn.execute("SELECT COUNT(*) FROM pool_lines").fetchone()
+        self._swept_at = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.added = 0
+
+    def _migrate_attrs(self) -> None:
+        """Pools created before the foreign key: rebuild pool_attrs with it, dropping orphaned rows."""
+        row = self._conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'pool_attrs'").fetchone()
+        if row is None or "REFERENCES" in row[0]:
+            return
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._conn.execute("ALTER TABLE pool_attrs RENAME TO pool_attrs_old")
+            self._conn.execute(f"CREATE TABLE pool_attrs ({_ATTRS_COLUMNS})")
+            self._conn.execute(
+                "INSERT INTO pool_attrs (attr, line_id) "
+                "SELECT attr, line_id FROM pool_attrs_old WHERE line_id IN (SELECT id FROM pool_lines)"
+            )
+            self._conn.execute("DROP TABLE pool_attrs_old")
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    def add(self, features: Dict[str, Any], outputs: Dict[str, str], ratings: Dict[str, int]) -> int:
+        """Add well-rated lines produced for `features`; returns how many were new."""
+        attrs = normalize_attributes(features)
+        if not attrs:
+            return 0
+        description = " ".join(sorted(_description_words(features)))
+        now = time.time()
+        added = 0
+        with self._lock:
+            for label, line in outputs.items():
+                norm = _normalize_line(line)
+                if not norm or ratings.get(label, 0) < MIN_RATING:
+                    continue
+                cursor = self._conn.execute(
+                    "INSERT OR IGNORE INTO pool_lines (label, line, norm, rating, attrs, description, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (label, line, norm, int(ratings[label]), json.dumps(sorted(attrs)), description, now),
+                )
+                if cursor.rowcount:
+                    self._conn.executemany(
+                        "INSERT INTO pool_attrs (attr, line_id) VALUES (?, ?)",
+                        [(attr, cursor.lastrowid) for attr in attrs],
+                    )
+                    added += 1
+            self._approx_lines += added
+            if now - self._swept_at >= SWEEP_INTERVAL_S:
+                self._swept_at = now
+                # created_at is indexed, so this only touches the expired rows
+                self._approx_lines -= self._conn.execute("DELETE FROM pool_lines WHERE created_at < ?", (now - MAX_AGE_S,)).rowcount
+            if self._approx_lines > self.max_lines:
+                self._evict()
+        self.added += added
+        return added
+
+    async def aadd(self, features: Dict[str, Any], outputs: Dict[str, str], ratings: Dict[str, int]) -> int:
+        return await asyncio.to_thread(self.add, features, outputs, ratings)
+
+    def _evict(self) -> None:
+        # Caller holds the lock. Recount (other workers add too), then drop the oldest ids
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM pool_lines").fetchone()
+        overflow = count - int(self.max_lines * EVICT_LOW_WATER) if count > self.max_lines else 0
+        if overflow > 0:
+            self._conn.execute(
+                "DELETE FROM pool_lines WHERE id < (SELECT id FROM pool_lines ORDER BY id LIMIT 1 OFFSET ?)", (overflow,)
+            )
+        self._approx_lines = count - max(overflow, 0)
+
+    def _candidates(self, attrs: Set[str], now: float) -> List[Tuple]:
+        placeholders = ",".join("?" for _ in attrs)
+        return self._conn.execute(
+            "SELECT l.id, l.label, l.line, l.rating, l.attrs, l.description, l.served_count "
+            f"FROM pool_lines l JOIN (SELECT line_id, COUNT(*) AS shared FROM pool_attrs WHERE attr IN ({placeholders}) "
+            "GROUP BY line_id ORDER BY shared DESC LIMIT 500) m ON m.line_id = l.id "
+            "WHERE l.created_at >= ? AND l.served_count < ? AND l.last_served <= ?",
+            (*attrs, now - MAX_AGE_S, MAX_SERVES, now - COOLDOWN_S),
+        ).fetchall()
+
+    def lookup(self, features: Dict[str, Any], labels: Iterable[str]) -> Optional[Tuple[Dict[str, str], Dict[str, int]]]:
+        """
+        (outputs, ratings) with one pooled line per label, or None when fewer than
+        LINE_POOL_MIN_COVERAGE of the labels have a close enough line. Served
+        lines are marked so the cooldown and serve cap apply.
+        """
+        labels = list(labels)
+        attrs = normalize_attributes(features)
+        if not attrs or not labels:
+            pool_lookups.inc(outcome="miss")
+            self.misses += 1
+            return None
+        words = _description_words(features)
+        now = time.time()
+        with self._lock:
+            rows = self._candidates(attrs, now)
+            best: Dict[str, Tuple[float, int, int, int, str]] = {}
+            for line_id, label, line, rating, line_attrs, description, served in rows:
+                if label not in labels:
+                    continue
+                similarity = ATTR_WEIGHT * _jaccard(attrs, set(json.loads(line_attrs)))
+                similarity += (1 - ATTR_WEIGHT) * _jaccard(words, set(description.split()))
+                if similarity < MIN_SIMILARITY:
+                    continue
+                # Closest first, then best rated, then least served
+                key = (round(similarity, 2), rating, -served, line_id, line)
+                if label not in best or key > best[label]:
+                    best[label] = key
+            if not best or len(best) < MIN_COVERAGE * len(labels):
+                pool_lookups.inc(outcome="miss")
+                self.misses += 1
+                return None
+            served_ids = [key[3] for key in best.values()]
+            self._conn.executemany(
+                "UPDATE pool_lines SET served_count = served_count + 1, last_served = ? WHERE id = ?",
+                [(now, line_id) for line_id in served_ids],
+            )
+            # Retire lines that reached the serve cap now, while they are the only rows touched
+            self._approx_lines -= self._conn.execute(
+                f"DELETE FROM pool_lines WHERE id IN ({','.join('?' for _ in served_ids)}) AND served_count >= ?",
+                (*served_ids, MAX_SERVES),
+            ).rowcount
+        pool_lookups.inc(outcome="hit")
+        self.hits += 1
+        outputs = {label: key[4] for label, key in best.items()}
+        ratings = {label: key[1] for label, key in best.items()}
+        return outputs, ratings
+
+    async def alookup(self, features: Dict[str, Any], labels: Iterable[str]) -> Optional[Tuple[Dict[str, str], Dict[str, int]]]:
+        return await asyncio.to_thread(self.lookup, features, list(labels))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM pool_lines")
+            self._approx_lines = 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM pool_lines").fetchone()
+        return count
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            (attrs,) = self._conn.execute("SELECT COUNT(DISTINCT attr) FROM pool_attrs").fetchone()
+        return {
+            "mode": POOL_MODE,
+            "path": self.path,
+            "lines": len(self),
+            "attributes": attrs,
+            "hits": self.hits,
+            "misses": self.misses,
+            "added": self.added,
+        }
+
+
+def resolve_pool_mode(mode: Optional[str] = None) -> str:
+    chosen = (mode or POOL_MODE or "off").strip().lower()
+    if chosen not in POOL_MODES:
+        raise ValueError(f"unknown line pool mode {chosen!r}; expected one of {', '.join(POOL_MODES)}")
+    return chosen
+
+
+line_pool: Optional[LinePool] = LinePool(POOL_PATH) if resolve_pool_mode() != "off" else None
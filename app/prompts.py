@@ -0,0 +1,248 @@
+"""
+Prompt layout and input-token accounting for the graph's LLM calls.
+
+Providers cache the longest prompt prefix they saw recently (OpenAI does it
+for prompts of 1024+ tokens, in 128-token steps), so each prompt puts what
+every call shares first and what varies last:
+
+- Generator and batched-generator system prompts start with the same
+  LINE_GUIDELINES block and contain nothing per style or per request; the
+  style instruction, photo features and lines to avoid go in the user message.
+- The rater system prompt is static; the lines go in the user message.
+
+Features and lines are serialized compactly (features_text, lines_json)
+instead of Python's str(dict), which spends tokens on quotes, brackets and
+empty fields.
+
+Fine-tuned models ("ft:..." such as the default GRAPH_MODEL) were trained on
+the earlier layout, so they keep it byte for byte (BASELINE_* templates, str()
+of features and lines); baseline_layout(model) picks the layout per model.
+
+count_tokens uses tiktoken (installed with langchain-openai) and falls back to
+an estimate when it or its encoding files are unavailable (it downloads them
+on first use). prompt_report() counts the input tokens of every LLM call one
+request makes; bench/prompt_tokens.py prints it.
+"""
+import json
+import logging
+import math
+import re
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+LINE_GUIDELINES = (
+    "Pickup lines should make her feel admired, special, or cherished.\n"
+    "You can add humor in pickup line.\n"
+    "Keep it less logical and more creative.\n"
+    "Avoid clichés unless used playfully. Use warmth, charm, or subtle romance.\n"
+)
+
+GENERATOR_SYSTEM = (
+    LINE_GUIDELINES
+    + "You write a single, short pickup line in the style the user gives.\n"
+    "Only output the pickup line text, no quotes, no JSON."
+)
+GENERATOR_USER = "Style: {style}\nFeatures: {features}{avoid}"
+
+BATCH_SYSTEM = (
+    LINE_GUIDELINES
+    + "You write short pickup lines, exactly one per listed style.\n"
+    "Return strict JSON with keys:\n"
+    "- lines: object mapping label->pickup line text (no quotes)\n"
+)
+BATCH_RATING_KEYS = "- ratings: object mapping label->integer 1-10, rating each line on attractiveness, charm, and respect\n"
+BATCH_USER = "Styles (label: style):\n{styles}\nFeatures: {features}{avoid}"
+
+RATER_SYSTEM = (
+    "You are a woman reading dating app openers.\n"
+    "Rate each line from 1-10 on attractiveness, charm, and respect.\n"
+    "Return strict JSON with keys: \n"
+    "- ratings: object mapping label->integer 1-10\n"
+    "- best_label: string (the best line's label)\n"
+    "- best_line: string"
+)
+RATER_USER = "Lines to rate (JSON): {outputs}"
+
+# The layout before the prefix-first prompts: the style instruction opens the
+# generator's system prompt, and features and lines go in as str(dict)
+BASELINE_GENERATOR_SYSTEM = (
+    "You write a single, short pickup line in the following style: {style}.\n"
+    "It should make her feel admired, special, or cherished.\n"
+    "You can add humor in pickup line.\n"
+    "Keep it less logical and more creative.\n"
+    "Avoid clichés unless used playfully. Use warmth, charm, or subtle romance.\n"
+    "Only output the pickup line text, no quotes, no JSON."
+)
+BASELINE_BATCH_SYSTEM = (
+    "You write short pickup lines, exactly one per requested style.\n"
+    "Each line should make her feel admired, special, or cherished.\n"
+    "You can add humor in pickup line.\n"
+    "Keep it less logical and more creative.\n"
+    "Avoid clichés unless used playfully. Use warmth, charm, or subtle romance.\n"
+    "Styles (label: style):\n{styles}\n"
+    "Return strict JSON with keys:\n"
+    "- lines: object mapping label->pickup line text (no quotes)\n"
+)
+BASELINE_USER = "Features: {features}{avoid}"
+
+# Features keys in the order they are written; any others follow sorted
+FEATURE_KEYS = ("description", "attributes", "vibes")
+
+# OpenAI chat format: each message is wrapped in a few tokens, and the reply is primed with more
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+_PIECE = re.compile(r"[A-Za-z]+|\d{1,3}|[^\sA-Za-z\d]")
+
+
+def baseline_layout(model: Optional[str]) -> bool:
+    """True for fine-tuned models, which keep the prompts they were trained on."""
+    return (model or "").startswith("ft:")
+
+
+def generator_prompt(baseline: bool) -> List[Tuple[str, str]]:
+    if baseline:
+        return [("system", BASELINE_GENERATOR_SYSTEM), ("user", BASELINE_USER)]
+    return [("system", GENERATOR_SYSTEM), ("user", GENERATOR_USER)]
+
+
+def batch_prompt(baseline: bool, rate_inline: bool = False) -> List[Tuple[str, str]]:
+    rating_keys = BATCH_RATING_KEYS if rate_inline else ""
+    if baseline:
+        return [("system", BASELINE_BATCH_SYSTEM + rating_keys), ("user", BASELINE_USER)]
+    return [("system", BATCH_SYSTEM + rating_keys), ("user", BATCH_USER)]
+
+
+def rater_prompt() -> List[Tuple[str, str]]:
+    return [("system", RATER_SYSTEM), ("user", RATER_USER)]
+
+
+def features_input(features: Optional[Dict[str, Any]], baseline: bool) -> Any:
+    """Prompt value for features: the dict itself (rendered with str()) in the baseline layout."""
+    return features if baseline else features_text(features)
+
+
+def lines_input(lines: Dict[str, str], baseline: bool) -> Any:
+    return lines if baseline else lines_json(lines)
+
+
+def features_text(features: Optional[Dict[str, Any]]) -> str:
+    """Canonical one-line-per-key features, skipping empty values: `description: ...\\nattributes: a, b`."""
+    features = features or {}
+    keys = [k for k in FEATURE_KEYS if k in features] + sorted(k for k in features if k not in FEATURE_KEYS)
+    rows = []
+    for key in keys:
+        value = features[key]
+        if isinstance(value, (list, tuple)):
+            value = ", ".join(str(v).strip() for v in value if str(v).strip())
+        elif isinstance(value, dict):
+            value = json.dumps(value, ensure_ascii=False, separators=(",", ":"), sort_keys=True)
+        value = str(value if value is not None else "").strip()
+        if value:
+            rows.append(f"{key}: {value}")
+    return "\n".join(rows)
+
+
+def lines_json(lines: Dict[str, str]) -> str:
+    return json.dumps(lines, ensure_ascii=False, separators=(",", ":"))
+
+
+def avoid_text(lines: Sequence[str]) -> str:
+    if not lines:
+        return ""
+    return "\nWrite something clearly different from these earlier lines: " + json.dumps(list(lines), ensure_ascii=False)
+
+
+@lru_cache(maxsize=16)
+def _encoding(model: str):
+    """tiktoken encoding for `model`, or None when tiktoken or its encoding files are unavailable."""
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        logger.warning("tiktoken encoding for %s unavailable (%s); token counts are estimates", model, e)
+        return None
+
+
+def tokenizer_name(model: str) -> str:
+    encoding = _encoding(model)
+    return encoding.name if encoding is not None else "estimate"
+
+
+def count_tokens(text: str, model: str = "gpt-4o-mini") -> int:
+    encoding = _encoding(model)
+    if encoding is not None:
+        return len(encoding.encode(text))
+    # Roughly what BPE tokenizers do to English: a token per short word, digit group or symbol
+    return sum(max(1, math.ceil(len(piece) / 6)) for piece in _PIECE.findall(text))
+
+
+def message_tokens(messages: Iterable[Tuple[str, str]], model: str = "gpt-4o-mini") -> int:
+    """Input tokens of a chat request with these (role, text) messages."""
+    return sum(TOKENS_PER_MESSAGE + count_tokens(text, model) for _, text in messages) + TOKENS_PER_REPLY
+
+
+def _shared_prefix_tokens(texts: List[str], model: str) -> int:
+    if len(texts) < 2:
+        return 0
+    prefix = texts[0]
+    for text in texts[1:]:
+        end = 0
+        while end < min(len(prefix), len(text)) and prefix[end] == text[end]:
+            end += 1
+        prefix = prefix[:end]
+    return count_tokens(prefix, model)
+
+
+def prompt_report(
+    features: Dict[str, Any],
+    styles: Dict[str, str],
+    mode: str = "fanout",
+    model: str = "gpt-4o-mini",
+    outputs: Optional[Dict[str, str]] = None,
+    baseline: Optional[bool] = None,
+) -> Dict[str, Any]:
+    """
+    Input tokens per LLM call for one request (no retries): one generator per
+    style (fanout) or one batched call, then the rater unless the batched call
+    rates inline. shared_prefix_tokens is how much of the generators' prompts is
+    identical from the start, i.e. what a provider prefix cache can reuse.
+    `baseline` picks the layout; by default it is the one `model` gets.
+    """
+    if baseline is None:
+        baseline = baseline_layout(model)
+    feature_value = features_input(features, baseline)
+
+    def render(prompt: List[Tuple[str, str]], **values: Any) -> List[Tuple[str, str]]:
+        return [(role, template.format(**values)) for role, template in prompt]
+
+    calls: List[Tuple[str, List[Tuple[str, str]]]] = []
+    if mode == "fanout":
+        for label, instruction in styles.items():
+            calls.append((label, render(generator_prompt(baseline), style=instruction, features=feature_value, avoid="")))
+    else:
+        requested = "\n".join(f"- {label}: {instruction}" for label, instruction in styles.items())
+        prompt = batch_prompt(baseline, rate_inline=mode == "batched_rated")
+        calls.append(("generate", render(prompt, styles=requested, features=feature_value, avoid="")))
+    if mode != "batched_rated":
+        lines = outputs or {label: "Your smile just made this beach look overdressed." for label in styles}
+        calls.append(("rate", render(rater_prompt(), outputs=lines_input(lines, baseline))))
+
+    nodes = [{"node": node, "input_tokens": message_tokens(messages, model)} for node, messages in calls]
+    generators = ["\n".join(text for _, text in messages) for node, messages in calls if node in styles]
+    return {
+        "mode": mode,
+        "model": model,
+        "layout": "baseline" if baseline else "prefix_first",
+        "tokenizer": tokenizer_name(model),
+        "nodes": nodes,
+        "input_tokens": sum(n["input_tokens"] for n in nodes),
+        "shared_prefix_tokens": _shared_prefix_tokens(generators, model),
+    }
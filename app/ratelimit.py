@@ -0,0 +1,235 @@
+"""
+OpenAI request/token budgets shared across worker processes.
+
+Two token buckets refill continuously: OPENAI_RPM requests and OPENAI_TPM
+tokens per minute (0 = unlimited). Every LLM call takes one request and an
+estimated OPENAI_TOKENS_PER_CALL tokens before it is sent; the estimate is
+corrected with the reported usage afterwards, so the bucket may briefly go
+negative.
+
+Backends:
+- memory: per process (fine for a single worker)
+- sqlite: one file at RATE_LIMIT_PATH shared by every worker on the host.
+  Updates run in BEGIN IMMEDIATE transactions, so workers never double-spend.
+  Each bucket runs them on its own single thread, so neither a lock wait nor
+  disk I/O blocks the event loop. It is the local stand-in for a Redis-backed
+  bucket in multi-host setups.
+
+Per-model budgets: OPENAI_MODEL_LIMITS_JSON='{"ft:gpt-3.5-turbo": {"rpm": 3500,
+"tpm": 90000}, "gpt-4o-mini": {"rpm": 500}}' gives models matching a prefix
+(longest prefix wins) their own buckets; other models share the
+OPENAI_RPM/OPENAI_TPM buckets.
+"""
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional, Tuple
+
+from app.metrics import metrics
+
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory").strip().lower()
+RATE_LIMIT_PATH = os.getenv("RATE_LIMIT_PATH", ".cache/ratelimit.sqlite3")
+OPENAI_RPM = float(os.getenv("OPENAI_RPM", "0"))
+OPENAI_TPM = float(os.getenv("OPENAI_TPM", "0"))
+TOKENS_PER_CALL = int(os.getenv("OPENAI_TOKENS_PER_CALL", "400"))
+try:
+    MODEL_LIMITS: Dict[str, Dict[str, float]] = json.loads(os.getenv("OPENAI_MODEL_LIMITS_JSON", "{}"))
+except ValueError:
+    MODEL_LIMITS = {}
+# Longest single sleep while waiting for tokens; waits re-check the bucket
+MAX_POLL_S = 0.25
+
+limit_wait_seconds = metrics.histogram(
+    "pickup_rate_limit_wait_seconds", "Time LLM calls waited for the OpenAI token buckets", ("bucket",)
+)
+
+
+class MemoryTokenBucket:
+    """Token bucket holding up to `capacity`, refilled at `rate` per second."""
+
+    def __init__(self, name: str, rate: float, capacity: float):
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def take(self, amount: float) -> float:
+        """Take `amount` if available and return 0, else return the seconds until it will be."""
+        amount = min(amount, self.capacity)
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= amount:
+                self._tokens -= amount
+                return 0.0
+            return (amount - self._tokens) / self.rate
+
+    def adjust(self, delta: float) -> None:
+        """Charge (positive) or refund (negative) tokens after the fact."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = min(self.capacity, self._tokens - delta)
+
+    def level(self) -> float:
+        with self._lock:
+            self._refill(time.monotonic())
+            return self._tokens
+
+    # The event loop's entry points; in-memory updates are cheap enough to run inline
+    async def atake(self, amount: float) -> float:
+        return self.take(amount)
+
+    async def aadjust(self, delta: float) -> None:
+        self.adjust(delta)
+
+
+class SQLiteTokenBucket:
+    """Same contract as MemoryTokenBucket, stored in a SQLite row shared between processes."""
+
+    def __init__(self, path: str, name: str, rate: float, capacity: float):
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=5.0, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        # Transactions on one bucket serialise anyway; a dedicated thread keeps their
+        # busy waits (up to the 5 s timeout) out of the loop and the shared executor
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"bucket-{name}")
+
+    def _update(self, fn) -> Any:
+        # Wall-clock time: monotonic clocks are not comparable across processes
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT tokens, updated_at FROM buckets WHERE name = ?", (self.name,)).fetchone()
+                now = time.time()
+                tokens = self.capacity if row is None else min(self.capacity, row[0] + max(0.0, now - row[1]) * self.rate)
+                tokens, result = fn(tokens)
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO buckets (name, tokens, updated_at) VALUES (?, ?, ?)", (self.name, tokens, now)
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return result
+
+    def take(self, amount: float) -> float:
+        amount = min(amount, self.capacity)
+
+        def take(tokens: float):
+            if tokens >= amount:
+                return tokens - amount, 0.0
+            return tokens, (amount - tokens) / self.rate
+
+        return self._update(take)
+
+    def adjust(self, delta: float) -> None:
+        self._update(lambda tokens: (min(self.capacity, tokens - delta), None))
+
+    def level(self) -> float:
+        return self._update(lambda tokens: (tokens, tokens))
+
+    async def atake(self, amount: float) -> float:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self.take, amount)
+
+    async def aadjust(self, delta: float) -> None:
+        await asyncio.get_running_loop().run_in_executor(self._executor, self.adjust, delta)
+
+
+def _bucket(name: str, per_minute: float):
+    if per_minute <= 0 or RATE_LIMIT_BACKEND in ("off", "none", "disabled"):
+        return None
+    if RATE_LIMIT_BACKEND == "sqlite":
+        return SQLiteTokenBucket(RATE_LIMIT_PATH, name, per_minute / 60.0, per_minute)
+    if RATE_LIMIT_BACKEND == "memory":
+        return MemoryTokenBucket(name, per_minute / 60.0, per_minute)
+    raise ValueError(f"unknown RATE_LIMIT_BACKEND {RATE_LIMIT_BACKEND!r}; expected memory, sqlite or off")
+
+
+class RateLimiter:
+    def __init__(self, requests=None, tokens=None):
+        self.requests = requests
+        self.tokens = tokens
+
+    async def _wait(self, bucket, amount: float) -> None:
+        started = time.perf_counter()
+        while True:
+            wait = await bucket.atake(amount)
+            if wait <= 0:
+                break
+            await asyncio.sleep(min(wait, MAX_POLL_S))
+        limit_wait_seconds.observe(time.perf_counter() - started, bucket=bucket.name)
+
+    async def acquire(self, tokens: int = TOKENS_PER_CALL) -> None:
+        """Wait until one request and `tokens` tokens fit in the budgets."""
+        if self.requests is not None:
+            await self._wait(self.requests, 1)
+        if self.tokens is not None:
+            await self._wait(self.tokens, tokens)
+
+    async def settle(self, estimated: int, resp: Any) -> None:
+        """Correct the token estimate with the usage reported on an AIMessage."""
+        if self.tokens is None:
+            return
+        usage = getattr(resp, "usage_metadata", None) or {}
+        actual = int(usage.get("total_tokens", 0) or 0)
+        if actual:
+            await self.tokens.aadjust(actual - estimated)
+
+    def stats(self) -> Dict[str, Optional[Dict[str, float]]]:
+        return {
+            bucket_name: (
+                {"capacity": bucket.capacity, "per_second": bucket.rate, "available": round(bucket.level(), 2)}
+                if bucket is not None else None
+            )
+            for bucket_name, bucket in (("requests", self.requests), ("tokens", self.tokens))
+        }
+
+
+rate_limiter = RateLimiter(_bucket("openai_rpm", OPENAI_RPM), _bucket("openai_tpm", OPENAI_TPM))
+_model_limiters: Dict[str, RateLimiter] = {}
+_model_limiters_lock = threading.Lock()
+
+
+def limit_group(model: Optional[str]) -> Tuple[str, Optional[Dict[str, float]]]:
+    """(group name, limits) for a model: its longest OPENAI_MODEL_LIMITS_JSON prefix, else the shared default."""
+    matches = [prefix for prefix in MODEL_LIMITS if (model or "").startswith(prefix)]
+    if not matches:
+        return "default", None
+    prefix = max(matches, key=len)
+    return prefix, MODEL_LIMITS[prefix]
+
+
+def limiter_for(model: Optional[str]) -> RateLimiter:
+    group, limits = limit_group(model)
+    if limits is None:
+        return rate_limiter
+    with _model_limiters_lock:
+        limiter = _model_limiters.get(group)
+        if limiter is None:
+            limiter = _model_limiters[group] = RateLimiter(
+                _bucket(f"{group}:rpm", float(limits.get("rpm", 0))),
+                _bucket(f"{group}:tpm", float(limits.get("tpm", 0))),
+            )
+    return limiter
+
+
+def all_stats() -> Dict[str, Any]:
+    with _model_limiters_lock:
+        limiters = dict(_model_limiters)
+    return {"default": rate_limiter.stats(), **{group: limiter.stats() for group, limiter in sorted(limiters.items())}}
@@ -0,0 +1,158 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterable, List, Optional, Tuple
+
+from app.graph import build_pickup_graph, resolve_mode
+from app.styles import style_registry
+
+
+class WarmKeyStore:
+    """
+    Registry keys recently built by any worker, kept in SQLite so a freshly
+    started worker can compile the same graphs before taking traffic. Compiled
+    graphs hold clients and locks and cannot be shared between processes; the
+    keys are what workers share.
+    """
+
+    def __init__(self, path: str, max_keys: int = 8):
+        self.path = path
+        self.max_keys = max(1, max_keys)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=5.0, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS warm_keys (key TEXT PRIMARY KEY, used_at REAL NOT NULL)")
+
+    def record(self, key: Tuple) -> None:
+        blob = json.dumps(
+            {"model": key[0], "vision_model": key[1], "temperature": key[2], "styles": list(key[3]), "mode": key[4]},
+            sort_keys=True,
+        )
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO warm_keys (key, used_at) VALUES (?, ?)", (blob, time.time()))
+            self._conn.execute(
+                "DELETE FROM warm_keys WHERE key NOT IN (SELECT key FROM warm_keys ORDER BY used_at DESC LIMIT ?)",
+                (self.max_keys,),
+            )
+
+    def recent(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = self._conn.execute("SELECT key FROM warm_keys ORDER BY used_at DESC LIMIT ?", (self.max_keys,)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+
+class GraphRegistry:
+    """
+    Process-wide LRU of compiled pickup graphs.
+
+    Building a graph creates one ChatOpenAI client per node (each with its own
+    HTTP connection pool) and recompiles the StateGraph, so we keep compiled
+    graphs around keyed by everything that changes their shape or clients.
+    """
+
+    def __init__(self, max_size: int = 8, warm_keys: Optional[WarmKeyStore] = None):
+        self.max_size = max(1, max_size)
+        self.warm_keys = warm_keys
+        self._graphs: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.builds = 0
+        self.build_seconds_total = 0.0
+        self.build_seconds_last = 0.0
+
+    @staticmethod
+    def make_key(
+        model: Optional[str],
+        temperature: Optional[float],
+        vision_model: Optional[str] = None,
+        mode: Optional[str] = None,
+        styles: Optional[Iterable[str]] = None,
+    ) -> Tuple:
+        vision_model = vision_model or os.getenv("OPENAI_VISION_MODEL") or model or "gpt-4o-mini"
+        temperature = float(temperature) if temperature is not None else None
+        # One compiled graph per style subset (registry order, so the same subset always hits)
+        return (model, vision_model, temperature, style_registry.resolve(styles), resolve_mode(mode))
+
+    def get(
+        self,
+        model: Optional[str] = None,
+        temperature: Optional[float] = None,
+        vision_model: Optional[str] = None,
+        mode: Optional[str] = None,
+        styles: Optional[Iterable[str]] = None,
+    ):
+        key = self.make_key(model, temperature, vision_model, mode, styles)
+        with self._lock:
+            graph = self._graphs.get(key)
+            if graph is not None:
+                self._graphs.move_to_end(key)
+                self.hits += 1
+                return graph
+            self.misses += 1
+
+        # Build outside the lock; a concurrent miss on the same key may build twice,
+        # which is harmless (last one wins) and keeps other keys from blocking.
+        started = time.perf_counter()
+        graph = build_pickup_graph(model=key[0], temperature=key[2], vision_model=key[1], mode=key[4], styles=key[3])
+        elapsed = time.perf_counter() - started
+
+        with self._lock:
+            self.builds += 1
+            self.build_seconds_total += elapsed
+            self.build_seconds_last = elapsed
+            self._graphs[key] = graph
+            self._graphs.move_to_end(key)
+            while len(self._graphs) > self.max_size:
+                self._graphs.popitem(last=False)
+                self.evictions += 1
+        if self.warm_keys is not None:
+            self.warm_keys.record(key)
+        return graph
+
+    def clear(self) -> None:
+        with self._lock:
+            self._graphs.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._graphs),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+                "evictions": self.evictions,
+                "builds": self.builds,
+                "build_seconds_total": round(self.build_seconds_total, 6),
+                "build_seconds_last": round(self.build_seconds_last, 6),
+                "keys": [
+                    {"model": k[0], "vision_model": k[1], "temperature": k[2], "styles": list(k[3]), "mode": k[4]}
+                    for k in self._graphs.keys()
+                ],
+            }
+
+
+_REGISTRY_SIZE = int(os.getenv("GRAPH_REGISTRY_SIZE", "8"))
+_WARM_KEYS_PATH = os.getenv("GRAPH_WARMUP_KEYS_PATH")
+
+graph_registry = GraphRegistry(
+    max_size=_REGISTRY_SIZE,
+    warm_keys=WarmKeyStore(_WARM_KEYS_PATH, max_keys=_REGISTRY_SIZE) if _WARM_KEYS_PATH else None,
+)
+
+
+def get_pickup_graph(
+    model: Optional[str] = None,
+    temperature: Optional[float] = None,
+    vision_model: Optional[str] = None,
+    mode: Optional[str] = None,
+    styles: Optional[Iterable[str]] = None,
+):
+    return graph_registry.get(model=model, temperature=temperature, vision_model=vision_model, mode=mode, styles=styles)
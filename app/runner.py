@@ -0,0 +1,566 @@
+import math
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+
+from app.cache import response_cache
+from app.diversity import duplicate_lines, find_duplicates, recent_lines, shingle
+from app.graph import STYLES, graph_run_config
+from app.images import ImagePayload, ImageTooLarge, UploadedImage, preprocess_image_async
+from app.latency import DeadlineExceeded
+from app.metrics import graph_llm_calls, graph_runs, graph_seconds
+from app.pool import line_pool, resolve_pool_mode
+from app.registry import get_pickup_graph, graph_registry
+from app.scheduler import LLMRateLimited
+from app.scoring import resolve_rater_mode
+from app.schemas import GraphGenerateRequest, GraphGenerateResponse, SessionMoreRequest
+from app.sessions import SESSION_AVOID_LINES, session_store
+from app.styles import style_registry
+
+# Fine-tuned model used by /v1/generate-graph
+GRAPH_MODEL = "ft:gpt-3.5-turbo-1106:manav::C8AMBoyU"
+DEFAULT_TEMPERATURE = 0.5
+CACHE_CONTROLS = ("default", "bypass", "refresh")
+NO_LINE_IN_TIME = "deadline_exceeded: no line finished before the deadline"
+
+
+def default_image_model() -> str:
+    return os.getenv("OPENAI_TEXT_MODEL") or "gpt-4o-mini"
+
+
+@dataclass
+class GraphRun:
+    """Everything needed to execute (or replay from cache) one graph request."""
+
+    graph: Any
+    state_in: Dict[str, Any]
+    config: Dict[str, Any]
+    cache_key: Optional[str] = None
+    cache_control: str = "default"
+    metadata: Dict[str, Any] = field(default_factory=dict)
+    debug: bool = False
+    # Style labels this run generates
+    styles: Tuple[str, ...] = ()
+    # Lines served to this user are remembered so later requests do not repeat them
+    user_id: Optional[str] = None
+    # Set for /v1/sessions/{id}/more runs: the result is added to that session instead of opening one
+    session_id: Optional[str] = None
+    # Batch runs open no session: nobody asks for more lines, and they would evict users' sessions
+    open_session: bool = True
+    # Image runs look the response cache up before preprocessing the upload; this
+    # is that lookup's result, so run_graph/stream_graph do not repeat it
+    cache_checked: bool = False
+    cached: Optional[Tuple[GraphGenerateResponse, Optional[Dict[str, Any]]]] = None
+    # (outputs, ratings) of a partial line pool hit; the graph then writes only the other styles
+    pooled: Optional[Tuple[Dict[str, str], Dict[str, int]]] = None
+
+
+def _graph_for(model: str, temperature: float, mode: Optional[str], styles: Tuple[str, ...]):
+    try:
+        return get_pickup_graph(model=model, temperature=temperature, mode=mode, styles=styles)
+    except ValueError as e:
+        # Unknown graph mode
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def _styles(requested: Optional[List[str]]) -> Tuple[str, ...]:
+    try:
+        return style_registry.resolve(requested)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def _rater_mode(rater: Optional[str]) -> str:
+    try:
+        return resolve_rater_mode(rater)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def _response_cache_key(
+    source: Dict[str, Any],
+    model: str,
+    temperature: float,
+    mode: Optional[str],
+    styles: Tuple[str, ...],
+) -> Optional[str]:
+    """Cache key for a generation, or None when the request should not be cached."""
+    if not response_cache.cacheable(temperature):
+        return None
+    graph_key = graph_registry.make_key(model, temperature, mode=mode, styles=styles)
+    return response_cache.make_key(source, graph=list(graph_key))
+
+
+def _seconds(ms: Optional[int]) -> Optional[float]:
+    # None keeps the env default in graph_run_config
+    return ms / 1000.0 if ms is not None else None
+
+
+async def prepare_features_run(
+    payload: GraphGenerateRequest,
+    route: str = "/v1/generate-graph",
+    priority: str = "interactive",
+) -> GraphRun:
+    # Choose model/temperature: prefer explicit override; otherwise use a safe base model for LangGraph
+    chosen_model = GRAPH_MODEL
+    chosen_temp = payload.temperature if payload.temperature is not None else DEFAULT_TEMPERATURE
+    styles = _styles(payload.styles)
+    app_graph = _graph_for(chosen_model, chosen_temp, payload.mode, styles)
+    rater_mode = _rater_mode(payload.rater)
+    state_in = {"features": payload.features.model_dump()}
+    cache_key = _response_cache_key(
+        {
+            "features": state_in["features"],
+            "retry": [payload.retry_threshold, payload.max_attempts, payload.latency_budget_ms],
+            "rater": rater_mode,
+        },
+        chosen_model,
+        chosen_temp,
+        payload.mode,
+        styles,
+    )
+    metadata = {
+        "route": route,
+        "model": chosen_model,
+        "temperature": chosen_temp,
+        "mode": payload.mode,
+    }
+    config = graph_run_config(
+        tags=["graph", "from-features"],
+        metadata=metadata,
+        retry_threshold=payload.retry_threshold,
+        max_attempts=payload.max_attempts,
+        retry_budget_s=_seconds(payload.latency_budget_ms),
+        deadline_s=_seconds(payload.deadline_ms),
+        hedge=payload.hedge,
+        rater_mode=rater_mode,
+        priority=priority,
+        history=await recent_lines.aget(payload.user_id),
+    )
+    return GraphRun(
+        app_graph, state_in, config, cache_key, payload.cache_control, metadata, payload.debug,
+        styles=styles, user_id=payload.user_id, open_session=priority != "batch",
+    )
+
+
+async def prepare_image_run(
+    upload: UploadedImage,
+    content_type: Optional[str],
+    model_text: Optional[str] = None,
+    temperature: Optional[float] = None,
+    mode: Optional[str] = None,
+    retry_threshold: Optional[int] = None,
+    max_attempts: Optional[int] = None,
+    latency_budget_ms: Optional[int] = None,
+    deadline_ms: Optional[int] = None,
+    hedge: Optional[bool] = None,
+    rater: Optional[str] = None,
+    styles: Optional[List[str]] = None,
+    cache_control: str = "default",
+    route: str = "/v1/generate-graph-from-image",
+    debug: bool = False,
+    user_id: Optional[str] = None,
+) -> GraphRun:
+    if cache_control not in CACHE_CONTROLS:
+        raise HTTPException(status_code=400, detail=f"cache_control must be one of {', '.join(CACHE_CONTROLS)}")
+
+    chosen_model = model_text or default_image_model()
+    chosen_temp = temperature if temperature is not None else DEFAULT_TEMPERATURE
+
+    selected = _styles(styles)
+    app_graph = _graph_for(chosen_model, chosen_temp, mode, selected)
+    rater_mode = _rater_mode(rater)
+    # Key on the original upload so hits do not depend on preprocessing settings
+    cache_key = _response_cache_key(
+        {
+            "image_sha256": upload.digest,
+            "retry": [retry_threshold, max_attempts, latency_budget_ms],
+            "rater": rater_mode,
+        },
+        chosen_model,
+        chosen_temp,
+        mode,
+        selected,
+    )
+
+    metadata = {
+        "route": route,
+        "model": chosen_model,
+        "temperature": chosen_temp,
+        "mode": mode,
+        "mime_type": content_type,
+        "upload_bytes": upload.size,
+    }
+    config = graph_run_config(
+        tags=["graph", "from-image"],
+        metadata=metadata,
+        retry_threshold=retry_threshold,
+        max_attempts=max_attempts,
+        retry_budget_s=_seconds(latency_budget_ms),
+        deadline_s=_seconds(deadline_ms),
+        hedge=hedge,
+        rater_mode=rater_mode,
+        history=await recent_lines.aget(user_id),
+    )
+    run = GraphRun(app_graph, {}, config, cache_key, cache_control, metadata, debug, styles=selected, user_id=user_id)
+    # A repeat upload is answered from the cache without decoding the image at all
+    run.cached, run.cache_checked = await _cached_response(run), True
+    if run.cached is not None:
+        return run
+
+    # Downsample/strip/re-encode off the event loop before the vision call
+    try:
+        # Pillow reads the spooled upload directly; the whole upload is never one bytes object
+        image_bytes, mime_type = await preprocess_image_async(upload.file, content_type)
+    except ImageTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    run.state_in = {
+        # A handle, so the graph passes the image by reference and frees it after describe
+        "image": ImagePayload(image_bytes, mime_type),
+        # Allow features passthrough if you later extend with extra form fields
+        "features": {},
+    }
+    metadata["sent_bytes"] = len(image_bytes)
+    return run
+
+
+async def prepare_session_run(
+    session_id: str,
+    payload: SessionMoreRequest,
+    route: str = "/v1/sessions/{session_id}/more",
+) -> GraphRun:
+    """
+    New lines for an open session: the stored features skip the vision call,
+    and the session's lines are avoided in the prompt and de-duplicated against.
+    """
+    session = await session_store.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired session")
+    settings = session.get("settings", {})
+    styles = _styles(payload.styles or settings.get("styles"))
+    app_graph = _graph_for(settings["model"], settings["temperature"], settings.get("mode"), styles)
+    rater_mode = _rater_mode(payload.rater or settings.get("rater"))
+    lines = session.get("lines", {})
+    user_id = settings.get("user_id")
+    metadata = {
+        "route": route,
+        "model": settings["model"],
+        "temperature": settings["temperature"],
+        "mode": settings.get("mode"),
+        "session_id": session_id,
+    }
+    config = graph_run_config(
+        tags=["graph", "session-more"],
+        metadata=metadata,
+        deadline_s=_seconds(payload.deadline_ms),
+        hedge=payload.hedge,
+        rater_mode=rater_mode,
+        history=tuple(shingle(line) for served in lines.values() for line in served) + await recent_lines.aget(user_id),
+        avoid={label: lines.get(label, [])[-SESSION_AVOID_LINES:] for label in styles if lines.get(label)},
+    )
+    # Every call should bring new lines, so the response cache and line pool are skipped
+    return GraphRun(
+        app_graph, {"features": session["features"]}, config, None, "bypass", metadata, payload.debug,
+        styles=styles, user_id=user_id, session_id=session_id,
+    )
+
+
+def _repeats_history(run: GraphRun, outputs: Dict[str, str]) -> bool:
+    """True when stored lines repeat ones this user was recently served, so they are generated afresh."""
+    history = run.config.get("configurable", {}).get("history")
+    if not history or not find_duplicates(outputs, history):
+        return False
+    duplicate_lines.inc(source="cache")
+    return True
+
+
+async def _cached_response(run: GraphRun) -> Optional[Tuple[GraphGenerateResponse, Optional[Dict[str, Any]]]]:
+    """
+    (response, features) from the response cache. cache_control: "default" serves
+    from and fills the cache, "refresh" skips the lookup but stores the fresh
+    result, "bypass" neither reads nor writes.
+    """
+    if run.cache_key and run.cache_control == "default":
+        cached = await response_cache.get(run.cache_key)
+        if cached is not None and not _repeats_history(run, cached.get("outputs") or {}):
+            graph_runs.inc(route=run.metadata.get("route", ""), outcome="cache_hit")
+            response = GraphGenerateResponse(**{**cached, "llm_calls": 0, "timings": None, "hedged": [], "source": "cache"})
+            return response, cached.get("features")
+    elif run.cache_key:
+        response_cache.bypasses += 1
+    return None
+
+
+async def _pooled_response(run: GraphRun) -> Optional[GraphGenerateResponse]:
+    """
+    Answer a features request from the line pool (LINE_POOL_MODE=serve) when it
+    covers every style. A partial hit (LINE_POOL_MIN_COVERAGE < 1) keeps the
+    pooled lines on the run and narrows its graph to the missing styles.
+    """
+    features = run.state_in.get("features")
+    if line_pool is None or resolve_pool_mode() != "serve" or run.cache_control != "default" or not features:
+        return None
+    labels = run.styles or STYLES
+    pooled = await line_pool.alookup(features, labels)
+    if pooled is None or _repeats_history(run, pooled[0]):
+        return None
+    missing = tuple(label for label in labels if label not in pooled[0])
+    if missing:
+        run.pooled = pooled
+        run.graph = _graph_for(run.metadata["model"], run.metadata["temperature"], run.metadata.get("mode"), missing)
+        return None
+    outputs, ratings = pooled
+    best_label = _best_label(outputs, ratings)
+    graph_runs.inc(route=run.metadata.get("route", ""), outcome="pool")
+    return GraphGenerateResponse(
+        outputs=outputs,
+        ratings=ratings,
+        best_label=best_label,
+        best_line=outputs[best_label],
+        source="pool",
+    )
+
+
+def _best_label(outputs: Dict[str, str], ratings: Dict[str, int]) -> str:
+    return max(outputs, key=lambda label: (ratings.get(label, 0), len(outputs[label])))
+
+
+def _with_pooled(run: GraphRun, response: GraphGenerateResponse) -> GraphGenerateResponse:
+    """Merge a partial pool hit's lines into the graph's response for the missing styles."""
+    if run.pooled is None:
+        return response
+    pooled_outputs, pooled_ratings = run.pooled
+    merged = {**pooled_outputs, **{label: line for label, line in response.outputs.items() if line}}
+    merged_ratings = {**pooled_ratings, **response.ratings}
+    outputs = {label: merged[label] for label in run.styles or STYLES if label in merged}
+    ratings = {label: merged_ratings.get(label, 0) for label in outputs}
+    best_label = _best_label(outputs, ratings) if outputs else ""
+    return response.model_copy(update={
+        "outputs": outputs,
+        "ratings": ratings,
+        "best_label": best_label,
+        "best_line": outputs.get(best_label, ""),
+    })
+
+
+async def _replayed_response(run: GraphRun) -> Optional[GraphGenerateResponse]:
+    """A response cache or line pool answer, remembered and opened as a session like a graph result."""
+    cached = run.cached if run.cache_checked else await _cached_response(run)
+    if cached is not None:
+        response, features = cached
+    else:
+        response, features = await _pooled_response(run), run.state_in.get("features")
+    if response is not None:
+        await _served(run, response, features)
+    return response
+
+
+async def _fill_pool(run: GraphRun, result: Dict[str, Any], response: GraphGenerateResponse) -> None:
+    if line_pool is not None and not response.dropped:
+        await line_pool.aadd(result.get("features") or run.state_in.get("features") or {}, response.outputs, response.ratings)
+
+
+async def _store_response(run: GraphRun, response: GraphGenerateResponse, features: Optional[Dict[str, Any]]) -> None:
+    # Deadline-degraded results are not worth replaying to later requests
+    if run.cache_key and run.cache_control != "bypass" and not response.dropped:
+        # Features are kept so a cache hit can still open a session
+        await response_cache.set(run.cache_key, {**response.model_dump(exclude={"timings", "session_id"}), "features": features})
+
+
+async def _served(run: GraphRun, response: GraphGenerateResponse, features: Optional[Dict[str, Any]]) -> None:
+    """Remember the lines for the user and add them to the run's session, or open one."""
+    await recent_lines.aadd(run.user_id, response.outputs.values())
+    if run.session_id:
+        await session_store.record(run.session_id, response.outputs, response.ratings)
+        response.session_id = run.session_id
+        return
+    if not run.open_session:
+        return
+    settings = {
+        "model": run.metadata.get("model"),
+        "temperature": run.metadata.get("temperature"),
+        "mode": run.metadata.get("mode"),
+        "rater": run.config.get("configurable", {}).get("rater_mode"),
+        "styles": list(run.styles),
+        "user_id": run.user_id,
+    }
+    response.session_id = await session_store.create(features, settings, response.outputs, response.ratings)
+
+
+def _timings_block(result: Dict[str, Any], total_seconds: float) -> Dict[str, Any]:
+    nodes = result.get("timings", []) or []
+    return {
+        "total_seconds": round(total_seconds, 6),
+        "nodes": nodes,
+        "input_tokens": sum(n.get("input_tokens", 0) for n in nodes),
+        "output_tokens": sum(n.get("output_tokens", 0) for n in nodes),
+        "cost_usd": round(sum(n.get("cost_usd", 0.0) for n in nodes), 8),
+    }
+
+
+async def _finish_run(run: GraphRun, result: Dict[str, Any], started: float) -> GraphGenerateResponse:
+    elapsed = time.perf_counter() - started
+    route = run.metadata.get("route", "")
+    graph_runs.inc(route=route, outcome="ok")
+    graph_seconds.observe(elapsed, route=route)
+    graph_llm_calls.inc(result.get("llm_calls", 0), route=route)
+
+    response = _with_pooled(run, response_from_state(result))
+    features = result.get("features") or run.state_in.get("features")
+    await _store_response(run, response, features)
+    await _fill_pool(run, result, response)
+    await _served(run, response, features)
+    if run.debug:
+        response.timings = _timings_block(result, elapsed)
+    return response
+
+
+def response_from_state(result: Dict[str, Any]) -> GraphGenerateResponse:
+    outputs = result.get("outputs", {}) or {}
+    ratings = result.get("ratings", {}) or {}
+    best_label = result.get("best_label", "")
+    best_line = result.get("best_line", outputs.get(best_label, ""))
+    return GraphGenerateResponse(
+        outputs=outputs,
+        ratings=ratings,
+        best_label=best_label,
+        best_line=best_line,
+        llm_calls=result.get("llm_calls", 0),
+        dropped=sorted(result.get("dropped", {}) or {}),
+        hedged=sorted(set(result.get("hedged", []) or [])),
+    )
+
+
+async def run_graph(run: GraphRun) -> GraphGenerateResponse:
+    """Run a prepared graph request (or serve it from the response cache or line pool)."""
+    cached = await _replayed_response(run)
+    if cached is not None:
+        return cached
+
+    started = time.perf_counter()
+    try:
+        result = await run.graph.ainvoke(run.state_in, config=run.config)
+    except DeadlineExceeded:
+        graph_runs.inc(route=run.metadata.get("route", ""), outcome="deadline")
+        raise HTTPException(status_code=504, detail="deadline_exceeded: image description did not finish in time")
+    except LLMRateLimited as e:
+        graph_runs.inc(route=run.metadata.get("route", ""), outcome="rate_limited")
+        raise _rate_limited_error(e.retry_after)
+    except Exception as e:
+        graph_runs.inc(route=run.metadata.get("route", ""), outcome="error")
+        # Surface error to client for debugging
+        raise HTTPException(status_code=500, detail=f"graph_error: {e}")
+
+    if _all_dropped(result, "rate_limited"):
+        graph_runs.inc(route=run.metadata.get("route", ""), outcome="rate_limited")
+        raise _rate_limited_error(None)
+    if _all_dropped(result, "deadline"):
+        graph_runs.inc(route=run.metadata.get("route", ""), outcome="deadline")
+        raise HTTPException(status_code=504, detail=NO_LINE_IN_TIME)
+    return await _finish_run(run, result, started)
+
+
+def _all_dropped(result: Dict[str, Any], reason: str) -> bool:
+    """No line was produced and at least one generator was dropped for `reason`."""
+    return not any((result.get("outputs") or {}).values()) and reason in (result.get("dropped") or {}).values()
+
+
+def _rate_limited_error(retry_after: Optional[float]) -> HTTPException:
+    headers = {"Retry-After": str(max(1, math.ceil(retry_after)))} if retry_after else None
+    return HTTPException(status_code=429, detail="rate_limited: OpenAI rate limit reached, retry later", headers=headers)
+
+
+def _merge_update(state: Dict[str, Any], update: Dict[str, Any]) -> None:
+    """Apply a node update to an accumulated state using the GraphState reducers."""
+    for key, value in update.items():
+        if key in ("outputs", "ratings", "attempts", "rated", "dropped"):
+            state[key] = {**(state.get(key) or {}), **(value or {})}
+        elif key == "llm_calls":
+            state[key] = state.get(key, 0) + (value or 0)
+        elif key in ("timings", "hedged"):
+            state[key] = (state.get(key) or []) + list(value or [])
+        elif key != "image":
+            state[key] = value
+
+
+async def stream_graph(run: GraphRun, tokens: bool = False) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Yield events as the graph progresses:
+      {"event": "features", "features": {...}}         after the describe node
+      {"event": "token", "label": ..., "delta": ...}    generator tokens (tokens=True, fanout mode only)
+      {"event": "line", "label": ..., "line": ..., "attempt": n}  each line as its node finishes
+      {"event": "dropped", "label": ..., "reason": "deadline"}  a style (or "rate") missed the deadline
+      {"event": "ratings", "ratings": {...}, "best_label": ..., "best_line": ...}
+      {"event": "done", ...GraphGenerateResponse}       final result
+      {"event": "error", "detail": ...}                 on failure (stream ends)
+    """
+    cached = await _replayed_response(run)
+    if cached is not None:
+        for label, line in cached.outputs.items():
+            yield {"event": "line", "label": label, "line": line, "attempt": 1, "cached": True}
+        yield {"event": "ratings", "ratings": cached.ratings, "best_label": cached.best_label, "best_line": cached.best_line}
+        yield {"event": "done", **cached.model_dump()}
+        return
+
+    for label, line in (run.pooled or ({}, {}))[0].items():
+        yield {"event": "line", "label": label, "line": line, "attempt": 1, "pooled": True}
+
+    stream_mode = ["updates", "messages"] if tokens else ["updates"]
+    state: Dict[str, Any] = {}
+    started = time.perf_counter()
+    try:
+        async for mode, chunk in run.graph.astream(run.state_in, config=run.config, stream_mode=stream_mode):
+            if mode == "messages":
+                message, meta = chunk
+                label = (meta or {}).get("langgraph_node")
+                delta = getattr(message, "content", "")
+                if label in (run.styles or STYLES) and delta:
+                    yield {"event": "token", "label": label, "delta": delta}
+                continue
+
+            for node, update in (chunk or {}).items():
+                update = update or {}
+                _merge_update(state, update)
+                if node == "describe" and "image" in run.state_in:
+                    yield {"event": "features", "features": update.get("features", {})}
+                attempts = update.get("attempts", {}) or {}
+                for label, line in (update.get("outputs", {}) or {}).items():
+                    yield {"event": "line", "label": label, "line": line, "attempt": attempts.get(label, 1)}
+                for label, reason in (update.get("dropped", {}) or {}).items():
+                    yield {"event": "dropped", "label": label, "reason": reason}
+                if "ratings" in update:
+                    yield {
+                        "event": "ratings",
+                        "ratings": state.get("ratings", {}),
+                        "best_label": state.get("best_label", ""),
+                        "best_line": state.get("best_line", ""),
+                    }
+    except DeadlineExceeded:
+        graph_runs.inc(route=run.metadata.get("route", ""), outcome="deadline")
+        yield {"event": "error", "detail": "deadline_exceeded: image description did not finish in time"}
+        return
+    except LLMRateLimited:
+        graph_runs.inc(route=run.metadata.get("route", ""), outcome="rate_limited")
+        yield {"event": "error", "detail": "rate_limited: OpenAI rate limit reached, retry later"}
+        return
+    except Exception as e:
+        graph_runs.inc(route=run.metadata.get("route", ""), outcome="error")
+        yield {"event": "error", "detail": f"graph_error: {e}"}
+        return
+
+    if _all_dropped(state, "rate_limited"):
+        graph_runs.inc(route=run.metadata.get("route", ""), outcome="rate_limited")
+        yield {"event": "error", "detail": "rate_limited: OpenAI rate limit reached, retry later"}
+        return
+    if _all_dropped(state, "deadline"):
+        graph_runs.inc(route=run.metadata.get("route", ""), outcome="deadline")
+        yield {"event": "error", "detail": NO_LINE_IN_TIME}
+        return
+    response = await _finish_run(run, state, started)
+    yield {"event": "done", **response.model_dump()}
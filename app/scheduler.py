@@ -0,0 +1,285 @@
+"""
+Process-wide scheduler for OpenAI calls.
+
+Every graph LLM call goes through llm_scheduler.call(), which per limit group
+(model prefix from OPENAI_MODEL_LIMITS_JSON, else "default"):
+
+1. waits for a concurrency slot. Waiters queue by priority: "interactive"
+   (API requests) is always served before "batch" (app.batch runs).
+2. waits for the group's RPM/TPM token buckets (app.ratelimit).
+3. makes the call. A 429, 5xx or connection error is retried up to
+   LLM_MAX_RETRIES times. The wait is the server's retry-after(-ms) header,
+   else exponential backoff with jitter. While a retry-after is pending, the
+   whole group waits, not just the failed call. The OpenAI client's own
+   retries are turned off (see app.graph._build_llm) so the scheduler sees
+   every 429.
+
+The concurrency limit adapts with AIMD. A success adds 1/limit, which is
+about +1 per round trip of a full window. A 429 multiplies the limit by
+LLM_AIMD_BACKOFF. So does a call slower than LLM_AIMD_LATENCY_FACTOR times
+the recent minimum latency of calls of the same kind and model: a batched
+generator or rater call is compared with other batched or rater calls, not
+with single-style generators. Decreases happen at most once per
+LLM_AIMD_COOLDOWN_S.
+"""
+import asyncio
+import email.utils
+import os
+import random
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Tuple
+
+from app.metrics import metrics
+from app.ratelimit import TOKENS_PER_CALL, limit_group, limiter_for
+
+PRIORITIES = ("interactive", "batch")
+CONCURRENCY_INITIAL = int(os.getenv("LLM_CONCURRENCY_INITIAL", "32"))
+CONCURRENCY_MIN = int(os.getenv("LLM_CONCURRENCY_MIN", "2"))
+CONCURRENCY_MAX = int(os.getenv("LLM_CONCURRENCY_MAX", "256"))
+AIMD_BACKOFF = float(os.getenv("LLM_AIMD_BACKOFF", "0.5"))
+# 0 turns off latency-driven decreases (429s still back off)
+AIMD_LATENCY_FACTOR = float(os.getenv("LLM_AIMD_LATENCY_FACTOR", "3.0"))
+AIMD_COOLDOWN_S = float(os.getenv("LLM_AIMD_COOLDOWN_S", "1.0"))
+AIMD_WINDOW = 100
+AIMD_MIN_SAMPLES = 20
+MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+RETRY_BASE_S = float(os.getenv("LLM_RETRY_BASE_S", "0.5"))
+RETRY_MAX_S = float(os.getenv("LLM_RETRY_MAX_S", "20"))
+
+llm_retries = metrics.counter("pickup_llm_retries_total", "LLM calls retried by the scheduler", ("group", "reason"))
+llm_rate_limited = metrics.counter("pickup_llm_rate_limited_total", "429 responses from OpenAI", ("group",))
+llm_queue_wait = metrics.histogram(
+    "pickup_llm_queue_wait_seconds", "Time LLM calls waited for a concurrency slot", ("group", "priority")
+)
+
+
+class LLMRateLimited(Exception):
+    """OpenAI kept answering 429 after the scheduler's retries."""
+
+    def __init__(self, group: str, retry_after: Optional[float] = None):
+        super().__init__(f"OpenAI rate limit reached for {group}")
+        self.group = group
+        self.retry_after = retry_after
+
+
+def _header(error: BaseException, name: str) -> Optional[str]:
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    return headers.get(name) if headers is not None else None
+
+
+def retry_after_seconds(error: BaseException) -> Optional[float]:
+    """Server-requested wait from retry-after-ms / retry-after (seconds or HTTP date), if any."""
+    value = _header(error, "retry-after-ms")
+    if value:
+        try:
+            return max(0.0, float(value) / 1000.0)
+        except ValueError:
+            pass
+    value = _header(error, "retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        parsed = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, parsed.timestamp() - time.time())
+
+
+def retry_reason(error: BaseException) -> Optional[str]:
+    """Why an error is worth retrying ("rate_limited", "server_error", "connection"), or None."""
+    # Already loaded by the time a call fails; importing it at startup costs half a second
+    import openai
+
+    if isinstance(error, openai.RateLimitError):
+        # An exhausted quota does not recover by waiting
+        return None if getattr(error, "code", None) == "insufficient_quota" else "rate_limited"
+    if isinstance(error, openai.APIStatusError):
+        return "server_error" if error.status_code >= 500 else None
+    if isinstance(error, openai.APIConnectionError):
+        return "connection"
+    return None
+
+
+class AdaptiveLimit:
+    """AIMD concurrency limit with strict-priority waiter queues for one limit group."""
+
+    def __init__(
+        self,
+        initial: int = CONCURRENCY_INITIAL,
+        minimum: int = CONCURRENCY_MIN,
+        maximum: int = CONCURRENCY_MAX,
+    ):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = float(min(self.maximum, max(self.minimum, initial)))
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self._waiters: Dict[str, Deque[asyncio.Future]] = {p: deque() for p in PRIORITIES}
+        # Recent latencies per call kind + model, each the baseline for its own calls
+        self._latencies: Dict[str, Deque[float]] = {}
+        self._last_decrease = 0.0
+        self.decreases = 0
+
+    def queued(self, priority: str) -> int:
+        return sum(1 for f in self._waiters[priority] if not f.done())
+
+    async def acquire(self, priority: str) -> None:
+        if self.in_flight < int(self.limit) and not any(self.queued(p) for p in PRIORITIES):
+            self.in_flight += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[priority].append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just as we were cancelled; pass it on
+                self.release()
+            raise
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        self._wake()
+
+    def _wake(self) -> None:
+        # Slots are handed over with in_flight already counted
+        for priority in PRIORITIES:
+            queue = self._waiters[priority]
+            while queue and self.in_flight < int(self.limit):
+                future = queue.popleft()
+                if not future.done():
+                    self.in_flight += 1
+                    future.set_result(None)
+
+    def _decrease(self) -> None:
+        now = time.monotonic()
+        if now - self._last_decrease < AIMD_COOLDOWN_S:
+            return
+        self._last_decrease = now
+        self.limit = max(float(self.minimum), self.limit * AIMD_BACKOFF)
+        self.decreases += 1
+
+    def on_success(self, seconds: float, kind: str = "") -> None:
+        latencies = self._latencies.get(kind)
+        if latencies is None:
+            latencies = self._latencies[kind] = deque(maxlen=AIMD_WINDOW)
+        latencies.append(seconds)
+        if (
+            AIMD_LATENCY_FACTOR > 0
+            and len(latencies) >= AIMD_MIN_SAMPLES
+            and seconds > AIMD_LATENCY_FACTOR * min(latencies)
+        ):
+            self._decrease()
+        else:
+            self.limit = min(float(self.maximum), self.limit + 1.0 / self.limit)
+        self._wake()
+
+    def on_overload(self, retry_after: Optional[float]) -> None:
+        self._decrease()
+        if retry_after:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limit": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "queued": {p: self.queued(p) for p in PRIORITIES},
+            "decreases": self.decreases,
+            "blocked_for_s": round(max(0.0, self.blocked_until - time.monotonic()), 3),
+        }
+
+
+def _backoff(attempt: int, retry_after: Optional[float]) -> float:
+    if retry_after is not None:
+        return min(RETRY_MAX_S, retry_after)
+    return min(RETRY_MAX_S, RETRY_BASE_S * (2 ** attempt)) * random.uniform(0.5, 1.0)
+
+
+class LLMScheduler:
+    def __init__(self):
+        self._limits: Dict[str, AdaptiveLimit] = {}
+
+    def _limit(self, group: str) -> AdaptiveLimit:
+        limit = self._limits.get(group)
+        if limit is None:
+            limit = self._limits[group] = AdaptiveLimit()
+        return limit
+
+    async def call(
+        self,
+        model: str,
+        make_call: Callable[[], Awaitable[Any]],
+        priority: str = "interactive",
+        observe: Optional[Callable[[float], None]] = None,
+        kind: str = "",
+    ) -> Any:
+        """
+        Run make_call() under the model's concurrency limit and budgets, retrying
+        retryable errors. `kind` (e.g. "generate", "rate") picks the latency
+        baseline the call is compared with for AIMD.
+        """
+        if priority not in PRIORITIES:
+            priority = "interactive"
+        group, _ = limit_group(model)
+        limit = self._limit(group)
+        limiter = limiter_for(model)
+        attempt = 0
+        while True:
+            # Honour a retry-after another call received for this group
+            blocked = limit.blocked_until - time.monotonic()
+            if blocked > 0:
+                await asyncio.sleep(blocked)
+            queued_at = time.perf_counter()
+            await limit.acquire(priority)
+            try:
+                llm_queue_wait.observe(time.perf_counter() - queued_at, group=group, priority=priority)
+                await limiter.acquire(TOKENS_PER_CALL)
+                started = time.perf_counter()
+                result = await make_call()
+                elapsed = time.perf_counter() - started
+            except Exception as e:
+                reason = retry_reason(e)
+                retry_after = retry_after_seconds(e)
+                if reason == "rate_limited":
+                    llm_rate_limited.inc(group=group)
+                    limit.on_overload(retry_after)
+                if reason is None or attempt >= MAX_RETRIES:
+                    if reason == "rate_limited":
+                        raise LLMRateLimited(group, retry_after) from e
+                    raise
+            else:
+                limit.on_success(elapsed, f"{kind}:{model}")
+                await limiter.settle(TOKENS_PER_CALL, result)
+                if observe is not None:
+                    observe(elapsed)
+                return result
+            finally:
+                limit.release()
+            llm_retries.inc(group=group, reason=reason)
+            await asyncio.sleep(_backoff(attempt, retry_after))
+            attempt += 1
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {group: limit.stats() for group, limit in sorted(self._limits.items())}
+
+    def queue_depths(self) -> Dict[Tuple[str, str], float]:
+        return {(group, p): limit.queued(p) for group, limit in self._limits.items() for p in PRIORITIES}
+
+    def concurrency(self) -> Dict[Tuple[str, str], float]:
+        samples = {}
+        for group, limit in self._limits.items():
+            samples[(group, "limit")] = limit.limit
+            samples[(group, "in_flight")] = limit.in_flight
+        return samples
+
+
+llm_scheduler = LLMScheduler()
+
+metrics.gauge("pickup_llm_queue_depth", "LLM calls waiting for a concurrency slot", llm_scheduler.queue_depths, ("group", "priority"))
+metrics.gauge("pickup_llm_concurrency", "Adaptive LLM concurrency limit and calls in flight", llm_scheduler.concurrency, ("group", "state"))
@@ -1,5 +1,5 @@
-from typing import List, Optional, Dict, Any
-from pydantic import BaseModel, Field, ConfigDict
+from typing import List, Literal, Optional, Dict, Any
+from pydantic import BaseModel, Field, ConfigDict, field_validator
 
 
 class ImageDescription(BaseModel):
@@ -8,6 +8,41 @@ class ImageDescription(BaseModel):
     vibes: List[str] = Field(default_factory=list)
 
 
+def _clamp_ratings(value: Any) -> Dict[str, int]:
+    """Coerce model-written scores to ints in 1-10, dropping ones that are not numbers."""
+    if not isinstance(value, dict):
+        raise ValueError("ratings must be an object")
+    ratings = {}
+    for label, score in value.items():
+        try:
+            ratings[str(label)] = max(1, min(10, int(round(float(score)))))
+        except (TypeError, ValueError):
+            continue
+    return ratings
+
+
+class RatingsResult(BaseModel):
+    """Rater node reply."""
+    ratings: Dict[str, int] = Field(default_factory=dict)
+    best_label: str = ""
+    best_line: str = ""
+
+    _coerce_ratings = field_validator("ratings", mode="before")(_clamp_ratings)
+
+    @field_validator("best_label", "best_line", mode="before")
+    @classmethod
+    def _none_as_empty(cls, value: Any) -> str:
+        return "" if value is None else str(value)
+
+
+class GeneratedLinesResult(BaseModel):
+    """Batched generator reply; ratings only when it was asked to rate."""
+    lines: Dict[str, str] = Field(default_factory=dict)
+    ratings: Dict[str, int] = Field(default_factory=dict)
+
+    _coerce_ratings = field_validator("ratings", mode="before")(_clamp_ratings)
+
+
 class GenerateFromFeaturesRequest(BaseModel):
     # Allow fields starting with "model_" without warnings
     model_config = ConfigDict(protected_namespaces=())
@@ -44,13 +79,66 @@ class GraphGenerateRequest(BaseModel):
     features: ImageDescription
     model_text: Optional[str] = Field(default=None, description="Override text model id for graph")
     temperature: Optional[float] = Field(default=None, ge=0.0, le=2.0)
+    mode: Optional[Literal["fanout", "batched", "batched_rated"]] = Field(
+        default=None,
+        description="fanout: one LLM call per style; batched: one call for all styles plus a rater call; "
+                    "batched_rated: one call that writes and rates all lines. Defaults to GRAPH_MODE env or fanout.",
+    )
+    retry_threshold: Optional[int] = Field(default=None, ge=1, le=10, description="Regenerate lines rated below this score")
+    max_attempts: Optional[int] = Field(default=None, ge=1, le=5, description="Max generations per style, including the first")
+    latency_budget_ms: Optional[int] = Field(default=None, ge=0, description="No retry round starts after this much time (0 = no limit)")
+    deadline_ms: Optional[int] = Field(
+        default=None,
+        ge=0,
+        description="Hard request deadline; styles whose line is not ready in time are dropped (0 = no deadline). "
+                    "Defaults to GRAPH_DEADLINE_MS env.",
+    )
+    hedge: Optional[bool] = Field(default=None, description="Fire a duplicate LLM call when one runs past the observed p95 latency")
+    rater: Optional[Literal["llm", "local", "local_then_llm"]] = Field(
+        default=None,
+        description="llm: LLM rater call; local: CPU scorer only; local_then_llm: LLM only when the top local scores are close. "
+                    "Defaults to RATER_MODE env or llm.",
+    )
+    styles: Optional[List[str]] = Field(
+        default=None,
+        description="Subset of style labels to generate (e.g. [\"playful\", \"sweet\"]); defaults to every enabled style",
+    )
+    cache_control: Literal["default", "bypass", "refresh"] = Field(
+        default="default",
+        description="default: serve from/fill the response cache; refresh: regenerate and overwrite; bypass: skip the cache",
+    )
+    user_id: Optional[str] = Field(
+        default=None,
+        max_length=128,
+        description="Caller's user id; lines that repeat the ones recently served to this user are regenerated",
+    )
+    debug: bool = Field(default=False, description="Include per-node timings, tokens and cost in the response")
 
 
 class GraphGenerateResponse(BaseModel):
-    outputs: Dict[str, str] = Field(description="One line output from each node: playful, witty, spicy, sweet")
+    outputs: Dict[str, str] = Field(description="One line per generated style, keyed by style label")
     ratings: Dict[str, int] = Field(description="Rating 1-10 from the rater for each node label")
     best_label: str
     best_line: str
+    llm_calls: int = Field(default=0, description="LLM calls made for this request (0 when served from cache)")
+    dropped: List[str] = Field(default_factory=list, description="Styles dropped for missing the deadline or staying rate limited (\"rate\" if ratings are heuristic)")
+    hedged: List[str] = Field(default_factory=list, description="Styles or nodes whose LLM call was hedged")
+    source: Literal["graph", "cache", "pool"] = Field(default="graph", description="Where the lines came from")
+    session_id: Optional[str] = Field(
+        default=None,
+        description="POST /v1/sessions/{session_id}/more for new lines on the same photo without describing it again",
+    )
+    timings: Optional[Dict[str, Any]] = Field(default=None, description="Per-node timings, tokens and cost (debug requests only)")
+
+
+class SessionMoreRequest(BaseModel):
+    styles: Optional[List[str]] = Field(default=None, description="Styles to write new lines for; defaults to the session's styles")
+    rater: Optional[Literal["llm", "local", "local_then_llm"]] = Field(
+        default=None, description="Overrides the session's rater mode for this call"
+    )
+    deadline_ms: Optional[int] = Field(default=None, ge=0, description="Hard request deadline (0 = no deadline)")
+    hedge: Optional[bool] = Field(default=None, description="Fire a duplicate LLM call when one runs past the observed p95 latency")
+    debug: bool = Field(default=False, description="Include per-node timings, tokens and cost in the response")
 
 
 class RazorpayCreateOrderRequest(BaseModel):
@@ -58,6 +146,11 @@ class RazorpayCreateOrderRequest(BaseModel):
     currency: str = Field(default="INR", description="ISO currency code, e.g., INR")
     receipt: Optional[str] = Field(default=None, description="Receipt identifier for the order")
     notes: Optional[Dict[str, Any]] = Field(default=None, description="Optional notes to attach to the order")
+    idempotency_key: Optional[str] = Field(
+        default=None,
+        max_length=255,
+        description="Retries with the same key return the original order (same as the Idempotency-Key header)",
+    )
 
 
 class RazorpayOrderResponse(BaseModel):
@@ -71,3 +164,16 @@ class RazorpayOrderResponse(BaseModel):
     amount_due: Optional[int] = None
     notes: Dict[str, Any] = Field(default_factory=dict)
     key_id: str = Field(description="Public Razorpay key id to be used on frontend for checkout")
+    payment_id: Optional[str] = Field(default=None, description="Payment recorded by signature verification or webhook")
+    idempotent_replay: bool = Field(default=False, description="True when an earlier request with the same key created this order")
+
+
+class RazorpayVerifyRequest(BaseModel):
+    razorpay_order_id: str
+    razorpay_payment_id: str
+    razorpay_signature: str
+
+
+class RazorpayVerifyResponse(BaseModel):
+    verified: bool
+    order: RazorpayOrderResponse
@@ -0,0 +1,289 @@
+"""
+Local pickup-line scoring: a CPU-only stand-in for the LLM rater.
+
+Scores a line 1-10 from cheap signals: length sweet spot, overlap with the
+photo's features, cliché and disrespect blacklists, and character-trigram
+similarity to a corpus of lines that were rated highly. Scoring a line takes
+microseconds, so the rate node can skip its LLM call (rater mode "local") or
+only make it when the local scores cannot separate the top lines
+("local_then_llm").
+
+The corpus starts from a small built-in seed, can be loaded from
+RATER_CORPUS_PATH (plain text, one line per row, or JSONL with "line" and an
+optional "rating"), and grows with lines the LLM rater scores >= RATER_LEARN_MIN.
+If RATER_EMBEDDING_MODEL names a sentence-transformers model (optional
+dependency) its cosine similarity is blended into the corpus signal. Encoding
+takes milliseconds, so with an embedder the async entry points (ascore_values,
+ascore_lines, alearn) run in a worker thread; without one they stay inline.
+"""
+import asyncio
+import json
+import logging
+import os
+import re
+import threading
+from collections import Counter, deque
+from typing import Any, Deque, Dict, Iterable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# llm: always ask the LLM rater; local: never; local_then_llm: only for close calls
+RATER_MODES = ("llm", "local", "local_then_llm")
+RATER_MODE = os.getenv("RATER_MODE", "llm").strip().lower()
+# Local scores of the two best lines closer than this go to the LLM rater
+CLOSE_MARGIN = float(os.getenv("RATER_CLOSE_MARGIN", "0.5"))
+CORPUS_PATH = os.getenv("RATER_CORPUS_PATH")
+CORPUS_MAX = int(os.getenv("RATER_CORPUS_MAX", "5000"))
+LEARN_MIN = int(os.getenv("RATER_LEARN_MIN", "9"))
+EMBEDDING_MODEL = os.getenv("RATER_EMBEDDING_MODEL")
+
+SEED_CORPUS = (
+    "Is your dog single? Because I think we'd both be happy to follow you around.",
+    "I was going to wait for the sunset, but your smile already lit up my evening.",
+    "Your smile could make a Monday feel like a long weekend.",
+    "If beach days were a person, I think I'd be looking at them right now.",
+    "I'm not a photographer, but I can definitely picture us together at that beach.",
+    "You look like the kind of person who makes strangers' days better without trying.",
+    "Do you believe in love at first swipe, or should I scroll past again?",
+    "Your playlist and my road trip seem like they'd get along. Should we introduce them?",
+    "I'd tell you a joke about your glasses, but you'd probably see right through it.",
+    "Fair warning: I'm very good at coffee dates and terrible at pretending I'm not smitten.",
+    "That guitar looks great on you. Do you take requests, or just hearts?",
+    "You must be a great listener, because my heart has been talking about you all day.",
+)
+
+CLICHES = (
+    "did it hurt",
+    "fell from heaven",
+    "are you a parking ticket",
+    "are you a magician",
+    "is your name google",
+    "you must be tired",
+    "running through my mind",
+    "do you have a map",
+    "lost in your eyes",
+    "are you a camera",
+    "an angel",
+    "are you wifi",
+    "come here often",
+)
+
+DISRESPECT = (
+    "sexy",
+    "hot body",
+    "ugly",
+    "fat",
+    "stupid",
+    "bitch",
+    "damn girl",
+    "shut up",
+)
+
+_WORD = re.compile(r"[a-z']+")
+_STOPWORDS = {
+    "a", "an", "and", "are", "at", "be", "but", "for", "i", "in", "is", "it", "me", "my", "of",
+    "on", "or", "so", "that", "the", "to", "with", "you", "your", "person", "photo",
+}
+
+
+def _normalize(text: str) -> str:
+    return " ".join(_WORD.findall((text or "").lower()))
+
+
+def trigrams(text: str) -> Set[str]:
+    """Character trigrams of the normalized text, padded so word starts count."""
+    text = f"  {_normalize(text)} "
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def _feature_words(features: Optional[Dict[str, Any]]) -> Set[str]:
+    features = features or {}
+    text = " ".join(
+        [str(features.get("description") or "")]
+        + [str(a) for a in features.get("attributes") or []]
+        + [str(v) for v in features.get("vibes") or []]
+    )
+    return {w for w in _WORD.findall(text.lower()) if w not in _STOPWORDS and len(w) > 2}
+
+
+class _Embedder:
+    """Optional sentence-transformers similarity; disabled if the package is missing."""
+
+    def __init__(self, model_name: str):
+        from sentence_transformers import SentenceTransformer
+
+        self.model = SentenceTransformer(model_name, device="cpu")
+        self.vectors: List[Any] = []
+
+    def add(self, lines: Iterable[str]) -> None:
+        lines = list(lines)
+        if lines:
+            self.vectors.extend(self.model.encode(lines, normalize_embeddings=True))
+
+    def similarity(self, line: str) -> float:
+        if not self.vectors:
+            return 0.0
+        vector = self.model.encode([line], normalize_embeddings=True)[0]
+        return max(float((vector * v).sum()) for v in self.vectors)
+
+
+class LocalScorer:
+    """Scores lines 1-10 without network calls; see the module docstring for the signals."""
+
+    def __init__(self, corpus: Iterable[str] = (), max_corpus: int = CORPUS_MAX, embedding_model: Optional[str] = None):
+        self.max_corpus = max_corpus
+        self._lines: Deque[Tuple[int, str, Set[str]]] = deque()
+        self._index: Dict[str, Set[int]] = {}
+        self._sizes: Dict[int, int] = {}
+        self._seen: Set[str] = set()
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self._embedder: Optional[_Embedder] = None
+        if embedding_model:
+            try:
+                self._embedder = _Embedder(embedding_model)
+            except ImportError:
+                logger.warning("RATER_EMBEDDING_MODEL is set but sentence-transformers is not installed; ignoring it")
+        self.add_lines(corpus)
+
+    def add_lines(self, lines: Iterable[str]) -> None:
+        added = []
+        with self._lock:
+            for line in lines:
+                text = _normalize(line)
+                if not text or text in self._seen:
+                    continue
+                added.append(line)
+                grams = trigrams(line)
+                line_id = self._next_id
+                self._next_id += 1
+                self._lines.append((line_id, text, grams))
+                self._sizes[line_id] = len(grams)
+                self._seen.add(text)
+                for gram in grams:
+                    self._index.setdefault(gram, set()).add(line_id)
+                if len(self._lines) > self.max_corpus:
+                    old_id, old_text, old_grams = self._lines.popleft()
+                    del self._sizes[old_id]
+                    self._seen.discard(old_text)
+                    for gram in old_grams:
+                        ids = self._index.get(gram)
+                        if ids is not None:
+                            ids.discard(old_id)
+                            if not ids:
+                                del self._index[gram]
+        if self._embedder is not None:
+            self._embedder.add(added)
+
+    def learn(self, outputs: Dict[str, str], ratings: Dict[str, int]) -> None:
+        """Add lines the LLM rater scored highly to the corpus."""
+        self.add_lines([line for label, line in outputs.items() if line and ratings.get(label, 0) >= LEARN_MIN])
+
+    async def _offload(self, fn, *args):
+        if self._embedder is None:
+            return fn(*args)
+        return await asyncio.to_thread(fn, *args)
+
+    async def alearn(self, outputs: Dict[str, str], ratings: Dict[str, int]) -> None:
+        await self._offload(self.learn, outputs, ratings)
+
+    def corpus_size(self) -> int:
+        return len(self._lines)
+
+    def similarity(self, line: str) -> float:
+        """Best trigram Jaccard similarity to the corpus (0-1)."""
+        grams = trigrams(line)
+        if not grams:
+            return 0.0
+        overlap: Counter = Counter()
+        with self._lock:
+            for gram in grams:
+                overlap.update(self._index.get(gram, ()))
+            if not overlap:
+                return 0.0
+            return max(shared / (len(grams) + self._sizes[line_id] - shared) for line_id, shared in overlap.items())
+
+    def score(self, line: str, features: Optional[Dict[str, Any]] = None) -> int:
+        return int(round(self.score_value(line, features)))
+
+    def score_value(self, line: str, features: Optional[Dict[str, Any]] = None) -> float:
+        """Unrounded 1-10 score, for telling close lines apart."""
+        text = _normalize(line)
+        if not text:
+            return 1.0
+        padded = f" {text} "
+        if any(f" {term} " in padded for term in DISRESPECT):
+            return 2.0
+
+        words = text.split()
+        score = 6.0
+        if 6 <= len(words) <= 30:
+            score += 1.0
+        elif len(words) < 4 or len(words) > 45:
+            score -= 2.0
+
+        hits = len(_feature_words(features) & set(words))
+        score += min(hits, 2) * 0.75
+        score -= 2.0 * min(2, sum(1 for phrase in CLICHES if f" {phrase} " in padded))
+
+        similarity = self.similarity(line)
+        if self._embedder is not None:
+            similarity = max(similarity, self._embedder.similarity(line))
+        score += min(1.0, similarity * 2.5)
+
+        if line.rstrip().endswith("?"):
+            score += 0.25
+        if line.count("!") > 2:
+            score -= 0.5
+        return max(1.0, min(10.0, score))
+
+    def score_lines(self, outputs: Dict[str, str], features: Optional[Dict[str, Any]] = None) -> Dict[str, int]:
+        return {label: self.score(line, features) for label, line in outputs.items()}
+
+    def score_values(self, outputs: Dict[str, str], features: Optional[Dict[str, Any]] = None) -> Dict[str, float]:
+        return {label: self.score_value(line, features) for label, line in outputs.items()}
+
+    async def ascore_values(self, outputs: Dict[str, str], features: Optional[Dict[str, Any]] = None) -> Dict[str, float]:
+        return await self._offload(self.score_values, outputs, features)
+
+    async def ascore_lines(self, outputs: Dict[str, str], features: Optional[Dict[str, Any]] = None) -> Dict[str, int]:
+        return await self._offload(self.score_lines, outputs, features)
+
+
+def is_close_call(ratings: Dict[str, float], margin: float = CLOSE_MARGIN) -> bool:
+    """True when the two best scores are too close for the local scorer to pick a winner."""
+    top = sorted(ratings.values(), reverse=True)[:2]
+    return len(top) == 2 and top[0] - top[1] < margin
+
+
+def resolve_rater_mode(mode: Optional[str] = None) -> str:
+    chosen = (mode or RATER_MODE or "llm").strip().lower()
+    if chosen not in RATER_MODES:
+        raise ValueError(f"unknown rater mode {chosen!r}; expected one of {', '.join(RATER_MODES)}")
+    return chosen
+
+
+def _load_corpus(path: Optional[str]) -> List[str]:
+    if not path or not os.path.exists(path):
+        return []
+    lines = []
+    with open(path, "r", encoding="utf-8") as f:
+        for raw in f:
+            raw = raw.strip()
+            if not raw:
+                continue
+            if raw.startswith("{"):
+                try:
+                    data = json.loads(raw)
+                    # A rating like "9/10" or null makes the row unusable, not the corpus
+                    rating = float(data.get("rating", LEARN_MIN))
+                except (AttributeError, TypeError, ValueError):
+                    continue
+                if data.get("line") and rating >= LEARN_MIN:
+                    lines.append(str(data["line"]))
+            else:
+                lines.append(raw)
+    return lines
+
+
+local_scorer = LocalScorer(list(SEED_CORPUS) + _load_corpus(CORPUS_PATH), embedding_model=EMBEDDING_MODEL)
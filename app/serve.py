@@ -0,0 +1,52 @@
+"""
+Multi-worker entry point with state shared between the worker processes.
+
+    python -m app.serve --workers 4 --port 8080
+
+Each uvicorn worker is a separate process with its own event loop, so anything
+kept in memory is per worker. Before forking, this sets (unless already set):
+
+- RESPONSE_CACHE_BACKEND / VISION_CACHE_BACKEND=sqlite: one cache file all
+  workers read and fill, so a response cached by one is a hit on every other.
+- RATE_LIMIT_BACKEND=sqlite: the OpenAI RPM/TPM token buckets live in one
+  SQLite row each, so the workers together stay inside OPENAI_RPM/OPENAI_TPM.
+- SESSION_BACKEND=sqlite: a session_id issued by one worker can be used with
+  /v1/sessions/{id}/more on any other.
+- DEDUPE_HISTORY_BACKEND=sqlite: a user's recently served lines are avoided
+  whichever worker served them.
+- GRAPH_WARMUP_KEYS_PATH: graphs any worker has built are recorded there and
+  compiled by every worker at startup.
+
+Set any of them explicitly to override (e.g. =memory for per-worker state).
+"""
+import argparse
+import os
+
+import uvicorn
+
+SHARED_DEFAULTS = {
+    "RESPONSE_CACHE_BACKEND": "sqlite",
+    "VISION_CACHE_BACKEND": "sqlite",
+    "RATE_LIMIT_BACKEND": "sqlite",
+    "SESSION_BACKEND": "sqlite",
+    "DEDUPE_HISTORY_BACKEND": "sqlite",
+    "GRAPH_WARMUP_KEYS_PATH": ".cache/warm_keys.sqlite3",
+}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8080")))
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", str(os.cpu_count() or 1))))
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+
+    for name, value in SHARED_DEFAULTS.items():
+        os.environ.setdefault(name, value)
+    # Workers are spawned after this, so they inherit the environment above
+    uvicorn.run("app.main:app", host=args.host, port=args.port, workers=max(1, args.workers), log_level=args.log_level)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Generation sessions: "more lines" for the same photo without a full graph run.
+
+Every graph response opens a session (`session_id` in the response) holding
+the photo's features, the request's model/temperature/mode/rater/styles and
+the lines served so far per style. POST /v1/sessions/{id}/more runs only the
+generators and the rater for the requested styles:
+
+- describe passes through on the stored features (no vision call);
+- each style's last SESSION_AVOID_LINES lines are listed in its generator
+  prompt as lines to avoid;
+- new lines that still repeat one of the session's lines (or the user's
+  recent lines) are regenerated, as in app.diversity;
+- the new lines are added to the session, keeping SESSION_MAX_LINES per style.
+
+Sessions are stored in an app.cache backend (SESSION_BACKEND: memory; sqlite,
+shared by the workers on a host and the app.serve default; or off). At most SESSION_MAX_ENTRIES are kept,
+and the least recently used are dropped first. A session expires SESSION_TTL_S
+after it was last used.
+"""
+import os
+import time
+import uuid
+from typing import Any, Dict, Optional
+
+from app.cache import build_backend, call_backend
+
+SESSION_TTL_S = float(os.getenv("SESSION_TTL_S", "3600"))
+# Lines kept per style, and how many of the latest the generator is asked to avoid
+SESSION_MAX_LINES = int(os.getenv("SESSION_MAX_LINES", "10"))
+SESSION_AVOID_LINES = int(os.getenv("SESSION_AVOID_LINES", "3"))
+
+
+def _add_lines(session: Dict[str, Any], outputs: Dict[str, str], ratings: Dict[str, int]) -> Dict[str, Any]:
+    lines = session.setdefault("lines", {})
+    for label, line in outputs.items():
+        if line:
+            lines[label] = (lines.get(label, []) + [line])[-SESSION_MAX_LINES:]
+    session["ratings"] = {**session.get("ratings", {}), **ratings}
+    session["runs"] = session.get("runs", 0) + 1
+    session["updated_at"] = time.time()
+    return session
+
+
+class SessionStore:
+    def __init__(self, backend, ttl: Optional[float] = None):
+        self.backend = backend
+        self.ttl = ttl
+        self.created = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.backend is not None
+
+    async def create(
+        self,
+        features: Optional[Dict[str, Any]],
+        settings: Dict[str, Any],
+        outputs: Dict[str, str],
+        ratings: Dict[str, int],
+    ) -> Optional[str]:
+        """Open a session for a finished generation; None when sessions are off or there are no features."""
+        if not self.enabled or not features:
+            return None
+        session_id = uuid.uuid4().hex
+        session = {"id": session_id, "features": features, "settings": settings, "created_at": time.time()}
+        _add_lines(session, outputs, ratings)
+        await call_backend(self.backend, "set", session_id, session, self.ttl)
+        self.created += 1
+        return session_id
+
+    async def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        session = await call_backend(self.backend, "get", session_id) if self.enabled else None
+        if session is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return session
+
+    async def record(self, session_id: str, outputs: Dict[str, str], ratings: Dict[str, int]) -> None:
+        """
+        Add a "more" call's lines and restart the session's TTL. The backend
+        applies the change atomically (one transaction for sqlite), so calls on
+        other workers do not overwrite each other's lines.
+        """
+        if self.enabled:
+            await call_backend(self.backend, "update", session_id, lambda session: _add_lines(session, outputs, ratings), self.ttl)
+
+    def stats(self) -> Dict[str, Any]:
+        if not self.enabled:
+            return {"enabled": False}
+        lookups = self.hits + self.misses
+        return {
+            "enabled": True,
+            "backend": self.backend.name,
+            "size": len(self.backend),
+            "max_entries": self.backend.max_entries,
+            "ttl_s": self.ttl,
+            "created": self.created,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            "evictions": getattr(self.backend, "evictions", 0),
+        }
+
+
+session_store = SessionStore(
+    build_backend(
+        os.getenv("SESSION_BACKEND", "memory"),
+        os.getenv("SESSION_PATH", ".cache/sessions.sqlite3"),
+        int(os.getenv("SESSION_MAX_ENTRIES", "10000")),
+        table="sessions",
+    ),
+    ttl=SESSION_TTL_S or None,
+)
@@ -0,0 +1,135 @@
+"""
+Style registry: which pickup-line styles the graph generates.
+
+Styles come from STYLES_PATH, a JSON or YAML file (YAML needs the optional
+pyyaml package), or from the built-in set below when it is unset. The file
+is either a list of style objects or a mapping of label -> object:
+
+    - label: playful
+      instruction: playful, cheeky, light banter
+    - label: roast
+      instruction: playful roast, cheeky tease, light sarcasm without insults
+      model: gpt-4o-mini      # optional: model for this style's generator
+      temperature: 0.9        # optional: overrides the request temperature
+    - label: spicy
+      instruction: bold, flirty, a tiny bit spicy but respectful
+      enabled: false          # kept in the file, never generated
+
+The graph builder wires one generator per selected style. Requests can pick a
+subset with `styles`. Per-style model and temperature only apply in fanout
+mode; the batched modes write every line in one call.
+"""
+import json
+import os
+import re
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+STYLES_PATH = os.getenv("STYLES_PATH")
+
+# Node names the graph uses itself
+RESERVED_LABELS = {"describe", "generate", "rate", "done"}
+_LABEL = re.compile(r"^[a-z][a-z0-9_]{0,31}$")
+
+
+@dataclass(frozen=True)
+class Style:
+    label: str
+    instruction: str
+    model: Optional[str] = None
+    temperature: Optional[float] = None
+    enabled: bool = True
+
+
+DEFAULT_STYLES: Tuple[Style, ...] = (
+    Style("playful", "playful, cheeky, light banter"),
+    Style("witty", "clever, wordplay, subtle humor"),
+    Style("spicy", "bold, flirty, a tiny bit spicy but respectful"),
+    Style("sweet", "wholesome, kind, cute"),
+    Style("roast", "playful roast, cheeky tease, light sarcasm without insults; keep respectful and fun"),
+    Style("rizz", "confident, charismatic charm with smooth delivery; respectful and magnetic, no arrogance"),
+)
+
+
+def _style_from(data: Dict[str, Any], label: Optional[str] = None) -> Style:
+    if not isinstance(data, dict):
+        raise ValueError(f"style {label or data!r} must be an object")
+    label = str(data.get("label") or label or "").strip()
+    if not _LABEL.match(label) or label in RESERVED_LABELS or label.startswith("retry_"):
+        raise ValueError(f"invalid style label {label!r}: use lowercase letters, digits and _ (not a reserved node name)")
+    instruction = str(data.get("instruction") or "").strip()
+    if not instruction:
+        raise ValueError(f"style {label!r} needs an instruction")
+    temperature = data.get("temperature")
+    if temperature is not None and not 0.0 <= float(temperature) <= 2.0:
+        raise ValueError(f"style {label!r}: temperature must be between 0 and 2")
+    return Style(
+        label=label,
+        instruction=instruction,
+        model=data.get("model") or None,
+        temperature=float(temperature) if temperature is not None else None,
+        enabled=bool(data.get("enabled", True)),
+    )
+
+
+def parse_styles(data: Any) -> Tuple[Style, ...]:
+    """Styles from a decoded registry file (list of objects or label -> object mapping)."""
+    if isinstance(data, dict):
+        styles = [_style_from(value, label) for label, value in data.items()]
+    elif isinstance(data, list):
+        styles = [_style_from(value) for value in data]
+    else:
+        raise ValueError("style registry must be a list or an object")
+    labels = [s.label for s in styles]
+    duplicates = sorted({label for label in labels if labels.count(label) > 1})
+    if duplicates:
+        raise ValueError(f"duplicate style labels: {', '.join(duplicates)}")
+    if not any(s.enabled for s in styles):
+        raise ValueError("style registry has no enabled styles")
+    return tuple(styles)
+
+
+def load_styles(path: Optional[str] = STYLES_PATH) -> Tuple[Style, ...]:
+    if not path:
+        return DEFAULT_STYLES
+    with open(path, "r", encoding="utf-8") as f:
+        text = f.read()
+    if path.endswith((".yaml", ".yml")):
+        try:
+            import yaml
+        except ImportError:
+            raise ValueError(f"{path} is YAML but pyyaml is not installed (pip install pyyaml), or use JSON")
+        return parse_styles(yaml.safe_load(text))
+    return parse_styles(json.loads(text))
+
+
+class StyleRegistry:
+    def __init__(self, styles: Iterable[Style]):
+        self._styles: Dict[str, Style] = {s.label: s for s in styles if s.enabled}
+
+    def labels(self) -> Tuple[str, ...]:
+        return tuple(self._styles)
+
+    def get(self, label: str) -> Style:
+        return self._styles[label]
+
+    def instructions(self, labels: Optional[Iterable[str]] = None) -> Dict[str, str]:
+        return {label: self._styles[label].instruction for label in (labels or self._styles)}
+
+    def resolve(self, requested: Optional[Iterable[str]] = None) -> Tuple[str, ...]:
+        """
+        Registry-ordered labels for a request's style selection (all enabled
+        styles when None). Raises ValueError for unknown or disabled labels.
+        """
+        if requested is None:
+            return self.labels()
+        wanted = {str(label).strip().lower() for label in requested if str(label).strip()}
+        if not wanted:
+            raise ValueError("styles must name at least one style")
+        unknown = sorted(wanted - set(self._styles))
+        if unknown:
+            raise ValueError(f"unknown styles: {', '.join(unknown)}; expected some of {', '.join(self._styles)}")
+        return tuple(label for label in self._styles if label in wanted)
+
+
+style_registry = StyleRegistry(load_styles())
@@ -0,0 +1,126 @@
+"""
+Application-lifetime HTTP connection pools shared by every LLM node and the
+Razorpay calls, so requests reuse warm keep-alive connections instead of
+paying a TLS handshake per graph build or payment call.
+
+Started in the FastAPI lifespan (clients are also created lazily on first use,
+e.g. from the batch CLI) and closed on shutdown.
+"""
+import os
+import threading
+from typing import Dict, Optional, Tuple
+
+import httpx
+
+MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "200"))
+MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "50"))
+KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "60"))
+# HTTP/2 multiplexes many LLM calls over one connection; needs the optional `h2` package
+HTTP2 = os.getenv("HTTP2", "1").strip().lower() not in ("0", "false", "no")
+RAZORPAY_POOL_SIZE = int(os.getenv("RAZORPAY_POOL_SIZE", "20"))
+# Point at a stub (e.g. bench.fake_openai) instead of api.razorpay.com
+RAZORPAY_BASE_URL = os.getenv("RAZORPAY_BASE_URL") or "https://api.razorpay.com"
+RAZORPAY_TIMEOUT = float(os.getenv("RAZORPAY_TIMEOUT", "15"))
+
+_lock = threading.Lock()
+_async_client: Optional[httpx.AsyncClient] = None
+_sync_client: Optional[httpx.Client] = None
+_razorpay_client: Optional[httpx.AsyncClient] = None
+
+
+def _http2_available() -> bool:
+    if not HTTP2:
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=MAX_CONNECTIONS,
+        max_keepalive_connections=MAX_KEEPALIVE,
+        keepalive_expiry=KEEPALIVE_EXPIRY,
+    )
+
+
+def request_timeout() -> httpx.Timeout:
+    return httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT)
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """Shared async client for OpenAI calls (pass as ChatOpenAI(http_async_client=...))."""
+    global _async_client
+    with _lock:
+        if _async_client is None or _async_client.is_closed:
+            _async_client = httpx.AsyncClient(limits=_limits(), timeout=request_timeout(), http2=_http2_available())
+        return _async_client
+
+
+def get_sync_client() -> httpx.Client:
+    """Shared sync client so ChatOpenAI does not open a private pool per instance."""
+    global _sync_client
+    with _lock:
+        if _sync_client is None or _sync_client.is_closed:
+            _sync_client = httpx.Client(limits=_limits(), timeout=request_timeout(), http2=_http2_available())
+        return _sync_client
+
+
+def get_razorpay_client() -> httpx.AsyncClient:
+    """Shared async client for the Razorpay REST API; credentials are passed per request."""
+    global _razorpay_client
+    with _lock:
+        if _razorpay_client is None or _razorpay_client.is_closed:
+            _razorpay_client = httpx.AsyncClient(
+                base_url=RAZORPAY_BASE_URL.rstrip("/"),
+                limits=httpx.Limits(max_connections=RAZORPAY_POOL_SIZE, max_keepalive_connections=RAZORPAY_POOL_SIZE),
+                timeout=httpx.Timeout(RAZORPAY_TIMEOUT, connect=CONNECT_TIMEOUT),
+            )
+        return _razorpay_client
+
+
+def start() -> None:
+    get_async_client()
+    get_sync_client()
+
+
+async def aclose() -> None:
+    global _async_client, _sync_client, _razorpay_client
+    with _lock:
+        async_client, sync_client, razorpay_client = _async_client, _sync_client, _razorpay_client
+        _async_client = _sync_client = _razorpay_client = None
+    if async_client is not None:
+        await async_client.aclose()
+    if sync_client is not None:
+        sync_client.close()
+    if razorpay_client is not None:
+        await razorpay_client.aclose()
+
+
+def _pool_connections(client) -> Optional[list]:
+    # httpx does not expose pool state publicly; read httpcore's pool defensively
+    pool = getattr(getattr(client, "_transport", None), "_pool", None)
+    return list(getattr(pool, "connections", []) or []) if pool is not None else None
+
+
+def pool_stats() -> Dict[Tuple[str, str], float]:
+    """(pool, state) -> connections, for the /metrics gauge."""
+    samples: Dict[Tuple[str, str], float] = {}
+    for name, client, cap in (
+        ("openai_async", _async_client, MAX_CONNECTIONS),
+        ("openai_sync", _sync_client, MAX_CONNECTIONS),
+        ("razorpay", _razorpay_client, RAZORPAY_POOL_SIZE),
+    ):
+        connections = _pool_connections(client) if client is not None else None
+        if connections is None:
+            continue
+        idle = sum(1 for c in connections if getattr(c, "is_idle", lambda: False)())
+        samples[(name, "open")] = len(connections)
+        samples[(name, "idle")] = idle
+        samples[(name, "active")] = len(connections) - idle
+        samples[(name, "max")] = cap
+    return samples
@@ -0,0 +1,76 @@
+"""
+Cost of near-duplicate detection and diversity ranking on the graph's hot path.
+
+Times, in-process and without any LLM calls, the app.diversity work one rate
+node does: find_duplicates over a request's lines against a user's history,
+_pick_best with the diversity bonus, and the RecentLines lookup and update
+the runner makes per request.
+
+    python -m bench.dedupe --lines 6 --history 20 --iterations 20000
+"""
+import argparse
+import json
+import time
+from typing import Any, Callable, Dict
+
+from app.diversity import RecentLines, find_duplicates, shingle
+from app.graph import _pick_best
+from app.scoring import SEED_CORPUS
+from bench.fake_openai import LINES
+
+
+def _per_call_us(fn: Callable[[], Any], iterations: int) -> float:
+    fn()
+    started = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - started) / iterations * 1e6
+
+
+def run(args) -> Dict[str, Any]:
+    corpus = list(LINES) + list(SEED_CORPUS)
+    outputs = {f"style_{i}": corpus[i % len(corpus)] for i in range(args.lines)}
+    # One near duplicate inside the request, so the scan does not stop early
+    outputs["style_dup"] = corpus[0].replace("staring", "staring at you")
+    ratings = {label: 8 for label in outputs}
+    # The lines after the request's; a long window wraps around and repeats some of them
+    history_lines = [corpus[(args.lines + i) % len(corpus)] for i in range(args.history)]
+    history = tuple(shingle(line) for line in history_lines)
+    store = RecentLines(window=args.history)
+    store.add("user", history_lines)
+
+    duplicates = find_duplicates(outputs, history)
+    return {
+        "lines": len(outputs),
+        "history": len(history),
+        "duplicates": {label: source for label, (source, _) in duplicates.items()},
+        "find_duplicates_us": round(_per_call_us(lambda: find_duplicates(outputs, history), args.iterations), 2),
+        "pick_best_us": round(_per_call_us(lambda: _pick_best(outputs, ratings, history=history), args.iterations), 2),
+        "history_get_us": round(_per_call_us(lambda: store.get("user"), args.iterations), 2),
+        "history_add_us": round(_per_call_us(lambda: store.add("user", outputs.values()), args.iterations), 2),
+    }
+
+
+def report(results: Dict[str, Any]) -> None:
+    print(f"lines={results['lines']} history={results['history']} duplicates={results['duplicates']}")
+    for key in ("find_duplicates_us", "pick_best_us", "history_get_us", "history_add_us"):
+        print(f"  {key[:-3]:<16} {results[key]:8.2f} us/call")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lines", type=int, default=6, help="Generated lines per request (one near duplicate is added)")
+    parser.add_argument("--history", type=int, default=20, help="Lines in the user's history window")
+    parser.add_argument("--iterations", type=int, default=20000)
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args()
+
+    results = run(args)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        report(results)
+
+
+if __name__ == "__main__":
+    main()
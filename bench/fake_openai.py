@@ -0,0 +1,293 @@
+"""
+Local OpenAI-compatible stub for benchmarks.
+
+Serves POST /v1/chat/completions with a fixed per-call latency and canned replies:
+- rater prompts get a ratings object (every label gets --rating); --rater-format
+  switches to fenced, truncated or non-JSON replies (or alternates JSON and
+  prose) to exercise the app's tolerant parser and fallback,
+- vision/describe prompts get a JSON features object,
+- batched generator prompts get a JSON object of lines (and ratings when asked),
+- everything else gets a short pickup line, chosen per style and features (padded
+  to --completion-tokens words). Prompts that list earlier lines to avoid get
+  a new line composed from a word list (seeded by the prompt), as a real
+  model would write something new rather than pick from a fixed set.
+Requests with "stream": true get the reply as SSE chunks, one word at a time.
+With --max-concurrency, completions beyond that many in flight get a 429 with
+retry-after-ms, like OpenAI's rate limiter.
+
+It also stubs Razorpay order creation and lookup at /razorpay/v1/orders for
+RAZORPAY_BASE_URL. Replies are deterministic: no randomness, only fixed sleeps.
+
+Run it and point the app at it:
+
+    python -m bench.fake_openai --port 9100 --latency 0.2
+    OPENAI_BASE_URL=http://127.0.0.1:9100/v1 OPENAI_API_KEY=sk-fake \
+    RAZORPAY_BASE_URL=http://127.0.0.1:9100/razorpay uvicorn app.main:app
+"""
+import argparse
+import asyncio
+import json
+import random
+import re
+import time
+import uuid
+import zlib
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+stub = FastAPI(title="Fake OpenAI")
+stub.state.latency = 0.2
+stub.state.rating = 9
+stub.state.rater_format = "json"
+stub.state.completion_tokens = 0
+stub.state.razorpay_latency = 0.05
+# Every Nth completion sleeps slow_latency instead: a deterministic latency tail
+stub.state.slow_every = 0
+stub.state.slow_latency = 2.0
+# Completions in flight above this are rejected with 429 (0 = no limit)
+stub.state.max_concurrency = 0
+stub.state.retry_after_ms = 200
+stub.state.in_flight = 0
+stub.state.rejected = 0
+stub.state.calls = 0
+stub.state.rater_calls = 0
+stub.state.orders = 0
+stub.state.order_store = {}
+# Never reset with the stats, so order ids stay unique for the stub's lifetime
+stub.state.order_seq = 0
+
+RATER_FORMATS = ("json", "fenced", "truncated", "text", "mixed")
+
+# Generator replies are picked by a hash of the prompt, so each style gets its
+# own (stable) line and local scorers see realistic variety
+LINES = (
+    "Are you a sunset? Because I can't stop staring.",
+    "Is your dog single? Asking for me, obviously.",
+    "Your smile just made this beach look overdressed.",
+    "Did it hurt when you fell from heaven?",
+    "I'd share my umbrella with you, even on a sunny beach day. Coffee instead?",
+    "Hey",
+    "Fair warning: I'm great at coffee dates and terrible at hiding a crush.",
+    "Your dog looks like the best judge of character. I'd like a second opinion.",
+    "I was going to play it cool, but that grin ruined the plan.",
+    "Save me a spot on the sand and I'll bring the good snacks.",
+    "You look like you give excellent playlist recommendations.",
+    "Quick question: is the sea jealous yet?",
+)
+# Material for new lines when the prompt lists lines to avoid (app.prompts.avoid_text)
+AVOID_MARKER = "different from these earlier lines"
+WORDS = (
+    "sunlight", "gravity", "compass", "lantern", "velvet", "thunder", "harbor", "comet", "orchard", "meadow",
+    "violin", "pancakes", "museum", "midnight", "passport", "origami", "skyline", "glacier", "jukebox", "saffron",
+    "cartwheel", "lighthouse", "marmalade", "telescope", "waltz", "cinnamon", "balloon", "riddle", "postcard", "tide",
+    "honey", "atlas", "firefly", "sonnet", "espresso", "kite", "aurora", "pebble", "carousel", "moonbeam",
+)
+
+
+def _text_of(message) -> str:
+    content = message.get("content")
+    if isinstance(content, list):
+        return " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return str(content or "")
+
+
+def _reply_for(messages) -> str:
+    system = next((_text_of(m) for m in messages if m.get("role") == "system"), "")
+    user = " ".join(_text_of(m) for m in messages if m.get("role") == "user")
+    if "Rate each line" in system:
+        labels = re.findall(r'"([a-z_]+)":', user) or re.findall(r"'([a-z_]+)':", user)
+        ratings = {label: stub.state.rating for label in labels}
+        best = labels[0] if labels else ""
+        return _rater_reply(json.dumps({"ratings": ratings, "best_label": best, "best_line": ""}))
+    if "lines: object mapping" in system:
+        # Base models get the styles in the user message, fine-tuned ones in the system prompt
+        labels = [
+            l for l in re.findall(r"^- ([a-z_]+): ", system + "\n" + user, flags=re.M)
+            if l not in ("lines", "ratings")
+        ]
+        reply = {"lines": {label: _line(label + user, AVOID_MARKER in user) for label in labels}}
+        if "- ratings:" in system:
+            reply["ratings"] = {label: stub.state.rating for label in labels}
+        return json.dumps(reply)
+    if "dating profile photos" in system:
+        return json.dumps({"description": "person smiling with a dog at the beach", "attributes": ["smiling", "dog", "beach"]})
+    # The style is in the user message for base models and in the system prompt for fine-tuned
+    # ones; the user message carries the features, plus the lines to avoid on retries
+    line = _line(system + user, AVOID_MARKER in user)
+    padding = stub.state.completion_tokens - len(line.split())
+    return line + " really" * padding if padding > 0 else line
+
+
+def _line(key: str, fresh: bool = False) -> str:
+    if not fresh:
+        return LINES[zlib.crc32(key.encode("utf-8")) % len(LINES)]
+    rng = random.Random(zlib.crc32(key.encode("utf-8")))
+    return " ".join(rng.sample(WORDS, 9)).capitalize() + "?"
+
+
+def _rater_reply(payload: str) -> str:
+    stub.state.rater_calls += 1
+    fmt = stub.state.rater_format
+    if fmt == "mixed":
+        # Every other rater call is unparseable, in a fixed order
+        fmt = "json" if stub.state.rater_calls % 2 else "text"
+    if fmt == "fenced":
+        return f"Here you go:\n```json\n{payload}\n```"
+    if fmt == "truncated":
+        # Cut off mid-object, as if max_tokens ran out
+        return payload[: len(payload) * 2 // 3]
+    if fmt == "text":
+        return "All of these are great, I would rate them highly!"
+    return payload
+
+
+@stub.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    if stub.state.max_concurrency and stub.state.in_flight >= stub.state.max_concurrency:
+        stub.state.rejected += 1
+        return JSONResponse(
+            {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+            status_code=429,
+            headers={"retry-after-ms": str(stub.state.retry_after_ms)},
+        )
+    stub.state.calls += 1
+    slow = stub.state.slow_every and stub.state.calls % stub.state.slow_every == 0
+    stub.state.in_flight += 1
+    try:
+        await asyncio.sleep(stub.state.slow_latency if slow else stub.state.latency)
+    finally:
+        stub.state.in_flight -= 1
+    content = _reply_for(body.get("messages", []))
+    if body.get("stream"):
+        return StreamingResponse(_stream_chunks(body.get("model", "fake"), content), media_type="text/event-stream")
+    prompt_tokens = sum(len(_text_of(m).split()) for m in body.get("messages", []))
+    completion_tokens = len(content.split())
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "fake"),
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }
+        ],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
+
+async def _stream_chunks(model: str, content: str):
+    chunk_id = f"chatcmpl-{uuid.uuid4().hex}"
+    words = content.split(" ")
+    for i, word in enumerate(words):
+        delta = {"content": word if i == 0 else " " + word}
+        if i == 0:
+            delta["role"] = "assistant"
+        chunk = {
+            "id": chunk_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": None}],
+        }
+        yield f"data: {json.dumps(chunk)}\n\n"
+        await asyncio.sleep(0.005)
+    done = {
+        "id": chunk_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+    }
+    yield f"data: {json.dumps(done)}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+@stub.post("/razorpay/v1/orders")
+async def razorpay_create_order(request: Request):
+    body = await request.json()
+    stub.state.orders += 1
+    stub.state.order_seq += 1
+    order_id = f"order_{stub.state.order_seq:014d}"
+    await asyncio.sleep(stub.state.razorpay_latency)
+    amount = int(body.get("amount", 0))
+    order = {
+        "id": order_id,
+        "entity": "order",
+        "amount": amount,
+        "amount_paid": 0,
+        "amount_due": amount,
+        "currency": body.get("currency", "INR"),
+        "receipt": body.get("receipt"),
+        "status": "created",
+        "attempts": 0,
+        "notes": body.get("notes") or [],
+        "created_at": int(time.time()),
+    }
+    stub.state.order_store[order["id"]] = order
+    return order
+
+
+@stub.get("/razorpay/v1/orders/{order_id}")
+async def razorpay_fetch_order(order_id: str):
+    await asyncio.sleep(stub.state.razorpay_latency)
+    order = stub.state.order_store.get(order_id)
+    if order is None:
+        return JSONResponse({"error": {"code": "BAD_REQUEST_ERROR", "description": "The id provided does not exist"}}, status_code=400)
+    return order
+
+
+@stub.get("/stats")
+async def stats():
+    return {
+        "calls": stub.state.calls,
+        "rater_calls": stub.state.rater_calls,
+        "orders": stub.state.orders,
+        "rejected": stub.state.rejected,
+    }
+
+
+@stub.post("/stats/reset")
+async def reset_stats():
+    stub.state.calls = stub.state.rater_calls = stub.state.orders = stub.state.rejected = 0
+    return {"ok": True}
+
+
+def main() -> None:
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds to sleep per completion")
+    parser.add_argument("--rating", type=int, default=9, help="Score given to every line by the fake rater")
+    parser.add_argument("--rater-format", choices=RATER_FORMATS, default="json", help="Shape of rater replies")
+    parser.add_argument("--completion-tokens", type=int, default=0, help="Pad generated lines to this many words")
+    parser.add_argument("--slow-every", type=int, default=0, help="Make every Nth completion slow (0 = never)")
+    parser.add_argument("--slow-latency", type=float, default=2.0, help="Seconds to sleep for slow completions")
+    parser.add_argument("--razorpay-latency", type=float, default=0.05, help="Seconds to sleep per Razorpay order")
+    parser.add_argument("--max-concurrency", type=int, default=0, help="Reject completions beyond this many in flight with 429")
+    parser.add_argument("--retry-after-ms", type=int, default=200, help="retry-after-ms sent with 429 replies")
+    args = parser.parse_args()
+    stub.state.latency = args.latency
+    stub.state.rating = args.rating
+    stub.state.rater_format = args.rater_format
+    stub.state.completion_tokens = args.completion_tokens
+    stub.state.razorpay_latency = args.razorpay_latency
+    stub.state.slow_every = args.slow_every
+    stub.state.slow_latency = args.slow_latency
+    stub.state.max_concurrency = args.max_concurrency
+    stub.state.retry_after_ms = args.retry_after_ms
+    uvicorn.run(stub, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
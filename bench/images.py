@@ -0,0 +1,79 @@
+"""
+Image preprocessing benchmark: bytes received vs bytes sent to the vision model,
+and time spent in app.images.preprocess_image.
+
+    python -m bench.images --corpus ~/photos            # real sample images
+    python -m bench.images --synthetic 20               # generated 12 MP phone-style JPEGs
+"""
+import argparse
+import base64
+import io
+import os
+import statistics
+import time
+
+from app.images import MAX_SIDE, preprocess_image
+
+
+def _synthetic_corpus(count: int, size=(4032, 3024)):
+    from PIL import Image
+
+    images = []
+    for i in range(count):
+        # Noise over a gradient compresses roughly like a real photo
+        noise = Image.effect_noise(size, 40 + i % 30).convert("RGB")
+        gradient = Image.linear_gradient("L").resize(size).convert("RGB")
+        img = Image.blend(noise, gradient, 0.5)
+        exif = Image.Exif()
+        exif[0x010F] = "BenchPhone"  # Make
+        exif[0x0112] = 6  # Orientation: rotate 90 CW
+        out = io.BytesIO()
+        img.save(out, format="JPEG", quality=92, exif=exif)
+        images.append((f"synthetic-{i}.jpg", out.getvalue()))
+    return images
+
+
+def _load_corpus(path: str):
+    images = []
+    for name in sorted(os.listdir(path)):
+        if name.lower().endswith((".jpg", ".jpeg", ".png", ".webp", ".heic")):
+            with open(os.path.join(path, name), "rb") as f:
+                images.append((name, f.read()))
+    return images
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", help="Directory of sample images")
+    parser.add_argument("--synthetic", type=int, default=10, help="Generate N synthetic photos when no corpus is given")
+    args = parser.parse_args()
+
+    images = _load_corpus(args.corpus) if args.corpus else _synthetic_corpus(args.synthetic)
+    if not images:
+        raise SystemExit("no images found")
+
+    bytes_in = bytes_out = b64_in = b64_out = 0
+    timings = []
+    for name, data in images:
+        started = time.perf_counter()
+        out, mime = preprocess_image(data)
+        elapsed = time.perf_counter() - started
+        timings.append(elapsed)
+        bytes_in += len(data)
+        bytes_out += len(out)
+        b64_in += len(base64.b64encode(data))
+        b64_out += len(base64.b64encode(out))
+        print(f"{name}: {len(data) / 1024:.0f} KiB -> {len(out) / 1024:.0f} KiB ({mime}) in {elapsed * 1000:.1f} ms")
+
+    print(f"\nimages={len(images)} max_side={MAX_SIDE}")
+    print(f"bytes in={bytes_in / 1e6:.2f} MB sent={bytes_out / 1e6:.2f} MB ratio={bytes_out / bytes_in:.3f}")
+    print(f"base64 payload in={b64_in / 1e6:.2f} MB sent={b64_out / 1e6:.2f} MB")
+    print(
+        "preprocess ms p50={:.1f} max={:.1f} total={:.0f}".format(
+            statistics.median(timings) * 1000, max(timings) * 1000, sum(timings) * 1000
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,408 @@
+"""
+Load-test suite for the API against local stubs (no API key or network needed).
+
+Starts bench.fake_openai (OpenAI + Razorpay stub) and uvicorn app.main with
+--workers processes, then for each scenario fires --requests requests with
+--concurrency in flight and reports RPS, p50/p95/p99 latency, LLM calls per
+request and resident memory per worker:
+
+    features   POST /v1/generate-graph
+    image      POST /v1/generate-graph-from-image (fixed synthetic JPEG)
+    razorpay   POST /v1/payments/razorpay/create-order
+    razorpay_dupes  the same, with Idempotency-Keys repeated per --duplicate-ratio
+                    (client retries); reports Razorpay orders actually created
+    session_more    POST /v1/sessions/{id}/more: the first "generate again" tap on
+                    a session opened by an (unmeasured) image request per request
+
+Stub latency and replies are fixed, so runs are comparable. Save a baseline and
+compare later runs against it (exit code 1 on regression):
+
+    python -m bench.load_graph --requests 200 --concurrency 50 --save-baseline bench/baselines/local.json
+    python -m bench.load_graph --requests 200 --concurrency 50 --compare bench/baselines/local.json
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Union
+
+import httpx
+
+SCENARIOS = ("features", "image", "razorpay", "razorpay_dupes", "session_more")
+
+FEATURES_PAYLOAD = {
+    "features": {
+        "description": "person smiling with a dog at the beach",
+        "attributes": ["smiling", "dog", "beach", "sunset"],
+        "vibes": ["adventurous", "warm"],
+    },
+    "temperature": 0.5,
+}
+ORDER_PAYLOAD = {"amount": 49900, "currency": "INR", "receipt": "bench"}
+
+# metric -> True when higher is better
+COMPARED_METRICS = {
+    "rps": True,
+    "p50_s": False,
+    "p95_s": False,
+    "p99_s": False,
+    "llm_calls_per_request": False,
+    "rss_mb_per_worker": False,
+}
+
+
+def _spawn(args, env=None) -> subprocess.Popen:
+    return subprocess.Popen([sys.executable, *args], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+async def _wait_ready(url: str, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get(url)).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"server at {url} did not become ready")
+
+
+def app_env(fake_url: str) -> Dict[str, str]:
+    """Environment that points the app at the stub, with a fresh order ledger."""
+    env = dict(os.environ)
+    env.update({
+        "OPENAI_BASE_URL": f"{fake_url}/v1",
+        "OPENAI_API_KEY": "sk-fake",
+        "RAZORPAY_BASE_URL": f"{fake_url}/razorpay",
+        "RAZORPAY_KEY_ID": "rzp_test_bench",
+        "RAZORPAY_KEY_SECRET": "bench-secret",
+        "RAZORPAY_LEDGER_PATH": os.path.join(tempfile.mkdtemp(prefix="bench-ledger-"), "ledger.sqlite3"),
+        "LANGCHAIN_TRACING_V2": "false",
+    })
+    return env
+
+
+def percentile(values, pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * (len(ordered) - 1)))))
+    return ordered[idx]
+
+
+def _synthetic_jpeg() -> bytes:
+    from PIL import Image
+
+    img = Image.linear_gradient("L").resize((1600, 1200)).convert("RGB")
+    out = io.BytesIO()
+    img.save(out, format="JPEG", quality=90)
+    return out.getvalue()
+
+
+RequestKwargs = Union[Dict[str, Any], Callable[[int], Dict[str, Any]]]
+
+
+def _request_kwargs(scenario: str, image: bytes, args) -> RequestKwargs:
+    if scenario == "features":
+        return {"url": "/v1/generate-graph", "json": FEATURES_PAYLOAD}
+    if scenario == "image":
+        return {"url": "/v1/generate-graph-from-image", "files": {"file": ("bench.jpg", image, "image/jpeg")}}
+    if scenario == "razorpay_dupes":
+        # Request i reuses key i % distinct, so duplicates of a key are in flight together
+        distinct = max(1, round(args.requests * (1 - args.duplicate_ratio)))
+        nonce = uuid.uuid4().hex[:8]
+
+        def order(i: int) -> Dict[str, Any]:
+            key = f"bench-{nonce}-{i % distinct}"
+            return {
+                "url": "/v1/payments/razorpay/create-order",
+                "json": {**ORDER_PAYLOAD, "receipt": key},
+                "headers": {"Idempotency-Key": key},
+            }
+
+        return order
+    return {"url": "/v1/payments/razorpay/create-order", "json": ORDER_PAYLOAD}
+
+
+def _proc_status(pid: int) -> Dict[str, str]:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            return dict(line.rstrip("\n").split(":\t", 1) for line in f if ":\t" in line)
+    except OSError:
+        return {}
+
+
+def _worker_pids(server_pid: int, workers: int) -> List[int]:
+    """uvicorn runs in-process with one worker, otherwise as a supervisor with child workers."""
+    if workers <= 1:
+        return [server_pid]
+    pids = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        status = _proc_status(int(entry))
+        if status.get("PPid", "").strip() != str(server_pid):
+            continue
+        try:
+            with open(f"/proc/{entry}/cmdline", "rb") as f:
+                cmdline = f.read()
+        except OSError:
+            continue
+        if b"resource_tracker" not in cmdline:
+            pids.append(int(entry))
+    return pids
+
+
+def rss_per_worker_mb(server_pid: int, workers: int) -> float:
+    """Mean resident memory of the app workers (Linux /proc only; 0 elsewhere)."""
+    sizes = []
+    for pid in _worker_pids(server_pid, workers):
+        rss = _proc_status(pid).get("VmRSS", "").split()
+        if rss:
+            sizes.append(int(rss[0]) / 1024.0)
+    return statistics.mean(sizes) if sizes else 0.0
+
+
+async def drive(client: httpx.AsyncClient, kwargs: RequestKwargs, total: int, concurrency: int):
+    sem = asyncio.Semaphore(concurrency)
+    latencies, errors, llm_calls = [], 0, []
+
+    async def one(i: int):
+        nonlocal errors
+        async with sem:
+            started = time.perf_counter()
+            resp = await client.post(**(kwargs(i) if callable(kwargs) else kwargs))
+            latencies.append(time.perf_counter() - started)
+            if resp.status_code != 200:
+                errors += 1
+            elif "llm_calls" in resp.json():
+                llm_calls.append(resp.json()["llm_calls"])
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    wall = time.perf_counter() - started
+    return latencies, errors, wall, llm_calls
+
+
+async def _open_sessions(client: httpx.AsyncClient, image: bytes, args) -> List[str]:
+    """One session per measured request, each opened by an image request."""
+    sem = asyncio.Semaphore(args.concurrency)
+
+    async def one() -> str:
+        async with sem:
+            resp = await client.post(**_request_kwargs("image", image, args))
+            resp.raise_for_status()
+            return resp.json()["session_id"]
+
+    return list(await asyncio.gather(*(one() for _ in range(args.requests))))
+
+
+async def run_scenario(client, fake_url: str, scenario: str, image: bytes, args, server_pid: int) -> Dict[str, Any]:
+    # session_more shares the image path's graph, and its sessions come from image requests
+    warm = "image" if scenario == "session_more" else scenario
+    if args.warmup:
+        await drive(client, _request_kwargs(warm, image, args), args.warmup, min(args.warmup, args.concurrency))
+    # Built after the warmup so razorpay_dupes keys are fresh
+    if scenario == "session_more":
+        session_ids = await _open_sessions(client, image, args)
+        kwargs: RequestKwargs = lambda i: {"url": f"/v1/sessions/{session_ids[i]}/more", "json": {}}
+    else:
+        kwargs = _request_kwargs(scenario, image, args)
+    await client.post(f"{fake_url}/stats/reset")
+    latencies, errors, wall, llm_calls = await drive(client, kwargs, args.requests, args.concurrency)
+    stub_stats = (await client.get(f"{fake_url}/stats")).json()
+    stub_calls = stub_stats["calls"]
+    return {
+        "requests": args.requests,
+        "errors": errors,
+        "wall_s": round(wall, 3),
+        "rps": round(args.requests / wall, 2),
+        "p50_s": round(percentile(latencies, 50), 4),
+        "p95_s": round(percentile(latencies, 95), 4),
+        "p99_s": round(percentile(latencies, 99), 4),
+        "mean_s": round(statistics.mean(latencies), 4),
+        # Counted at the stub, so it includes calls the response does not report
+        "llm_calls_per_request": round(stub_calls / args.requests, 2),
+        "reported_llm_calls_per_request": round(statistics.mean(llm_calls), 2) if llm_calls else 0.0,
+        "llm_429s": stub_stats.get("rejected", 0),
+        "razorpay_orders_per_request": round(stub_stats.get("orders", 0) / args.requests, 3),
+        "rss_mb_per_worker": round(rss_per_worker_mb(server_pid, args.workers), 1),
+    }
+
+
+def _settings(args) -> Dict[str, Any]:
+    return {
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "workers": args.workers,
+        "latency": args.latency,
+        "rater_format": args.rater_format,
+        "rater_mode": args.rater_mode,
+        "mode": args.mode,
+        "caches": args.caches,
+        "shared": args.shared,
+        "slow_every": args.slow_every,
+        "llm_max_concurrency": args.llm_max_concurrency,
+        "duplicate_ratio": args.duplicate_ratio,
+        "deadline_ms": args.deadline_ms,
+        "hedge": args.hedge,
+        "python": platform.python_version(),
+    }
+
+
+async def run(args) -> Dict[str, Any]:
+    fake_url = f"http://127.0.0.1:{args.fake_port}"
+    app_url = f"http://127.0.0.1:{args.app_port}"
+    env = app_env(fake_url)
+    if args.mode:
+        env["GRAPH_MODE"] = args.mode
+    if args.rater_mode:
+        env["RATER_MODE"] = args.rater_mode
+    if args.deadline_ms is not None:
+        env["GRAPH_DEADLINE_MS"] = str(args.deadline_ms)
+    if args.hedge:
+        env["GRAPH_HEDGE"] = "1"
+    if not args.caches:
+        # Measure the full path on every request
+        env["RESPONSE_CACHE_BACKEND"] = "off"
+        env["VISION_CACHE_BACKEND"] = "off"
+    fake = _spawn([
+        "-m", "bench.fake_openai",
+        "--port", str(args.fake_port),
+        "--latency", str(args.latency),
+        "--rater-format", args.rater_format,
+        "--completion-tokens", str(args.completion_tokens),
+        "--slow-every", str(args.slow_every),
+        "--slow-latency", str(args.slow_latency),
+        "--max-concurrency", str(args.llm_max_concurrency),
+    ])
+    # --shared runs the multi-worker entry point (shared SQLite caches, rate limits and warm-up keys)
+    entry = ["-m", "app.serve"] if args.shared else ["-m", "uvicorn", "app.main:app"]
+    server = _spawn(
+        [*entry, "--host", "127.0.0.1", "--port", str(args.app_port), "--workers", str(args.workers), "--log-level", "warning"],
+        env=env,
+    )
+    image = _synthetic_jpeg()
+    results: Dict[str, Any] = {}
+    try:
+        await _wait_ready(f"{fake_url}/stats")
+        await _wait_ready(f"{app_url}/ready")
+        limits = httpx.Limits(max_connections=args.concurrency + 2, max_keepalive_connections=args.concurrency + 2)
+        async with httpx.AsyncClient(base_url=app_url, timeout=120.0, limits=limits) as client:
+            for scenario in args.scenarios:
+                results[scenario] = await run_scenario(client, fake_url, scenario, image, args, server.pid)
+    finally:
+        server.terminate()
+        fake.terminate()
+        server.wait()
+        fake.wait()
+    return {"settings": _settings(args), "scenarios": results}
+
+
+def report(results: Dict[str, Any]) -> None:
+    settings = results["settings"]
+    print(
+        "concurrency={concurrency} workers={workers} llm_latency={latency}s rater={rater_format} mode={mode}".format(
+            **{**settings, "mode": settings["mode"] or "default"}
+        )
+    )
+    for name, r in results["scenarios"].items():
+        print(f"\n[{name}] requests={r['requests']} errors={r['errors']} wall={r['wall_s']:.2f}s rps={r['rps']:.1f}")
+        print(f"  latency p50={r['p50_s']:.3f}s p95={r['p95_s']:.3f}s p99={r['p99_s']:.3f}s mean={r['mean_s']:.3f}s")
+        print(f"  llm_calls/request={r['llm_calls_per_request']:.2f} 429s={r.get('llm_429s', 0)} rss/worker={r['rss_mb_per_worker']:.1f} MB")
+        if name.startswith("razorpay"):
+            print(f"  razorpay_orders/request={r.get('razorpay_orders_per_request', 0):.3f}")
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> bool:
+    """Print deltas against a saved baseline; False when any metric regressed beyond tolerance."""
+    ok = True
+    changed = [k for k, v in baseline.get("settings", {}).items() if results["settings"].get(k) != v]
+    if changed:
+        print(f"\nwarning: settings differ from baseline: {', '.join(changed)}")
+    print(f"\ncomparison against baseline (tolerance {tolerance:.0%}):")
+    for name, current in results["scenarios"].items():
+        base = baseline.get("scenarios", {}).get(name)
+        if not base:
+            print(f"  [{name}] no baseline")
+            continue
+        if current["errors"] > base.get("errors", 0):
+            ok = False
+            print(f"  [{name}] errors: {base.get('errors', 0)} -> {current['errors']} REGRESSION")
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            before, after = base.get(metric), current.get(metric)
+            if not before or after is None:
+                continue
+            delta = (after - before) / before
+            regressed = -delta > tolerance if higher_is_better else delta > tolerance
+            ok = ok and not regressed
+            flag = "REGRESSION" if regressed else "ok"
+            print(f"  [{name}] {metric}: {before:g} -> {after:g} ({delta:+.1%}) {flag}")
+    return ok
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"Comma-separated subset of {', '.join(SCENARIOS)}")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=5, help="Unmeasured requests per scenario")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument("--latency", type=float, default=0.2, help="Fake LLM latency per call (seconds)")
+    parser.add_argument("--rater-format", default="json", help="Fake rater replies: json, fenced, truncated, text or mixed")
+    parser.add_argument("--completion-tokens", type=int, default=0, help="Pad fake generated lines to this many words")
+    parser.add_argument("--slow-every", type=int, default=0, help="Every Nth fake LLM call is slow (latency tail)")
+    parser.add_argument("--slow-latency", type=float, default=2.0, help="Latency of slow fake LLM calls (seconds)")
+    parser.add_argument("--duplicate-ratio", type=float, default=0.8, help="Share of razorpay_dupes requests that repeat a key")
+    parser.add_argument("--llm-max-concurrency", type=int, default=0, help="Fake OpenAI answers 429 beyond this many calls in flight")
+    parser.add_argument("--deadline-ms", type=int, help="GRAPH_DEADLINE_MS for the app")
+    parser.add_argument("--hedge", action="store_true", help="Enable hedged LLM calls in the app (GRAPH_HEDGE=1)")
+    parser.add_argument("--rater-mode", help="RATER_MODE for the app: llm, local or local_then_llm")
+    parser.add_argument("--mode", help="GRAPH_MODE for the app (default: the app's own default)")
+    parser.add_argument("--caches", action="store_true", help="Keep response/vision caches on (off by default)")
+    parser.add_argument("--shared", action="store_true", help="Serve with python -m app.serve (state shared across workers)")
+    parser.add_argument("--fake-port", type=int, default=9100)
+    parser.add_argument("--app-port", type=int, default=9180)
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    parser.add_argument("--save-baseline", metavar="PATH", help="Write results to PATH")
+    parser.add_argument("--compare", metavar="PATH", help="Compare against a baseline saved with --save-baseline")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="Allowed relative regression (0.15 = 15%%)")
+    return parser
+
+
+def main() -> None:
+    parser = build_parser()
+    args = parser.parse_args()
+    args.scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = [s for s in args.scenarios if s not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+
+    results = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        report(results)
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.save_baseline) or ".", exist_ok=True)
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"\nbaseline saved to {args.save_baseline}")
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
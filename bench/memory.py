@@ -0,0 +1,125 @@
+"""
+Peak memory per concurrent image request.
+
+For each --concurrency-levels value, starts a fresh uvicorn app.main (one
+worker) against the local stub, sends two image requests to load everything
+lazily imported, resets the kernel's peak-RSS counter, fires that many
+POST /v1/generate-graph-from-image requests at once and reads the peak back
+(VmHWM in /proc/<pid>/status; Linux only). A fresh server per level keeps
+memory freed by an earlier burst from hiding the next one's growth.
+
+    python -m bench.memory --concurrency-levels 1,10,25,50 --synthetic-size 4032x3024
+
+Reports peak RSS growth over the idle server, total and per concurrent request.
+"""
+import argparse
+import asyncio
+import json
+from typing import Any, Dict, Tuple
+
+import httpx
+
+from bench.images import _synthetic_corpus
+from bench.load_graph import _proc_status, _spawn, _wait_ready, app_env
+
+
+def _rss_mb(pid: int, field: str) -> float:
+    return int(_proc_status(pid)[field].split()[0]) / 1024.0
+
+
+def _reset_peak(pid: int) -> None:
+    # "5" resets VmHWM to the current RSS (Linux >= 4.0)
+    with open(f"/proc/{pid}/clear_refs", "w") as f:
+        f.write("5")
+
+
+async def measure(env: Dict[str, str], image: bytes, concurrency: int, port: int) -> Dict[str, Any]:
+    app_url = f"http://127.0.0.1:{port}"
+    server = _spawn(
+        ["-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        env=env,
+    )
+    files = {"file": ("photo.jpg", image, "image/jpeg")}
+    try:
+        await _wait_ready(f"{app_url}/ready", timeout=60.0)
+        async with httpx.AsyncClient(base_url=app_url, timeout=120.0, limits=httpx.Limits(max_connections=concurrency + 2)) as client:
+            for _ in range(2):
+                (await client.post("/v1/generate-graph-from-image", files=files)).raise_for_status()
+            idle = _rss_mb(server.pid, "VmRSS")
+            _reset_peak(server.pid)
+            responses = await asyncio.gather(*(
+                client.post("/v1/generate-graph-from-image", files=files) for _ in range(concurrency)
+            ))
+            peak = _rss_mb(server.pid, "VmHWM")
+    finally:
+        server.terminate()
+        server.wait()
+    growth = max(0.0, peak - idle)
+    return {
+        "concurrency": concurrency,
+        "errors": sum(1 for r in responses if r.status_code != 200),
+        "idle_rss_mb": round(idle, 1),
+        "peak_rss_mb": round(peak, 1),
+        "growth_mb": round(growth, 1),
+        "mb_per_request": round(growth / concurrency, 2),
+    }
+
+
+async def run(args) -> Dict[str, Any]:
+    fake_url = f"http://127.0.0.1:{args.fake_port}"
+    env = app_env(fake_url)
+    # Every request must reach the vision call: no response, vision or pool hits
+    env.update({
+        "RESPONSE_CACHE_BACKEND": "off",
+        "VISION_CACHE_BACKEND": "off",
+        "LINE_POOL_MODE": "off",
+        "GRAPH_WARMUP_KEYS_PATH": "",
+    })
+    width, height = _size(args.synthetic_size)
+    [(_, image)] = _synthetic_corpus(1, (width, height))
+    fake = _spawn(["-m", "bench.fake_openai", "--port", str(args.fake_port), "--latency", str(args.latency)])
+    levels = []
+    try:
+        await _wait_ready(f"{fake_url}/stats")
+        for concurrency in args.concurrency_levels:
+            levels.append(await measure(env, image, concurrency, args.app_port))
+    finally:
+        fake.terminate()
+        fake.wait()
+    return {"upload_bytes": len(image), "size": f"{width}x{height}", "latency": args.latency, "levels": levels}
+
+
+def _size(value: str) -> Tuple[int, int]:
+    width, height = value.lower().split("x")
+    return int(width), int(height)
+
+
+def report(results: Dict[str, Any]) -> None:
+    print(f"upload={results['upload_bytes'] / 1024:.0f} KB ({results['size']}) llm_latency={results['latency']}s")
+    for r in results["levels"]:
+        print(
+            f"  concurrency={r['concurrency']:<4} errors={r['errors']} idle={r['idle_rss_mb']:.1f} MB "
+            f"peak={r['peak_rss_mb']:.1f} MB growth={r['growth_mb']:.1f} MB per_request={r['mb_per_request']:.2f} MB"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency-levels", default="1,10,25,50", help="Comma-separated burst sizes")
+    parser.add_argument("--synthetic-size", default="4032x3024", help="Synthetic upload size (12 MP phone photo)")
+    parser.add_argument("--latency", type=float, default=0.5, help="Stub LLM latency, long enough for bursts to overlap")
+    parser.add_argument("--fake-port", type=int, default=9102)
+    parser.add_argument("--app-port", type=int, default=9182)
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args()
+    args.concurrency_levels = [int(n) for n in args.concurrency_levels.split(",") if n.strip()]
+
+    results = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        report(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Input tokens per LLM call for one request, per graph mode.
+
+Counts, with a local tokenizer (app.prompts.count_tokens: tiktoken, or an
+estimate when its encoding files cannot be downloaded), the prompt of every
+generator and rater call a request makes without retries, and compares it with
+the previous layout: the style instruction at the start of each generator's
+system prompt, and features and lines written with Python's str(dict).
+Fine-tuned ("ft:") models still get the previous layout in the graph.
+
+    python -m bench.prompt_tokens
+    python -m bench.prompt_tokens --modes fanout --model gpt-4o-mini --json
+
+shared_prefix is how many leading tokens every style's generator prompt has in
+common, i.e. what a provider prompt-prefix cache can reuse across styles.
+"""
+import argparse
+import json
+from typing import Any, Dict
+
+from app.graph import GRAPH_MODES, STYLES
+from app.prompts import prompt_report
+from bench.load_graph import FEATURES_PAYLOAD
+
+SAMPLE_LINE = "Your smile just made this beach look overdressed."
+
+
+def run(args) -> Dict[str, Any]:
+    features = FEATURES_PAYLOAD["features"]
+    outputs = {label: SAMPLE_LINE for label in STYLES}
+    results = {}
+    for mode in args.modes:
+        results[mode] = {
+            layout: prompt_report(features, STYLES, mode=mode, model=args.model, outputs=outputs, baseline=baseline)
+            for layout, baseline in (("current", False), ("previous", True))
+        }
+    return results
+
+
+def report(results: Dict[str, Any]) -> None:
+    for mode, r in results.items():
+        current, previous = r["current"], r["previous"]
+        saved = previous["input_tokens"] - current["input_tokens"]
+        print(
+            f"[{mode}] tokenizer={current['tokenizer']} input_tokens={current['input_tokens']} "
+            f"(previous layout {previous['input_tokens']}, {saved:+d} saved) "
+            f"shared_prefix={current['shared_prefix_tokens']} (previous {previous['shared_prefix_tokens']})"
+        )
+        before = {n["node"]: n["input_tokens"] for n in previous["nodes"]}
+        for n in current["nodes"]:
+            print(f"  {n['node']:<10} {n['input_tokens']:5d} tokens (previous {before.get(n['node'], 0)})")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", default=",".join(GRAPH_MODES), help="Comma-separated graph modes")
+    parser.add_argument("--model", default="gpt-4o-mini", help="Model whose tokenizer is used")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args()
+    args.modes = [m.strip() for m in args.modes.split(",") if m.strip()]
+    unknown = sorted(set(args.modes) - set(GRAPH_MODES))
+    if unknown:
+        parser.error(f"--modes takes {', '.join(GRAPH_MODES)}")
+
+    results = run(args)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        report(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Worker scaling benchmark for the multi-worker entry point (python -m app.serve).
+
+Runs bench.load_graph once per worker count with state shared across workers
+and reports throughput and scaling efficiency (rps_n / (n * rps_1)) per
+scenario. The stubbed LLM latency is fixed, so with enough concurrency the
+app's own CPU work (graph orchestration, JSON, image decoding) is the
+bottleneck and throughput should grow close to linearly with workers up to the
+number of cores. Worker counts above os.cpu_count() are flagged: they can only
+time-slice the same cores.
+
+    python -m bench.scaling --workers-list 1,2,4 --requests 400 --concurrency 100 --latency 0.05
+
+Any other bench.load_graph option (--scenarios, --caches, --rater-mode, ...)
+is passed through.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+from typing import Any, Dict, List
+
+from bench import load_graph
+
+
+def scaling_table(runs: Dict[int, Dict[str, Any]]) -> Dict[str, List[Dict[str, Any]]]:
+    """Per scenario: rps, p95 and efficiency relative to the smallest worker count."""
+    counts = sorted(runs)
+    table: Dict[str, List[Dict[str, Any]]] = {}
+    for scenario in runs[counts[0]]["scenarios"]:
+        base = runs[counts[0]]["scenarios"][scenario]["rps"] / counts[0]
+        rows = []
+        for n in counts:
+            r = runs[n]["scenarios"][scenario]
+            rows.append({
+                "workers": n,
+                "rps": r["rps"],
+                "p95_s": r["p95_s"],
+                "errors": r["errors"],
+                "efficiency": round(r["rps"] / (n * base), 3) if base else 0.0,
+            })
+        table[scenario] = rows
+    return table
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers-list", default="1,2,4", help="Comma-separated worker counts to run")
+    parser.add_argument("--per-worker-state", action="store_true", help="Plain uvicorn workers instead of app.serve")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args, passthrough = parser.parse_known_args()
+    counts = sorted({int(n) for n in args.workers_list.split(",") if n.strip()})
+    if not counts or counts[0] < 1:
+        parser.error("--workers-list needs positive worker counts")
+
+    cores = os.cpu_count() or 1
+    runs: Dict[int, Dict[str, Any]] = {}
+    for n in counts:
+        run_args = load_graph.build_parser().parse_args([*passthrough, "--workers", str(n)])
+        run_args.scenarios = [s.strip() for s in run_args.scenarios.split(",") if s.strip()]
+        run_args.shared = not args.per_worker_state
+        print(f"running {n} worker(s)...", file=sys.stderr)
+        runs[n] = asyncio.run(load_graph.run(run_args))
+
+    table = scaling_table(runs)
+    if args.json:
+        print(json.dumps({"cores": cores, "runs": runs, "scaling": table}, indent=2))
+        return
+    print(f"cores={cores} shared_state={not args.per_worker_state}")
+    for scenario, rows in table.items():
+        print(f"\n[{scenario}]")
+        for row in rows:
+            note = "  (more workers than cores)" if row["workers"] > cores else ""
+            print(
+                f"  workers={row['workers']:<3} rps={row['rps']:<8.1f} p95={row['p95_s']:.3f}s "
+                f"errors={row['errors']} efficiency={row['efficiency']:.0%}{note}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+Cold-start benchmark: import time and time to first response per warm-up mode.
+
+Measures, in fresh processes against the local stub (bench.fake_openai):
+
+- import_s: `import app.main` (heavy LangChain/LangGraph modules are deferred),
+  and import_eager_s: the same plus those modules, i.e. what importing the app
+  cost before they were deferred;
+- per GRAPH_WARMUP mode (blocking, background, off), from process spawn:
+  health_s until GET /health answers (the port is open),
+  ready_s until GET /ready answers 200,
+  first_response_s until the first POST /v1/generate-graph returns,
+  plus first_request_s / second_request_s, the latency of those requests alone.
+
+    python -m bench.startup --repeat 3
+    python -m bench.startup --warmup-modes background,off --json
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List
+
+import httpx
+
+from bench.load_graph import FEATURES_PAYLOAD, _spawn, app_env
+
+WARMUP_MODES = ("blocking", "background", "off")
+EAGER_MODULES = "import langchain_core.prompts, langchain_openai, langgraph.graph"
+POLL_S = 0.01
+
+
+def _import_seconds(env: Dict[str, str], eager: bool) -> float:
+    code = (
+        "import time; t = time.perf_counter(); import app.main; "
+        + (f"{EAGER_MODULES}; " if eager else "")
+        + "print(time.perf_counter() - t)"
+    )
+    out = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True)
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def _poll(client: httpx.Client, url: str, started: float, timeout: float) -> float:
+    """Seconds since `started` until `url` answers 200."""
+    while time.monotonic() - started < timeout:
+        try:
+            if client.get(url).status_code == 200:
+                return time.monotonic() - started
+        except httpx.HTTPError:
+            pass
+        time.sleep(POLL_S)
+    raise RuntimeError(f"{url} did not answer 200 within {timeout}s")
+
+
+def cold_start(env: Dict[str, str], mode: str, port: int, timeout: float) -> Dict[str, float]:
+    app_url = f"http://127.0.0.1:{port}"
+    started = time.monotonic()
+    server = _spawn(
+        ["-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        env={**env, "GRAPH_WARMUP": "1" if mode == "blocking" else mode},
+    )
+    try:
+        with httpx.Client(timeout=60.0) as client:
+            health_s = _poll(client, f"{app_url}/health", started, timeout)
+            ready_s = _poll(client, f"{app_url}/ready", started, timeout)
+            latencies = []
+            for _ in range(2):
+                sent = time.monotonic()
+                client.post(f"{app_url}/v1/generate-graph", json=FEATURES_PAYLOAD).raise_for_status()
+                latencies.append(time.monotonic() - sent)
+                if len(latencies) == 1:
+                    first_response_s = time.monotonic() - started
+    finally:
+        server.terminate()
+        server.wait()
+    return {
+        "health_s": health_s,
+        "ready_s": ready_s,
+        "first_response_s": first_response_s,
+        "first_request_s": latencies[0],
+        "second_request_s": latencies[1],
+    }
+
+
+def _median(runs: List[Dict[str, float]]) -> Dict[str, float]:
+    return {key: round(statistics.median(run[key] for run in runs), 3) for key in runs[0]}
+
+
+def run(args) -> Dict[str, Any]:
+    fake_url = f"http://127.0.0.1:{args.fake_port}"
+    env = app_env(fake_url)
+    # Nothing carried over between runs: every request takes the full graph path
+    env.update({"RESPONSE_CACHE_BACKEND": "off", "VISION_CACHE_BACKEND": "off", "GRAPH_WARMUP_KEYS_PATH": ""})
+    fake = _spawn(["-m", "bench.fake_openai", "--port", str(args.fake_port), "--latency", str(args.latency)])
+    results: Dict[str, Any] = {"repeat": args.repeat, "latency": args.latency, "modes": {}}
+    try:
+        with httpx.Client() as client:
+            _poll(client, f"{fake_url}/stats", time.monotonic(), args.timeout)
+        results["import_s"] = round(statistics.median(_import_seconds(env, False) for _ in range(args.repeat)), 3)
+        results["import_eager_s"] = round(statistics.median(_import_seconds(env, True) for _ in range(args.repeat)), 3)
+        for mode in args.warmup_modes:
+            runs = [cold_start(env, mode, args.app_port, args.timeout) for _ in range(args.repeat)]
+            results["modes"][mode] = _median(runs)
+    finally:
+        fake.terminate()
+        fake.wait()
+    return results
+
+
+def report(results: Dict[str, Any]) -> None:
+    print(f"repeat={results['repeat']} llm_latency={results['latency']}s (medians)")
+    print(f"import app.main: {results['import_s']:.3f}s (with LangChain/LangGraph loaded eagerly: {results['import_eager_s']:.3f}s)")
+    for mode, r in results["modes"].items():
+        print(
+            f"  GRAPH_WARMUP={mode:<10} health={r['health_s']:.3f}s ready={r['ready_s']:.3f}s "
+            f"first_response={r['first_response_s']:.3f}s first_request={r['first_request_s']:.3f}s "
+            f"second_request={r['second_request_s']:.3f}s"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--warmup-modes", default=",".join(WARMUP_MODES), help="Comma-separated GRAPH_WARMUP modes")
+    parser.add_argument("--repeat", type=int, default=3, help="Cold starts per mode (medians are reported)")
+    parser.add_argument("--latency", type=float, default=0.05, help="Stub LLM latency per call (seconds)")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Give up on a server after this many seconds")
+    parser.add_argument("--fake-port", type=int, default=9101)
+    parser.add_argument("--app-port", type=int, default=9181)
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args()
+    args.warmup_modes = [m.strip() for m in args.warmup_modes.split(",") if m.strip()]
+    unknown = sorted(set(args.warmup_modes) - set(WARMUP_MODES))
+    if unknown or args.repeat < 1:
+        parser.error(f"--warmup-modes takes {', '.join(WARMUP_MODES)}; --repeat must be positive")
+
+    results = run(args)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        report(results)
+
+
+if __name__ == "__main__":
+    main()
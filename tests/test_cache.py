@@ -0,0 +1,112 @@
+import asyncio
+
+import pytest
+
+from app.cache import MemoryBackend, SQLiteBackend, VisionCache
+
+FEATURES = {"description": "person smiling with a dog", "attributes": ["dog"]}
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def backend(request, tmp_path):
+    if request.param == "memory":
+        return MemoryBackend()
+    return SQLiteBackend(str(tmp_path / "vision.sqlite3"), table="vision")
+
+
+class SlowVision:
+    def __init__(self, result=FEATURES, error=None):
+        self.calls = 0
+        self.release = asyncio.Event()
+        self.result = result
+        self.error = error
+
+    async def __call__(self):
+        self.calls += 1
+        await self.release.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+async def _settle(cache: VisionCache) -> None:
+    # The call leaves _inflight once its result is stored
+    for _ in range(200):
+        if not cache._inflight:
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("vision call still in flight")
+
+
+def test_concurrent_misses_share_one_call(backend):
+    async def run():
+        cache = VisionCache(backend)
+        vision = SlowVision()
+        callers = [asyncio.create_task(cache.get_or_compute("m:img", vision)) for _ in range(5)]
+        await asyncio.sleep(0.05)
+        vision.release.set()
+        results = await asyncio.gather(*callers)
+        await _settle(cache)
+        again = await cache.get_or_compute("m:img", vision)
+        return cache, vision, results, again
+
+    cache, vision, results, again = asyncio.run(run())
+    assert vision.calls == 1
+    assert results == [FEATURES] * 5
+    assert again == FEATURES
+    assert (cache.misses, cache.coalesced, cache.hits) == (1, 4, 1)
+
+
+def test_cancelled_caller_does_not_cancel_the_others(backend):
+    async def run():
+        cache = VisionCache(backend)
+        vision = SlowVision()
+        first = asyncio.create_task(cache.get_or_compute("m:img", vision))
+        second = asyncio.create_task(cache.get_or_compute("m:img", vision))
+        await asyncio.sleep(0.05)
+        first.cancel()
+        await asyncio.sleep(0)
+        vision.release.set()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return vision, await second
+
+    vision, result = asyncio.run(run())
+    assert vision.calls == 1
+    assert result == FEATURES
+
+
+def test_call_finishes_and_is_cached_after_every_caller_timed_out(backend):
+    async def run():
+        cache = VisionCache(backend)
+        vision = SlowVision()
+        with pytest.raises(asyncio.TimeoutError):
+            await cache.get_or_compute("m:img", vision, timeout=0.02)
+        vision.release.set()
+        await _settle(cache)
+        return cache, vision, await cache.get_or_compute("m:img", vision)
+
+    cache, vision, result = asyncio.run(run())
+    assert vision.calls == 1
+    assert result == FEATURES
+    assert cache.hits == 1
+
+
+def test_failed_call_is_not_cached(backend):
+    async def run():
+        cache = VisionCache(backend)
+        failing = SlowVision(error=RuntimeError("vision down"))
+        callers = [asyncio.create_task(cache.get_or_compute("m:img", failing)) for _ in range(3)]
+        await asyncio.sleep(0.05)
+        failing.release.set()
+        outcomes = await asyncio.gather(*callers, return_exceptions=True)
+        await _settle(cache)
+        working = SlowVision()
+        working.release.set()
+        return cache, outcomes, await cache.get_or_compute("m:img", working), working
+
+    cache, outcomes, result, working = asyncio.run(run())
+    assert all(isinstance(o, RuntimeError) for o in outcomes)
+    assert cache.errors == 1
+    assert result == FEATURES
+    assert working.calls == 1
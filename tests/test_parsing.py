@@ -0,0 +1,44 @@
+from app.parsing import parse_json_object, parse_model
+from app.schemas import RatingsResult
+
+
+def test_plain_json_is_not_repaired():
+    assert parse_json_object('{"ratings": {"a": 8}}') == ({"ratings": {"a": 8}}, False)
+
+
+def test_dict_passes_through():
+    assert parse_json_object({"a": 1}) == ({"a": 1}, False)
+
+
+def test_fenced_json():
+    text = 'Here you go:\n```json\n{"ratings": {"a": 8, "b": 6}}\n```'
+    assert parse_json_object(text) == ({"ratings": {"a": 8, "b": 6}}, True)
+
+
+def test_object_inside_prose():
+    assert parse_json_object('Sure! {"best_label": "a"} Hope that helps.') == ({"best_label": "a"}, True)
+
+
+def test_truncated_value_drops_the_dangling_key():
+    text = '{"ratings": {"a": 8, "b": 7}, "best_label": "a", "best_line": "You ar'
+    assert parse_json_object(text) == ({"ratings": {"a": 8, "b": 7}, "best_label": "a"}, True)
+
+
+def test_truncated_inside_nested_object():
+    assert parse_json_object('{"ratings": {"a": 8, "b": 7') == ({"ratings": {"a": 8, "b": 7}}, True)
+
+
+def test_unusable_replies():
+    for text in (None, "", "   ", "no json here", "[1, 2, 3]", "{"):
+        assert parse_json_object(text) == (None, False)
+
+
+def test_parse_model_validates():
+    result = parse_model('```\n{"ratings": {"a": "9"}, "best_label": "a"}\n```', RatingsResult, "rate")
+    assert result is not None
+    assert result.ratings == {"a": 9}
+    assert result.best_label == "a"
+
+
+def test_parse_model_rejects_garbage():
+    assert parse_model("I'd rate them all highly!", RatingsResult, "rate") is None
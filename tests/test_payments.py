@@ -0,0 +1,128 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+from app import payments
+from app.payments import OrderLedger, create_order
+
+AUTH = ("rzp_test_key", "secret")
+ORDER = {"amount": 49900, "currency": "INR", "receipt": "r1"}
+
+
+class FakeRazorpay:
+    def __init__(self):
+        self.created = []
+        self.fetched = []
+        self.fail_next_create = False
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        if request.method == "POST" and request.url.path == "/v1/orders":
+            if self.fail_next_create:
+                self.fail_next_create = False
+                return httpx.Response(500, json={"error": {"description": "try again"}})
+            order = {"id": f"order_{len(self.created) + 1}", "status": "created", **json.loads(request.content)}
+            self.created.append(order)
+            return httpx.Response(200, json=order)
+        if request.method == "GET" and request.url.path.startswith("/v1/orders/"):
+            order_id = request.url.path.rsplit("/", 1)[1]
+            self.fetched.append(order_id)
+            order = next(o for o in self.created if o["id"] == order_id)
+            return httpx.Response(200, json={**order, "status": "attempted"})
+        return httpx.Response(404, json={"error": {"description": "not found"}})
+
+
+@pytest.fixture
+def razorpay(monkeypatch, tmp_path):
+    fake = FakeRazorpay()
+    client = httpx.AsyncClient(base_url="https://razorpay.test", transport=httpx.MockTransport(fake))
+    monkeypatch.setattr(payments.transport, "get_razorpay_client", lambda: client)
+    monkeypatch.setattr(payments, "_ledger", OrderLedger(str(tmp_path / "ledger.sqlite3")))
+    return fake
+
+
+def test_same_key_replays_the_order(razorpay):
+    async def run():
+        first, replayed_first = await create_order(AUTH, ORDER, "key-1")
+        second, replayed_second = await create_order(AUTH, ORDER, "key-1")
+        return first, replayed_first, second, replayed_second
+
+    first, replayed_first, second, replayed_second = asyncio.run(run())
+    assert (replayed_first, replayed_second) == (False, True)
+    assert second["id"] == first["id"]
+    assert len(razorpay.created) == 1
+
+
+def test_concurrent_requests_with_one_key_create_one_order(razorpay):
+    async def run():
+        return await asyncio.gather(*(create_order(AUTH, ORDER, "key-1") for _ in range(5)))
+
+    results = asyncio.run(run())
+    assert {order["id"] for order, _ in results} == {"order_1"}
+    assert sorted(replayed for _, replayed in results) == [False, True, True, True, True]
+    assert len(razorpay.created) == 1
+
+
+def test_key_reused_for_another_order_is_422(razorpay):
+    async def run():
+        await create_order(AUTH, ORDER, "key-1")
+        await create_order(AUTH, {**ORDER, "amount": 100}, "key-1")
+
+    with pytest.raises(HTTPException) as excinfo:
+        asyncio.run(run())
+    assert excinfo.value.status_code == 422
+    assert len(razorpay.created) == 1
+
+
+def test_keyless_requests_are_not_deduplicated(razorpay):
+    async def run():
+        return [await create_order(AUTH, ORDER) for _ in range(2)]
+
+    (first, _), (second, _) = asyncio.run(run())
+    assert first["id"] != second["id"]
+    assert payments.get_ledger().get(second["id"])["status"] == "created"
+
+
+def test_reserved_key_prefix_is_rejected(razorpay):
+    with pytest.raises(HTTPException) as excinfo:
+        asyncio.run(create_order(AUTH, ORDER, payments.LEDGER_KEY_PREFIX + "order_1"))
+    assert excinfo.value.status_code == 400
+    assert razorpay.created == []
+
+
+def test_failed_create_frees_the_key(razorpay):
+    razorpay.fail_next_create = True
+
+    async def run():
+        with pytest.raises(HTTPException):
+            await create_order(AUTH, ORDER, "key-1")
+        return await create_order(AUTH, ORDER, "key-1")
+
+    order, replayed = asyncio.run(run())
+    assert not replayed
+    assert order["id"] == "order_1"
+
+
+def test_order_created_but_not_stored_is_fetched_on_retry(razorpay, monkeypatch):
+    ledger = payments.get_ledger()
+    complete = ledger.complete
+
+    def fail_once(*args):
+        monkeypatch.setattr(ledger, "complete", complete)
+        raise OSError("disk full")
+
+    monkeypatch.setattr(ledger, "complete", fail_once)
+
+    async def run():
+        with pytest.raises(OSError):
+            await create_order(AUTH, ORDER, "key-1")
+        return await create_order(AUTH, ORDER, "key-1")
+
+    order, replayed = asyncio.run(run())
+    assert replayed
+    assert order["id"] == "order_1"
+    assert order["status"] == "attempted"
+    assert len(razorpay.created) == 1
+    assert razorpay.fetched == ["order_1"]
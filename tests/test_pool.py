@@ -0,0 +1,121 @@
+import sqlite3
+import time
+
+import pytest
+
+from app import pool
+from app.pool import EVICT_LOW_WATER, LinePool
+
+FEATURES = {"description": "person smiling with a dog at the beach", "attributes": ["Dogs", "beach"], "vibes": ["warm"]}
+
+
+@pytest.fixture(autouse=True)
+def pool_settings(monkeypatch):
+    monkeypatch.setattr(pool, "MIN_RATING", 8)
+    monkeypatch.setattr(pool, "MIN_SIMILARITY", 0.5)
+    monkeypatch.setattr(pool, "MIN_COVERAGE", 1.0)
+    monkeypatch.setattr(pool, "MAX_AGE_S", 3600.0)
+    monkeypatch.setattr(pool, "MAX_SERVES", 50)
+    monkeypatch.setattr(pool, "COOLDOWN_S", 0.0)
+
+
+def _line(i: int) -> str:
+    # Lines are deduplicated on their words, so number them with letters
+    return f"Line {chr(ord('a') + i)} about your dog"
+
+
+def _add(line_pool: LinePool, line: str, rating: int = 9) -> int:
+    return line_pool.add(FEATURES, {"playful": line}, {"playful": rating})
+
+
+def _ids(line_pool: LinePool):
+    return [row[0] for row in line_pool._conn.execute("SELECT id FROM pool_lines ORDER BY id")]
+
+
+def _orphaned_attrs(line_pool: LinePool) -> int:
+    (count,) = line_pool._conn.execute(
+        "SELECT COUNT(*) FROM pool_attrs WHERE line_id NOT IN (SELECT id FROM pool_lines)"
+    ).fetchone()
+    return count
+
+
+def test_only_new_well_rated_lines_are_added(tmp_path):
+    line_pool = LinePool(str(tmp_path / "pool.sqlite3"))
+    assert _add(line_pool, "Is your dog single too?") == 1
+    assert _add(line_pool, "Is your DOG single, too?!") == 0
+    assert _add(line_pool, "Nice dog.", rating=5) == 0
+    assert len(line_pool) == 1
+
+
+def test_overflow_evicts_the_oldest_down_to_the_low_water_mark(tmp_path):
+    line_pool = LinePool(str(tmp_path / "pool.sqlite3"), max_lines=10)
+    for i in range(10):
+        _add(line_pool, _line(i))
+    first_ids = _ids(line_pool)
+    assert len(first_ids) == 10
+
+    _add(line_pool, "One line too many")
+    remaining = _ids(line_pool)
+    assert len(remaining) == int(10 * EVICT_LOW_WATER)
+    assert remaining == (first_ids + [remaining[-1]])[-len(remaining):]
+    assert _orphaned_attrs(line_pool) == 0
+
+
+def test_eviction_counts_lines_added_by_other_workers(tmp_path):
+    path = str(tmp_path / "pool.sqlite3")
+    other = LinePool(path, max_lines=10)
+    for i in range(6):
+        _add(other, _line(i))
+    mine = LinePool(path, max_lines=10)
+    for i in range(4):
+        _add(mine, _line(10 + i))
+    assert len(mine) == 10
+    for i in range(3):
+        _add(other, _line(20 + i))
+    # `mine` counts 11 once it adds again, then recounts the other worker's lines too
+    _add(mine, _line(14))
+    assert len(mine) == int(10 * EVICT_LOW_WATER)
+
+
+def test_expired_lines_are_swept(tmp_path):
+    line_pool = LinePool(str(tmp_path / "pool.sqlite3"))
+    _add(line_pool, "An old line about your dog")
+    line_pool._conn.execute("UPDATE pool_lines SET created_at = ?", (time.time() - 7200,))
+    line_pool._swept_at = 0.0
+    _add(line_pool, "A fresh line about your dog")
+    assert [line for (line,) in line_pool._conn.execute("SELECT line FROM pool_lines")] == ["A fresh line about your dog"]
+    assert _orphaned_attrs(line_pool) == 0
+
+
+def test_lines_retire_at_the_serve_cap(tmp_path, monkeypatch):
+    monkeypatch.setattr(pool, "MAX_SERVES", 2)
+    line_pool = LinePool(str(tmp_path / "pool.sqlite3"))
+    _add(line_pool, "Is your dog single too?")
+    for _ in range(2):
+        outputs, ratings = line_pool.lookup(FEATURES, ["playful"])
+        assert outputs == {"playful": "Is your dog single too?"}
+        assert ratings == {"playful": 9}
+    assert len(line_pool) == 0
+    assert _orphaned_attrs(line_pool) == 0
+    assert line_pool.lookup(FEATURES, ["playful"]) is None
+
+
+def test_old_pool_gets_the_cascading_attrs_table(tmp_path):
+    path = str(tmp_path / "pool.sqlite3")
+    line_pool = LinePool(path)
+    _add(line_pool, "Is your dog single too?")
+    line_pool._conn.close()
+    # Recreate pool_attrs the way pools made before the foreign key had it, plus an orphaned row
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute("ALTER TABLE pool_attrs RENAME TO pool_attrs_fk")
+    conn.execute("CREATE TABLE pool_attrs (attr TEXT NOT NULL, line_id INTEGER NOT NULL)")
+    conn.execute("INSERT INTO pool_attrs SELECT attr, line_id FROM pool_attrs_fk")
+    conn.execute("INSERT INTO pool_attrs VALUES ('cat', 999)")
+    conn.execute("DROP TABLE pool_attrs_fk")
+    conn.close()
+
+    line_pool = LinePool(path)
+    assert _orphaned_attrs(line_pool) == 0
+    line_pool.clear()
+    (attrs,) = line_pool._conn.execute("SELECT COUNT(*) FROM pool_attrs").fetchone()
+    assert attrs == 0
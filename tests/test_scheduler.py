@@ -0,0 +1,101 @@
+import asyncio
+
+import pytest
+
+from app import scheduler
+from app.scheduler import AIMD_MIN_SAMPLES, AdaptiveLimit
+
+
+@pytest.fixture(autouse=True)
+def no_cooldown(monkeypatch):
+    monkeypatch.setattr(scheduler, "AIMD_BACKOFF", 0.5)
+    monkeypatch.setattr(scheduler, "AIMD_LATENCY_FACTOR", 3.0)
+    monkeypatch.setattr(scheduler, "AIMD_COOLDOWN_S", 0.0)
+
+
+def test_success_adds_one_over_limit():
+    limit = AdaptiveLimit(initial=4, minimum=1, maximum=10)
+    limit.on_success(0.1)
+    assert limit.limit == pytest.approx(4.25)
+    for _ in range(100):
+        limit.on_success(0.1)
+    assert limit.limit == 10
+
+
+def test_overload_halves_down_to_minimum():
+    limit = AdaptiveLimit(initial=16, minimum=3, maximum=32)
+    limit.on_overload(None)
+    assert limit.limit == 8
+    limit.on_overload(None)
+    limit.on_overload(None)
+    assert limit.limit == 3
+    assert limit.decreases == 3
+
+
+def test_decreases_wait_for_the_cooldown(monkeypatch):
+    monkeypatch.setattr(scheduler, "AIMD_COOLDOWN_S", 60.0)
+    limit = AdaptiveLimit(initial=16, minimum=1, maximum=32)
+    limit.on_overload(2.0)
+    limit.on_overload(None)
+    assert limit.limit == 8
+    assert limit.decreases == 1
+    assert limit.stats()["blocked_for_s"] > 0
+
+
+def test_slow_call_decreases_against_its_own_kind():
+    limit = AdaptiveLimit(initial=16, minimum=1, maximum=32)
+    for _ in range(AIMD_MIN_SAMPLES):
+        limit.on_success(0.1, kind="generate:m")
+    before = limit.limit
+    # A batched call is slower by nature; it is only compared with other batched calls
+    limit.on_success(1.0, kind="generate_batch:m")
+    assert limit.limit > before
+    limit.on_success(1.0, kind="generate:m")
+    assert limit.limit == pytest.approx((before + 1 / before) / 2)
+
+
+def test_interactive_waiters_are_served_before_batch():
+    async def run():
+        limit = AdaptiveLimit(initial=1, minimum=1, maximum=1)
+        await limit.acquire("interactive")
+        order = []
+
+        async def waiter(name, priority):
+            await limit.acquire(priority)
+            order.append(name)
+
+        batch = asyncio.create_task(waiter("batch", "batch"))
+        await asyncio.sleep(0)
+        interactive = asyncio.create_task(waiter("interactive", "interactive"))
+        await asyncio.sleep(0)
+        assert limit.stats()["queued"] == {"interactive": 1, "batch": 1}
+
+        limit.release()
+        await interactive
+        assert order == ["interactive"]
+        assert limit.in_flight == 1
+        limit.release()
+        await batch
+        assert order == ["interactive", "batch"]
+        assert limit.in_flight == 1
+
+    asyncio.run(run())
+
+
+def test_cancelled_waiter_passes_its_slot_on():
+    async def run():
+        limit = AdaptiveLimit(initial=1, minimum=1, maximum=1)
+        await limit.acquire("interactive")
+        first = asyncio.create_task(limit.acquire("interactive"))
+        second = asyncio.create_task(limit.acquire("interactive"))
+        await asyncio.sleep(0)
+
+        # The slot is handed to `first`, which is cancelled before it runs
+        limit.release()
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        await asyncio.wait_for(second, 1)
+        assert limit.in_flight == 1
+
+    asyncio.run(run())